@@ -0,0 +1,114 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import argparse
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
+from data import PSANAImage, PANEL_SHAPE, sample_shapes
+from frame_source import FrameSource
+from instrument import Timers
+from batch_ring import BatchRing, RingBatches, default_n_slots, ring_loader
+
+# Samples per second of PSANAImage through the default DataLoader path (per-sample tensors, collation,
+# IPC of every batch) and through a shared-memory BatchRing, on synthetic frames and peaks.
+
+
+class SyntheticFrames(FrameSource):
+
+    def __init__(self, n_events):
+        super(SyntheticFrames, self).__init__("synthetic", 0)
+        self.times = np.arange(n_events)
+        self.base = np.random.rand(*PANEL_SHAPE).astype(np.float32) * 100.
+
+    def build(self, times=None):
+        pass
+
+    def read_img(self, event_idx):
+        # a copy, as a frame read from the page cache would be
+        return self.base.copy()
+
+
+def synthetic_dataset(n_events, n_peaks, downsample, n_classes, pool_in_loader):
+    dataset = PSANAImage.__new__(PSANAImage)
+    dataset.psana = SyntheticFrames(n_events)
+    dataset.cxi = []
+    for event_idx in range(n_events):
+        s = np.random.randint(0, PANEL_SHAPE[0], size=n_peaks).astype(np.int16)
+        r = (np.random.rand(n_peaks) * PANEL_SHAPE[1]).astype(np.float32)
+        c = (np.random.rand(n_peaks) * PANEL_SHAPE[2]).astype(np.float32)
+        dataset.cxi.append((event_idx, s, r, c))
+    dataset.rand_idxs = np.arange(n_events)
+    dataset.n = n_events
+    dataset.ratio_used = 1.
+    dataset.normalize = True
+    dataset.timers = Timers()
+    dataset.downsample = downsample
+    dataset.n_classes = n_classes
+    dataset.use_indexed_peaks = False
+    dataset.mode = "peaknet2020"
+    dataset.label_cache = None
+    dataset.sparse_labels = False
+    dataset.pool_in_loader = pool_in_loader and downsample >= 2
+    return dataset
+
+
+def run_default(dataset, batch_size, num_workers):
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=num_workers)
+    seen = 0
+    tic = time.time()
+    for x, y, n_trials in data_loader:
+        x.sum()
+        seen += x.size(0)
+    return seen / (time.time() - tic)
+
+
+def run_ring(dataset, batch_size, num_workers, ring):
+    batches = BatchSampler(RandomSampler(dataset), batch_size, drop_last=True)
+    data_loader = ring_loader(RingBatches(dataset, batches, ring), num_workers=num_workers)
+    seen = 0
+    tic = time.time()
+    for slot, n_batch in data_loader:
+        x, y, n_trials = ring.batch(slot, n_batch)
+        x.sum()
+        seen += x.size(0)
+        ring.release(slot)
+    return seen / (time.time() - tic)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--n_events", type=int, default=256)
+    p.add_argument("--n_peaks", type=int, default=200)
+    p.add_argument("--batch_size", type=int, default=8)
+    p.add_argument("--downsample", type=int, default=2)
+    p.add_argument("--n_classes", type=int, default=1)
+    p.add_argument("--pool_in_loader", type=str, default="False")
+    p.add_argument("--num_workers", type=int, nargs="+", default=[0, 2, 4])
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    pool_in_loader = args.pool_in_loader == "True"
+    dataset = synthetic_dataset(args.n_events, args.n_peaks, args.downsample, args.n_classes, pool_in_loader)
+
+    # both paths produce the same samples
+    ring = BatchRing(1, 1, sample_shapes(args.downsample, args.n_classes, False, pool_in_loader))
+    for idx in [0, args.n_events // 2]:
+        dataset.fill_sample(idx, *ring.sample(0, 0))
+        for a, b in zip(dataset[idx], ring.batch(0)):
+            assert torch.equal(a, b[0])
+
+    for num_workers in args.num_workers:
+        ring = BatchRing(default_n_slots(num_workers), args.batch_size,
+                         sample_shapes(args.downsample, args.n_classes, False, pool_in_loader))
+        default_rate = run_default(dataset, args.batch_size, num_workers)
+        ring_rate = run_ring(dataset, args.batch_size, num_workers, ring)
+        print("num_workers {:2d} | default DataLoader {:8.1f} samples/s | batch ring ({} slots) {:8.1f} samples/s"
+              " | x{:.2f}".format(num_workers, default_rate, ring.n_slots, ring_rate, ring_rate / default_rate))
+
+
+if __name__ == "__main__":
+    main()
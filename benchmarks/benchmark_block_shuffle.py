@@ -0,0 +1,83 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import argparse
+import tempfile
+import time
+import numpy as np
+from data import PANEL_SHAPE, block_shuffle
+from frame_source import FrameSource, H5FrameSource, export_frames, frame_path
+
+# Frames per second read from an exported run (H5FrameSource) in fully random order and in block shuffled
+# order. Each pass opens the run anew, after the file is dropped from the page cache, so the reads hit the storage.
+
+
+class SyntheticFrames(FrameSource):
+
+    def __init__(self, n_events):
+        super(SyntheticFrames, self).__init__("synthetic", 0)
+        self.times = np.arange(n_events)
+
+    def build(self, times=None):
+        pass
+
+    def read_img(self, event_idx):
+        return np.random.rand(*PANEL_SHAPE).astype(np.float32)
+
+
+def drop_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def read_rate(exp, run, frame_dir, order, n_reads):
+    # pages still mapped are not evicted: the file is dropped from the cache with no source open on it
+    source = H5FrameSource(exp, run, frame_dir=frame_dir)
+    drop_page_cache(source.path)
+    source.build()
+    tic = time.time()
+    for event_idx in order[:n_reads]:
+        source.load_img(int(event_idx))
+    rate = n_reads / (time.time() - tic)
+    source.close()
+    return rate
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--frame_dir", type=str, default=None, help="Exported frames; a synthetic run is written if None")
+    p.add_argument("--exp", type=str, default="synthetic")
+    p.add_argument("--run", type=int, default=0)
+    p.add_argument("--n_events", type=int, default=256, help="Events of the synthetic run")
+    p.add_argument("--n_reads", type=int, default=128)
+    p.add_argument("--block_size", type=int, nargs="+", default=[1, 4, 16, 64])
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    tmp_dir = None
+    if args.frame_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        args.frame_dir = tmp_dir.name
+        print("Writing {} synthetic frames...".format(args.n_events))
+        export_frames(SyntheticFrames(args.n_events), frame_path(args.frame_dir, args.exp, args.run))
+    source = H5FrameSource(args.exp, args.run, frame_dir=args.frame_dir)
+    source.build()
+    event_idxs = np.flatnonzero(source.rows >= 0)
+    source.close()
+    n_reads = min(args.n_reads, len(event_idxs))
+    rng = np.random.RandomState(0)
+    for block_size in args.block_size:
+        order = event_idxs[block_shuffle(event_idxs, block_size, rng)]
+        name = "full random" if block_size <= 1 else "block size {}".format(block_size)
+        print("{:16s} | {:8.1f} frames/s".format(name, read_rate(args.exp, args.run, args.frame_dir, order, n_reads)))
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
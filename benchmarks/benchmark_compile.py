@@ -0,0 +1,78 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import torch
+from data import PANEL_SHAPE
+from compiled import CompiledModel
+from models import AdaFilter_0, AdaFilter_1, AdaFilter_2
+from unet import UNet
+
+# Inference latency of each model run eagerly, through torch.compile and through frozen TorchScript traces
+# (see compiled.CompiledModel), at the batch sizes of training and peak finding, on random panels.
+# Also checks that the compiled outputs match the eager ones.
+
+
+def build_model(name, downsample):
+    params = {"downsample": downsample, "use_adaptive_filtering": True, "run_dataset_path": None}
+    if name == "UNet":
+        return UNet(n_channels=1, n_classes=1, n_filters=24, params=params)
+    return {"model_0": AdaFilter_0, "model_1": AdaFilter_1, "model_2": AdaFilter_2}[name](params=params)
+
+
+def timeit(f, x, n_repeats):
+    with torch.no_grad():
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        tic = time.time()
+        for _ in range(n_repeats):
+            f(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+    return (time.time() - tic) / n_repeats * 1e3
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--models", type=str, nargs="+", default=["model_0", "model_1", "model_2", "UNet"])
+    p.add_argument("--modes", type=str, nargs="+", default=["compile", "trace"])
+    p.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 10])
+    p.add_argument("--downsample", type=int, default=2)
+    p.add_argument("--n_repeats", type=int, default=10)
+    p.add_argument("--gpu", "-g", type=int, default=0, help="Use GPU x")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.gpu is not None and torch.cuda.is_available():
+        device = torch.device("cuda:{}".format(args.gpu))
+    else:
+        device = torch.device("cpu")
+    torch.manual_seed(0)
+    for name in args.models:
+        model = build_model(name, args.downsample).to(device).eval()
+        for batch_size in args.batch_sizes:
+            x = torch.rand((batch_size,) + PANEL_SHAPE, device=device)
+            with torch.no_grad():
+                reference = model(x)
+            t_eager = timeit(model, x, args.n_repeats)
+            line = "{:8s} batch {:3d} | eager {:9.2f} ms".format(name, batch_size, t_eager)
+            for mode in args.modes:
+                runner = CompiledModel(model, mode)
+                warm_up_time = runner.warm_up(x)
+                if runner.mode == "eager":
+                    line += " | {} failed".format(mode)
+                    continue
+                with torch.no_grad():
+                    max_diff = (runner(x) - reference).abs().max().item()
+                t = timeit(runner, x, args.n_repeats)
+                line += " | {} {:9.2f} ms x{:.2f} (warm-up {:.1f} s, max diff {:.1e})".format(
+                    mode, t, t_eager / t, warm_up_time, max_diff)
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import argparse
+import time
+import torch
+from data import PANEL_SHAPE
+from models import AdaFilter_1
+from models.dynamic_conv import choose_method
+
+# Forward and forward + backward time of AdaFilter_1 with each implementation of its per-panel dynamic
+# convolution (see models.dynamic_conv), over batch sizes and downsampling factors, on random panels.
+# Outputs and parameter gradients are checked against the grouped convolution.
+
+
+def run(model, x, method):
+    model.dynamic_conv = method
+    model.zero_grad(set_to_none=True)
+    out = model(x)
+    out.square().mean().backward()
+    return out.detach(), {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+
+
+def timeit(f, x, n_repeats):
+    f()
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    tic = time.time()
+    for _ in range(n_repeats):
+        f()
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    return (time.time() - tic) / n_repeats * 1e3
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 10, 32])
+    p.add_argument("--downsamples", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--methods", type=str, nargs="+", default=["grouped", "unfold", "shift"])
+    p.add_argument("--n_repeats", type=int, default=5)
+    p.add_argument("--gpu", "-g", type=int, default=0, help="Use GPU x")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.gpu is not None and torch.cuda.is_available():
+        device = torch.device("cuda:{}".format(args.gpu))
+    else:
+        device = torch.device("cpu")
+    torch.manual_seed(0)
+    for downsample in args.downsamples:
+        model = AdaFilter_1(params={"downsample": downsample, "use_adaptive_filtering": True}).to(device)
+        # BatchNorm statistics do not move between the runs compared
+        model.eval()
+        for batch_size in args.batch_sizes:
+            x = torch.rand((batch_size,) + PANEL_SHAPE, device=device)
+            x_ds = model.downsample_for_visualization(x)
+            # first dynamic layer (1 -> 16 channels, 3 x 3) of the (1, N * 32, h, w) padded input, shapes only
+            w_1 = torch.empty(batch_size * 32 * 16, 1, 3, 3, device="meta")
+            x_pad = torch.empty(1, batch_size * 32, x_ds.size(2) + 2, x_ds.size(3) + 2, device="meta")
+            line = "downsample {} batch {:3d} (auto: {:7s}) |".format(downsample, batch_size,
+                                                                  choose_method(x_pad, w_1, batch_size * 32))
+            reference = None
+            for method in args.methods:
+                out, grads = run(model, x, method)
+                if reference is None:
+                    reference = (out, grads)
+                    diff = 0.
+                else:
+                    diff = max([(out - reference[0]).abs().max().item()] +
+                               [(grads[name] - reference[1][name]).abs().max().item() for name in grads])
+                with torch.no_grad():
+                    t_fwd = timeit(lambda: model(x), x, args.n_repeats)
+                t_bwd = timeit(lambda: run(model, x, method), x, args.n_repeats)
+                line += " {} fwd {:8.1f} ms fwd+bwd {:8.1f} ms (diff {:.1e}) |".format(method, t_fwd, t_bwd, diff)
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
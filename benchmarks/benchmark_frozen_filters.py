@@ -0,0 +1,121 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import argparse
+import time
+import numpy as np
+import torch
+from data import PSANAImage, PANEL_SHAPE, preprocess_imgs
+from loss import PeakNetBCE1ChannelLoss
+from metrics import MetricsAccumulator
+from frozen_filters import FrozenFilters
+from models import AdaFilter_1
+
+# Throughput and accuracy of AdaFilter_1 over synthetic runs (a fixed background per run, noise and
+# Gaussian peaks per event) with per-event adaptive filters and with filters frozen after calibration
+# (see frozen_filters). Recall / precision are against the planted peaks; a trained model can be given.
+
+
+def loss_params():
+    return {"pos_weight": 1e-1, "use_indexed_peaks": False, "gamma": 1., "use_focal_loss": False, "gamma_FL": 1.,
+            "use_scheduled_pos_weight": False, "pos_weight_0": 1e2, "annihilation_speed": 1e-1,
+            "debug_metrics": False}
+
+
+def synthetic_run(rng, n_batches, batch_size, n_peaks, downsample):
+    n_panels, h, w = PANEL_SHAPE
+    background = 5. * rng.rand(n_panels, h, w).astype(np.float32)
+    dataset = PSANAImage.__new__(PSANAImage)
+    dataset.downsample = downsample
+    dataset.n_classes = 1
+    dataset.use_indexed_peaks = False
+    h_ds, w_ds = int(h / float(downsample)), int(w / float(downsample))
+    rows, cols = np.mgrid[-2:3, -2:3]
+    blob = 20. * np.exp(-(rows ** 2 + cols ** 2) / 2.).astype(np.float32)
+    batches = []
+    for _ in range(n_batches):
+        imgs = background + rng.rand(batch_size, n_panels, h, w).astype(np.float32)
+        labels = []
+        for b in range(batch_size):
+            s = rng.randint(0, n_panels, size=n_peaks).astype(np.int16)
+            r = rng.randint(2, h - 3, size=n_peaks)
+            c = rng.randint(2, w - 3, size=n_peaks)
+            for si, ri, ci in zip(s, r, c):
+                imgs[b, si, ri - 2:ri + 3, ci - 2:ci + 3] += blob
+            labels.append(dataset.render_label((0, s, r.astype(np.float32), c.astype(np.float32)), n_panels, h_ds,
+                                               w_ds))
+        preprocess_imgs(imgs)
+        y = torch.stack(labels)
+        batches.append((torch.from_numpy(imgs), y.view(-1, y.size(2), y.size(3), y.size(4))))
+    return batches
+
+
+def run(forward, runs, loss_func, device, cutoff):
+    accumulator = MetricsAccumulator()
+    n_events = 0
+    elapsed = 0.
+    with torch.no_grad():
+        for batches in runs:
+            if isinstance(forward, FrozenFilters):
+                forward.start_run()
+            for x, y in batches:
+                x = x.to(device)
+                tic = time.time()
+                scores = forward(x)
+                if x.is_cuda:
+                    torch.cuda.synchronize(x.device)
+                elapsed += time.time() - tic
+                n_events += x.size(0)
+                accumulator.add(loss_func(scores, y.to(device), cutoff=cutoff))
+    metrics = accumulator.values()
+    return 1e3 * elapsed / n_events, metrics["recall"], metrics["precision"]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--model_path", type=str, default=None, help="A trained AdaFilter_1 (.PT); random weights if None")
+    p.add_argument("--downsample", type=int, default=2)
+    p.add_argument("--n_runs", type=int, default=3)
+    p.add_argument("--n_batches", type=int, default=10, help="Batches per run")
+    p.add_argument("--batch_size", type=int, default=4)
+    p.add_argument("--n_peaks", type=int, default=100, help="Peaks per event")
+    p.add_argument("--n_calibration", type=int, nargs="+", default=[4, 16])
+    p.add_argument("--drift_check_every", type=int, default=16)
+    p.add_argument("--cutoff", type=float, default=0.5)
+    p.add_argument("--gpu", "-g", type=int, default=0, help="Use GPU x")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.gpu is not None and torch.cuda.is_available():
+        device = torch.device("cuda:{}".format(args.gpu))
+    else:
+        device = torch.device("cpu")
+    torch.manual_seed(0)
+    if args.model_path is not None:
+        model = torch.load(args.model_path, map_location="cpu", weights_only=False)
+    else:
+        model = AdaFilter_1(params={"downsample": args.downsample, "use_adaptive_filtering": True})
+    model = model.to(device).eval()
+    label_downsample = args.downsample if model.downsample_bool else 1
+    rng = np.random.RandomState(0)
+    runs = [synthetic_run(rng, args.n_batches, args.batch_size, args.n_peaks, label_downsample)
+            for _ in range(args.n_runs)]
+    loss_func = PeakNetBCE1ChannelLoss(loss_params(), device).to(device)
+
+    ms, recall, precision = run(model, runs, loss_func, device, args.cutoff)
+    print("per-event filters        | {:8.2f} ms / event | recall {:.4f} precision {:.4f}".format(ms, recall, precision))
+    for n_calibration in args.n_calibration:
+        frozen = FrozenFilters(model, n_calibration=n_calibration, drift_check_every=args.drift_check_every,
+                               cutoff=args.cutoff)
+        ms_frozen, recall_frozen, precision_frozen = run(frozen, runs, loss_func, device, args.cutoff)
+        print("frozen, {:3d} calibration | {:8.2f} ms / event | recall {:.4f} ({:+.4f}) precision {:.4f} ({:+.4f}) "
+              "| x{:.2f} throughput".format(n_calibration, ms_frozen, recall_frozen, recall_frozen - recall,
+                                            precision_frozen, precision_frozen - precision, ms / ms_frozen))
+        print("  " + frozen.report())
+        model.fixed_filters = None
+
+
+if __name__ == "__main__":
+    main()
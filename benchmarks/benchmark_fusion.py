@@ -0,0 +1,90 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import torch
+from data import PANEL_SHAPE
+from compiled import CompiledModel
+from fusion import fuse_for_inference
+from models import AdaFilter_0, AdaFilter_1, AdaFilter_2
+from unet import UNet
+
+# Inference latency of each model as trained and fused for inference (see fusion.fuse_for_inference: BatchNorm
+# folded into the convolutions, reflection pads merged into them), eagerly or through a compiled mode, on
+# random panels. The BatchNorm statistics are made non-trivial first, and the fused outputs checked.
+
+
+def build_model(name, downsample):
+    params = {"downsample": downsample, "use_adaptive_filtering": True, "run_dataset_path": None}
+    if name == "UNet":
+        return UNet(n_channels=1, n_classes=1, n_filters=24, params=params)
+    return {"model_0": AdaFilter_0, "model_1": AdaFilter_1, "model_2": AdaFilter_2}[name](params=params)
+
+
+def randomize_batchnorm(model):
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2.)
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.uniform_(-0.5, 0.5)
+
+
+def timeit(f, x, n_repeats):
+    with torch.no_grad():
+        f(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        tic = time.time()
+        for _ in range(n_repeats):
+            f(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+    return (time.time() - tic) / n_repeats * 1e3
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--models", type=str, nargs="+", default=["model_0", "model_1", "model_2", "UNet"])
+    p.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 10])
+    p.add_argument("--downsample", type=int, default=2)
+    p.add_argument("--compile", type=str, default="eager", help="eager, compile (torch.compile) or trace (TorchScript)")
+    p.add_argument("--n_repeats", type=int, default=10)
+    p.add_argument("--gpu", "-g", type=int, default=0, help="Use GPU x")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.gpu is not None and torch.cuda.is_available():
+        device = torch.device("cuda:{}".format(args.gpu))
+    else:
+        device = torch.device("cpu")
+    torch.manual_seed(0)
+    for name in args.models:
+        model = build_model(name, args.downsample).to(device)
+        randomize_batchnorm(model)
+        model.eval()
+        fused = fuse_for_inference(model)
+        n_modules = len(list(model.modules()))
+        n_fused_modules = len(list(fused.modules()))
+        for batch_size in args.batch_sizes:
+            x = torch.rand((batch_size,) + PANEL_SHAPE, device=device)
+            with torch.no_grad():
+                max_diff = (fused(x) - model(x)).abs().max().item()
+            runner = CompiledModel(model, args.compile)
+            fused_runner = CompiledModel(fused, args.compile)
+            runner.warm_up(x)
+            fused_runner.warm_up(x)
+            t = timeit(runner, x, args.n_repeats)
+            t_fused = timeit(fused_runner, x, args.n_repeats)
+            print("{:8s} batch {:3d} | {} {:9.2f} ms | fused {:9.2f} ms x{:.2f} | modules {} -> {} | max diff "
+                  "{:.1e}".format(name, batch_size, runner.mode, t, t_fused, t / t_fused, n_modules, n_fused_modules,
+                                  max_diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import argparse
+import time
+import numpy as np
+import torch
+from data import PSANAImage
+
+# Compares the vectorized label rasterizer of PSANAImage against the per-peak loop it replaced.
+
+
+def loop_make_label(s, r, c, downsample, n_panels=32, h=24, w=49):
+    label = torch.zeros(n_panels, 3, h, w)
+    for i in range(n_panels):
+        my_r = r[s == i]
+        my_c = c[s == i]
+        for j in range(len(my_r)):
+            u = int(np.floor(my_r[j] / float(downsample)))
+            v = int(np.floor(my_c[j] / float(downsample)))
+            if u < h and v < w:
+                label[i, 0, u, v] = 1
+                label[i, 1, u, v] = np.fmod(my_r[j] / float(downsample), 1.0)
+                label[i, 2, u, v] = np.fmod(my_c[j] / float(downsample), 1.0)
+    return label
+
+
+def loop_make_label_with_idxg(s, r, c, s_idxg, r_idxg, c_idxg, downsample, n_panels=32, h=24, w=49):
+    label = torch.zeros(n_panels, 6, h, w)
+    label[:, :3, :, :] = loop_make_label(s, r, c, downsample, n_panels=n_panels, h=h, w=w)
+    label[:, 3:, :, :] = loop_make_label(s_idxg, r_idxg, c_idxg, downsample, n_panels=n_panels, h=h, w=w)
+    return label
+
+
+def random_peaks(n_peaks, n_panels=32, h=185, w=388):
+    # same dtypes as CXILabel returns them (float32 positions from the CXI file)
+    s = np.random.randint(0, n_panels, size=n_peaks).astype(np.float32)
+    r = (np.random.rand(n_peaks) * h).astype(np.float32)
+    c = (np.random.rand(n_peaks) * w).astype(np.float32)
+    return s, r, c
+
+
+def timeit(f, n_repeats):
+    f()
+    tic = time.time()
+    for _ in range(n_repeats):
+        f()
+    return (time.time() - tic) / n_repeats * 1e3
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--n_peaks", type=int, nargs="+", default=[50, 200, 800])
+    p.add_argument("--downsample", type=int, default=2)
+    p.add_argument("--n_repeats", type=int, default=20)
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    n_panels, h, w = 32, 185, 388
+    h_ds = int(h / float(args.downsample))
+    w_ds = int(w / float(args.downsample))
+    dataset = PSANAImage.__new__(PSANAImage)
+    dataset.downsample = args.downsample
+
+    for n_peaks in args.n_peaks:
+        s, r, c = random_peaks(n_peaks)
+        s_idxg, r_idxg, c_idxg = random_peaks(n_peaks // 2)
+        kw = {"n_panels": n_panels, "h": h_ds, "w": w_ds}
+
+        ref_3 = loop_make_label(s, r, c, args.downsample, **kw)
+        ref_6 = loop_make_label_with_idxg(s, r, c, s_idxg, r_idxg, c_idxg, args.downsample, **kw)
+        assert torch.equal(dataset.make_label(s, r, c, **kw), ref_3)
+        assert torch.equal(dataset.make_label_with_idxg(s, r, c, s_idxg, r_idxg, c_idxg, **kw), ref_6)
+        assert torch.equal(dataset.make_label_1channel(s, r, c, **kw), ref_3[:, 0:1])
+        assert torch.equal(dataset.make_label_1channel(s, r, c, s_idxg, r_idxg, c_idxg, **kw), ref_6[:, [0, 3]])
+
+        t_loop_3 = timeit(lambda: loop_make_label(s, r, c, args.downsample, **kw), args.n_repeats)
+        t_vec_3 = timeit(lambda: dataset.make_label(s, r, c, **kw), args.n_repeats)
+        t_loop_6 = timeit(lambda: loop_make_label_with_idxg(s, r, c, s_idxg, r_idxg, c_idxg, args.downsample, **kw),
+                          args.n_repeats)
+        t_vec_6 = timeit(lambda: dataset.make_label_with_idxg(s, r, c, s_idxg, r_idxg, c_idxg, **kw), args.n_repeats)
+        t_vec_1 = timeit(lambda: dataset.make_label_1channel(s, r, c, s_idxg, r_idxg, c_idxg, **kw), args.n_repeats)
+        print("nPeaks {:5d} | 3 channels: loop {:8.3f} ms  vectorized {:6.3f} ms | "
+              "6 channels: loop {:8.3f} ms  vectorized {:6.3f} ms | 1 channel + idxg: vectorized {:6.3f} ms"
+              .format(n_peaks, t_loop_3, t_vec_3, t_loop_6, t_vec_6, t_vec_1))
+    print("All outputs identical to the loop version.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import resource
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+from data import PSANAImage, PANEL_SHAPE, preprocess_imgs
+from loss import PeakNetBCE1ChannelLoss
+from metrics import MetricsAccumulator
+from precision import MixedPrecision
+from models import AdaFilter_0, AdaFilter_1, AdaFilter_2
+from unet import UNet
+
+# Trains each model for a few steps on synthetic panels (noise plus Gaussian peaks) in float32 and in mixed
+# precision, from the same initialization, and compares the step time, the peak memory (CUDA allocator, or
+# the growth of the peak RSS on CPU) and recall / precision on held-out synthetic events.
+
+
+def build_model(name, downsample):
+    params = {"downsample": downsample, "use_adaptive_filtering": True, "run_dataset_path": None}
+    if name == "UNet":
+        return UNet(n_channels=1, n_classes=1, n_filters=24, params=params)
+    return {"model_0": AdaFilter_0, "model_1": AdaFilter_1, "model_2": AdaFilter_2}[name](params=params)
+
+
+def loss_params():
+    return {"pos_weight": 1e-1, "use_indexed_peaks": False, "gamma": 1., "use_focal_loss": False, "gamma_FL": 1.,
+            "use_scheduled_pos_weight": False, "pos_weight_0": 1e2, "annihilation_speed": 1e-1,
+            "debug_metrics": False}
+
+
+def synthetic_batch(rng, batch_size, n_peaks, label_downsample):
+    n_panels, h, w = PANEL_SHAPE
+    imgs = rng.rand(batch_size, n_panels, h, w).astype(np.float32)
+    dataset = PSANAImage.__new__(PSANAImage)
+    dataset.downsample = label_downsample
+    dataset.n_classes = 1
+    dataset.use_indexed_peaks = False
+    h_ds, w_ds = int(h / float(label_downsample)), int(w / float(label_downsample))
+    rows, cols = np.mgrid[-2:3, -2:3]
+    blob = 20. * np.exp(-(rows ** 2 + cols ** 2) / 2.).astype(np.float32)
+    labels = []
+    for b in range(batch_size):
+        s = rng.randint(0, n_panels, size=n_peaks).astype(np.int16)
+        r = rng.randint(2, h - 3, size=n_peaks)
+        c = rng.randint(2, w - 3, size=n_peaks)
+        for si, ri, ci in zip(s, r, c):
+            imgs[b, si, ri - 2:ri + 3, ci - 2:ci + 3] += blob
+        labels.append(dataset.render_label((0, s, r.astype(np.float32), c.astype(np.float32)), n_panels, h_ds, w_ds))
+    preprocess_imgs(imgs)
+    y = torch.stack(labels)
+    return torch.from_numpy(imgs), y.view(-1, y.size(2), y.size(3), y.size(4))
+
+
+def run(name, mode, args, device, results):
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    model = build_model(name, args.downsample).to(device)
+    label_downsample = args.downsample if getattr(model, "downsample_bool", False) else 1
+    batches = [synthetic_batch(rng, args.batch_size, args.n_peaks, label_downsample) for _ in range(args.n_batches)]
+    held_out = [synthetic_batch(rng, args.batch_size, args.n_peaks, label_downsample) for _ in range(2)]
+    loss_func = PeakNetBCE1ChannelLoss(loss_params(), device).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    precision = MixedPrecision(mode, device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    rss_0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    model.train()
+    step_times = []
+    for step in range(args.n_steps):
+        x, y = batches[step % len(batches)]
+        x, y = x.to(device), y.to(device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        tic = time.time()
+        optimizer.zero_grad()
+        with precision.autocast():
+            scores = model(x)
+        loss = loss_func(scores, y, cutoff=args.cutoff)["loss"]
+        precision.backward(loss)
+        precision.step(optimizer)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        step_times.append(time.time() - tic)
+
+    model.eval()
+    accumulator = MetricsAccumulator()
+    with torch.no_grad():
+        for x, y in held_out:
+            with precision.autocast():
+                scores = model(x.to(device))
+            accumulator.add(loss_func(scores, y.to(device), cutoff=args.cutoff))
+    metrics = accumulator.values()
+    if device.type == "cuda":
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2. ** 20
+    else:
+        # kB on Linux
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_0) / 2. ** 10
+    warm = step_times[min(args.n_warmup, len(step_times) - 1):]
+    results.put((name, mode, 1e3 * np.mean(warm), peak_mb, metrics["loss"], metrics["recall"], metrics["precision"]))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--models", type=str, nargs="+", default=["model_0", "model_1", "model_2", "UNet"])
+    p.add_argument("--precisions", type=str, nargs="+", default=["fp32", "amp"])
+    p.add_argument("--batch_size", type=int, default=4)
+    p.add_argument("--downsample", type=int, default=2)
+    p.add_argument("--n_peaks", type=int, default=100, help="Peaks per event")
+    p.add_argument("--n_batches", type=int, default=4, help="Distinct synthetic training batches")
+    p.add_argument("--n_steps", type=int, default=30)
+    p.add_argument("--n_warmup", type=int, default=5, help="Steps left out of the timing")
+    p.add_argument("--lr", type=float, default=1e-2)
+    p.add_argument("--cutoff", type=float, default=0.5)
+    p.add_argument("--gpu", "-g", type=int, default=0, help="Use GPU x")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.gpu is not None and torch.cuda.is_available():
+        device = torch.device("cuda:{}".format(args.gpu))
+    else:
+        device = torch.device("cpu")
+    # one process per run, so that each has its own peak RSS
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    print("{:8s} {:5s} | {:>10s} {:>12s} | {:>8s} {:>7s} {:>9s}".format(
+        "model", "prec", "ms / step", "peak MB", "loss", "recall", "precision"))
+    for name in args.models:
+        reference = None
+        for mode in args.precisions:
+            process = ctx.Process(target=run, args=(name, mode, args, device, results))
+            process.start()
+            name, mode, step_ms, peak_mb, loss, recall, prec = results.get()
+            process.join()
+            if reference is None:
+                reference = step_ms
+            print("{:8s} {:5s} | {:10.1f} {:12.1f} | {:8.4f} {:7.3f} {:9.3f}   x{:.2f}".format(
+                name, mode, step_ms, peak_mb, loss, recall, prec, reference / step_ms))
+
+
+if __name__ == "__main__":
+    main()
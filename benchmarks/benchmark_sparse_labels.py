@@ -0,0 +1,94 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import argparse
+import time
+import numpy as np
+import torch
+from data import PSANAImage
+from sparse_labels import SparseLabels
+
+# Checks that sparse labels rasterized in the loss equal the dense labels of PSANAImage, and compares
+# the bytes shipped per batch and the rendering time of both paths.
+
+
+def random_peaks(n_peaks, n_panels=32, h=185, w=388):
+    s = np.random.randint(0, n_panels, size=n_peaks).astype(np.float32)
+    r = (np.random.rand(n_peaks) * h).astype(np.float32)
+    c = (np.random.rand(n_peaks) * w).astype(np.float32)
+    return s, r, c
+
+
+def label_bytes(labels):
+    if isinstance(labels, SparseLabels):
+        tensors = [labels.peaks, labels.counts, labels.idxg_peaks, labels.idxg_counts]
+        return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+    return labels.numel() * labels.element_size()
+
+
+def timeit(f, n_repeats):
+    f()
+    tic = time.time()
+    for _ in range(n_repeats):
+        f()
+    return (time.time() - tic) / n_repeats * 1e3
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--n_peaks", type=int, nargs="+", default=[50, 200, 800])
+    p.add_argument("--batch_size", type=int, default=8)
+    p.add_argument("--downsample", type=int, default=2)
+    p.add_argument("--n_repeats", type=int, default=10)
+    p.add_argument("--gpu", "-g", type=int, default=0, help="Use GPU x")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.gpu is not None and torch.cuda.is_available():
+        device = torch.device("cuda:{}".format(args.gpu))
+    else:
+        device = torch.device("cpu")
+    n_panels, h, w = 32, 185, 388
+    h_ds = int(h / float(args.downsample))
+    w_ds = int(w / float(args.downsample))
+
+    for n_classes, use_indexed_peaks in [(1, False), (1, True), (3, False), (3, True)]:
+        dataset = PSANAImage.__new__(PSANAImage)
+        dataset.downsample = args.downsample
+        dataset.n_classes = n_classes
+        dataset.use_indexed_peaks = use_indexed_peaks
+        for n_peaks in args.n_peaks:
+            items = []
+            for _ in range(args.batch_size):
+                n = np.random.randint(n_peaks // 2, n_peaks + 1)
+                item = (0,) + random_peaks(n)
+                if use_indexed_peaks:
+                    item = item + random_peaks(n // 2)
+                items.append(item)
+
+            def dense():
+                labels = torch.stack([dataset.render_label(item, n_panels, h_ds, w_ds) for item in items])
+                return labels.view(-1, labels.size(2), labels.size(3), labels.size(4)).to(device)
+
+            def sparse():
+                return SparseLabels.collate([dataset.sparse_label(item, n_panels, h_ds, w_ds) for item in items])
+
+            assert torch.equal(sparse().to_dense(device), dense())
+            dense_bytes = label_bytes(torch.stack([dataset.render_label(item, n_panels, h_ds, w_ds)
+                                                   for item in items]))
+            sparse_bytes = label_bytes(sparse())
+            t_dense = timeit(dense, args.n_repeats)
+            t_pack = timeit(sparse, args.n_repeats)
+            labels = sparse()
+            t_raster = timeit(lambda: labels.to_dense(device), args.n_repeats)
+            print("n_classes {} idxg {:5s} nPeaks {:5d} | dense {:9.1f} kB, {:7.3f} ms (worker) | "
+                  "sparse {:7.1f} kB, {:6.3f} ms (worker) + {:6.3f} ms ({})".format(
+                      n_classes, str(use_indexed_peaks), n_peaks, dense_bytes / 1024., t_dense,
+                      sparse_bytes / 1024., t_pack, t_raster, device))
+    print("All sparse labels identical to the dense ones.")
+
+
+if __name__ == "__main__":
+    main()
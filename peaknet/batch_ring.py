@@ -0,0 +1,102 @@
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+
+class BatchRing(object):
+    """
+    Preallocated batch buffers in shared memory, recycled between DataLoader workers and the trainer.
+    A worker takes a free slot, writes its samples in place (dataset.fill_sample) and yields only
+    (slot, number of samples); the trainer reads views of the slot and gives it back with release()
+    once the step is done. Nothing is allocated, collated or pickled per sample.
+    """
+
+    def __init__(self, n_slots, batch_size, sample_shapes, dtype=torch.float32):
+        self.n_slots = n_slots
+        self.batch_size = batch_size
+        self.buffers = [torch.zeros((n_slots, batch_size) + tuple(shape), dtype=dtype).share_memory_()
+                        for shape in sample_shapes]
+        self.free = mp.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+
+    def acquire(self):
+        # blocks until the trainer releases a slot
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(int(slot))
+
+    def sample(self, slot, k):
+        return [buffer[slot, k] for buffer in self.buffers]
+
+    def batch(self, slot, n=None):
+        n = self.batch_size if n is None else n
+        return [buffer[slot, :n] for buffer in self.buffers]
+
+
+def default_n_slots(num_workers, prefetch_factor=2):
+    # enough for every batch the DataLoader prefetches, plus the one in use and the one being filled
+    return max(1, num_workers) * prefetch_factor + 2
+
+
+class RingStream(IterableDataset):
+    """
+    Batches of a PSANAStream written into a BatchRing. The stream's (dataset, index) pairs are filled
+    one by one, each before the stream moves on (and possibly closes that run).
+    """
+
+    def __init__(self, stream, ring, drop_last=True):
+        self.stream = stream
+        self.ring = ring
+        self.drop_last = drop_last
+
+    def set_epoch(self, epoch):
+        self.stream.set_epoch(epoch)
+
+    def __iter__(self):
+        slot, k = None, 0
+        for dataset, idx in self.stream.iter_items():
+            if slot is None:
+                slot = self.ring.acquire()
+            dataset.fill_sample(idx, *self.ring.sample(slot, k))
+            k += 1
+            if k == self.ring.batch_size:
+                yield slot, k
+                slot, k = None, 0
+        if slot is not None:
+            if self.drop_last:
+                self.ring.release(slot)
+            else:
+                yield slot, k
+
+
+class RingBatches(IterableDataset):
+    """
+    Index batches (e.g. from a BatchSampler) of a map-style dataset with fill_sample, written into a
+    BatchRing. Batches are dealt round-robin to the DataLoader workers.
+    """
+
+    def __init__(self, dataset, batches, ring):
+        self.dataset = dataset
+        self.batches = [list(batch) for batch in batches]
+        self.ring = ring
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        for b in range(worker_id, len(self.batches), num_workers):
+            slot = self.ring.acquire()
+            for k, idx in enumerate(self.batches[b]):
+                self.dataset.fill_sample(idx, *self.ring.sample(slot, k))
+            yield slot, len(self.batches[b])
+
+
+def ring_loader(ring_dataset, num_workers=0, persistent_workers=False):
+    # the workers already yield whole batches (slot indices), so no batching or collation here
+    return DataLoader(ring_dataset, batch_size=None, num_workers=num_workers,
+                      persistent_workers=persistent_workers and num_workers > 0)
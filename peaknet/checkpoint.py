@@ -0,0 +1,137 @@
+import os
+import time
+import queue
+import random
+import threading
+from glob import glob
+import numpy as np
+import torch
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_checkpoint(state, path):
+    # written next to the target, synced and renamed over it, so that a preempted job never leaves a truncated checkpoint
+    tmp_path = path + ".{}.tmp".format(os.getpid())
+    with open(tmp_path, "wb") as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def load_checkpoint(path):
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+# the samples skipped to resume at the next batch (PSANAStream.set_resume) depend on these
+RESUME_PARAMS = ["batch_size", "num_workers", "n_open_runs", "shuffle_buffer", "block_size", "n_per_run",
+                 "min_det_peaks", "min_indexed_peaks", "use_indexed_peaks"]
+
+
+def check_resume_params(saved, params, keys=RESUME_PARAMS):
+    changed = [key for key in keys if saved.get(key) != params.get(key)]
+    if changed:
+        raise ValueError("Cannot resume at the next batch with different " + ", ".join(
+            "{} ({} in the checkpoint, {} now)".format(key, saved.get(key), params.get(key)) for key in changed) + ".")
+
+
+def snapshot(state):
+    # host copy of every tensor of a (nested) state, taken before training modifies the originals
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class CheckpointWriter(object):
+    """
+    Serializes checkpoints in a background thread. submit() only takes a host snapshot of the state on the
+    training loop; writing, fsync and the atomic rename happen off the loop. A checkpoint submitted with
+    link= is numbered, link (e.g. checkpoint.pt) is pointed at it and only the keep_last newest are kept.
+    """
+
+    def __init__(self, keep_last=3, max_queue=2):
+        self.keep_last = keep_last
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.n_written = 0
+        self.last_latency = 0.
+        self.total_latency = 0.
+        self.snapshot_time = 0.
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, state, path, link=None):
+        if self.error is not None:
+            raise self.error
+        tic = time.time()
+        state = snapshot(state)
+        self.snapshot_time += time.time() - tic
+        # blocks if max_queue checkpoints are still being written
+        self.jobs.put((state, path, link, tic))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            state, path, link, tic = job
+            try:
+                save_checkpoint(state, path)
+                if link is not None:
+                    self.update_link(path, link)
+            except Exception as e:
+                self.error = e
+            self.last_latency = time.time() - tic
+            self.total_latency += self.last_latency
+            self.n_written += 1
+
+    def update_link(self, path, link):
+        tmp_link = link + ".{}.tmp".format(os.getpid())
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.basename(path), tmp_link)
+        os.replace(tmp_link, link)
+        if self.keep_last > 0:
+            # numbered checkpoints sort by step
+            numbered = sorted(glob(os.path.splitext(link)[0] + "_*.pt"))
+            for old in numbered[:-self.keep_last]:
+                os.remove(old)
+
+    def queue_depth(self):
+        return self.jobs.qsize()
+
+    def report(self):
+        return "checkpoints: {} written ; last write {:.2f} s ; mean write {:.2f} s ; snapshots {:.2f} s ; " \
+               "queue depth {}".format(self.n_written, self.last_latency,
+                                       self.total_latency / max(1, self.n_written), self.snapshot_time,
+                                       self.queue_depth())
+
+    def close(self):
+        # waits for the pending checkpoints
+        self.jobs.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,118 @@
+import time
+import torch
+from distributed import is_distributed, all_true
+
+
+def enable_graph_cache():
+    # compiled graphs are kept on disk (inductor's FX graph cache), so that later jobs skip most of the compilation
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+
+def compiler_errors():
+    # raised by torch.compile itself (graph capture, backend compilation), as opposed to the model's own errors
+    try:
+        from torch._dynamo.exc import TorchDynamoException
+        return (TorchDynamoException,)
+    except ImportError:
+        return ()
+
+
+class CompiledModel(object):
+    """
+    Calls model through torch.compile ("compile") or TorchScript traces ("trace": inference only, one frozen
+    trace per input shape), or as is ("eager"). If compiling or tracing fails, it falls back to eager for good:
+    only the first call for an input shape, and torch.compile's own errors, fall back, anything else is raised.
+    In distributed runs the ranks must run the same graphs: they agree on falling back in warm_up, and later
+    failures are raised.
+    The model itself is left untouched: its state_dict, checkpoints and visualization use the original
+    module, without the "_orig_mod." prefix of compiled modules.
+    """
+
+    def __init__(self, model, mode="eager"):
+        if mode not in ["eager", "compile", "trace"]:
+            raise ValueError("Unrecognized compile mode " + str(mode) + " (eager, compile or trace).")
+        self.model = model
+        self.mode = mode
+        self.compiled = None
+        self.traces = {}
+        self.shapes = set()
+        self.warming_up = False
+        if mode == "compile":
+            if hasattr(torch, "compile"):
+                enable_graph_cache()
+                self.compiled = torch.compile(model)
+            else:
+                print("torch.compile is not available in this version of PyTorch, running eagerly.")
+                self.mode = "eager"
+
+    def __call__(self, x):
+        if self.mode == "eager":
+            return self.model(x)
+        key = (tuple(x.shape), x.dtype, x.device)
+        if key in self.shapes:
+            try:
+                return self.run(x)
+            except compiler_errors() as e:
+                # e.g. a recompilation
+                return self.fall_back(x, e)
+        try:
+            out = self.run(x)
+        except Exception as e:
+            # compiled (or traced) for this shape here
+            return self.fall_back(x, e)
+        self.shapes.add(key)
+        return out
+
+    def run(self, x):
+        if self.mode == "compile":
+            return self.compiled(x)
+        return self.traced(x)(x)
+
+    def fall_back(self, x, e):
+        if is_distributed() and not self.warming_up:
+            raise e
+        print("Running eagerly, " + self.mode + " failed: " + repr(e))
+        self.mode = "eager"
+        return self.model(x)
+
+    def traced(self, x):
+        key = (tuple(x.shape), x.dtype, x.device)
+        if key not in self.traces:
+            if self.model.training:
+                raise ValueError("Traces are frozen for inference, put the model in eval mode.")
+            with torch.no_grad():
+                self.traces[key] = torch.jit.freeze(torch.jit.trace(self.model, x, check_trace=False))
+        return self.traces[key]
+
+    def warm_up(self, x, n_calls=2):
+        # compiles (or traces) for the shape of x ahead of the first batch. Calls made while training also run
+        # the backward pass, compiled on its first call; parameters are untouched and BatchNorm statistics restored.
+        if self.mode == "eager":
+            return 0.
+        tic = time.time()
+        buffers = {name: b.detach().clone() for name, b in self.model.named_buffers()}
+        self.warming_up = True
+        try:
+            for _ in range(n_calls):
+                if self.model.training:
+                    self(x).float().sum().backward()
+                else:
+                    with torch.no_grad():
+                        self(x)
+        finally:
+            self.warming_up = False
+        # every rank falls back if one did
+        if not all_true(self.mode != "eager"):
+            self.mode = "eager"
+        if self.model.training:
+            self.model.zero_grad(set_to_none=True)
+            with torch.no_grad():
+                for name, b in self.model.named_buffers():
+                    b.copy_(buffers[name])
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        return time.time() - tic
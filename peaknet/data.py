@@ -1,16 +1,173 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
+from torch.utils.data import Sampler, BatchSampler, RandomSampler, SequentialSampler
 import torch
+import torch.nn as nn
 import numpy as np
 import pandas as pd
 import h5py
 import json
-import psana
+import os
 import time
+from label_cache import LabelCache
+from sparse_labels import SparseLabel, SparseLabels
+from run_pool import get_run_pool
+from instrument import Timers
+from frame_source import PSANAReader, build_frame_source, frames_exist
+
+# CSPAD geometry: panels x rows x cols
+PANEL_SHAPE = (32, 185, 388)
+
+def open_cxi_label(cxi_path, use_indexed_peaks):
+    # returns the handle and its key in the run pool, to be released with get_run_pool().release(key)
+    key = ("cxi", os.path.abspath(cxi_path), bool(use_indexed_peaks))
+    return get_run_pool().acquire(key, lambda: CXILabel(cxi_path, use_indexed_peaks)), key
+
+
+def open_frame_source(exp, run, det_name, source="psana", frame_dir=None, image_cache=None, mask_cache_dir=None):
+    pool = get_run_pool()
+    key = ("frames", source, frame_dir, str(exp), int(run), det_name)
+
+    def opener():
+        reader = build_frame_source(exp, run, det_name, source=source, frame_dir=frame_dir,
+                                    mask_cache_dir=mask_cache_dir)
+        reader.build(times=pool.times.get(key))
+        pool.times[key] = reader.times
+        return reader
+
+    reader = pool.acquire(key, opener)
+    reader.image_cache = image_cache
+    return reader, key
+
+
+def label_shape(downsample, n_classes, use_indexed_peaks, n_panels=PANEL_SHAPE[0], h=PANEL_SHAPE[1],
+                w=PANEL_SHAPE[2]):
+    h_ds = int(h / float(downsample))
+    w_ds = int(w / float(downsample))
+    if n_classes == 1:
+        n_channels = 2 if use_indexed_peaks else 1
+    else:
+        n_channels = 6 if use_indexed_peaks else 3
+    return n_panels, n_channels, h_ds, w_ds
+
+
+def sample_shapes(downsample, n_classes, use_indexed_peaks, pool_in_loader=False):
+    # shapes of the (img, label, n_trials) samples of PSANAImage, e.g. to allocate a batch_ring.BatchRing
+    img_shape = PANEL_SHAPE
+    if pool_in_loader and downsample >= 2:
+        img_shape = (PANEL_SHAPE[0], PANEL_SHAPE[1] // downsample, PANEL_SHAPE[2] // downsample)
+    return [img_shape, label_shape(downsample, n_classes, use_indexed_peaks), (1,)]
+
+
+def preprocess_imgs(imgs, normalize=True):
+    # in place on a (B, panels, rows, cols) batch: clip negative pixels, then scale each panel by its max
+    imgs[imgs < 0] = 0
+    if normalize:
+        imgs /= imgs.max(axis=(2, 3), keepdims=True)
+    return imgs
+
+
+def block_shuffle(keys, block_size, rng):
+    """
+    A permutation of range(len(keys)) that is sequential in keys (event indices) within blocks of
+    block_size, with the blocks in random order. Block boundaries start at a random offset, so that
+    blocks differ from one epoch to the next. block_size <= 1 is a full random permutation.
+    """
+    if block_size <= 1:
+        return rng.permutation(len(keys))
+    return np.concatenate(shuffled_blocks(keys, block_size, rng))
+
+
+def shuffled_blocks(keys, block_size, rng):
+    # the blocks of block_shuffle (positions in keys), in their random order
+    order = np.argsort(np.asarray(keys), kind="stable")
+    cuts = np.arange(rng.randint(block_size), len(order), block_size)
+    blocks = np.split(order, cuts[cuts > 0])
+    return [blocks[k] for k in rng.permutation(len(blocks))]
+
+
+class BlockShuffleSampler(Sampler):
+    """
+    Shuffles a dataset by blocks of events that are contiguous on disk (see block_shuffle), so that
+    psana idx-mode and exported frame reads stay sequential within a block.
+    """
+
+    def __init__(self, keys, block_size=64, seed=0):
+        self.keys = np.asarray(keys)
+        self.block_size = block_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        return iter(block_shuffle(self.keys, self.block_size, rng).tolist())
+
+
+def index_sampler(dataset, shuffle=False, block_size=1):
+    if not shuffle:
+        return SequentialSampler(dataset)
+    if block_size > 1:
+        return BlockShuffleSampler(dataset.event_order(), block_size)
+    return RandomSampler(dataset)
+
+
+def batch_loader(dataset, batch_size, shuffle=False, drop_last=False, num_workers=0, block_size=1):
+    # each worker receives a list of indices and reads the whole batch with one load_imgs call
+    sampler = index_sampler(dataset, shuffle, block_size)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None,
+                      num_workers=num_workers)
+
+
+def rasterize_peaks(label, s, r, c, downsample, channel=0, with_offsets=True):
+    """
+    Write peaks (panel s, row r, col c) into a (n_panels, n_channels, h, w) float32 array, in place.
+    The confidence goes to label[:, channel] and, if with_offsets, the sub-pixel row/col offsets to
+    label[:, channel + 1] and label[:, channel + 2]. Matches the per-peak loop it replaces, including
+    "last peak wins" when several peaks fall into the same downsampled pixel.
+    """
+    if not label.flags.c_contiguous:
+        raise ValueError("rasterize_peaks writes through a flat view and needs a C-contiguous label array.")
+    n_panels, n_channels, h, w = label.shape
+    s = np.asarray(s).astype(np.int64)
+    # the loop version divided numpy scalars, which promotes to float64
+    r_ds = np.asarray(r, dtype=np.float64) / float(downsample)
+    c_ds = np.asarray(c, dtype=np.float64) / float(downsample)
+    u = np.floor(r_ds).astype(np.int64)
+    v = np.floor(c_ds).astype(np.int64)
+    keep = (s >= 0) & (s < n_panels) & (u >= 0) & (u < h) & (v >= 0) & (v < w)
+    if not keep.any():
+        return label
+    s, u, v, r_ds, c_ds = s[keep], u[keep], v[keep], r_ds[keep], c_ds[keep]
+    pixel = (u * w + v) + s * (n_channels * h * w)
+    # only the last peak falling into a pixel is written
+    _, last = np.unique(pixel[::-1], return_index=True)
+    last = len(pixel) - 1 - last
+    pixel = pixel[last]
+    flat = label.reshape(-1)
+    if with_offsets:
+        idx = np.concatenate((pixel + channel * h * w,
+                              pixel + (channel + 1) * h * w,
+                              pixel + (channel + 2) * h * w))
+        values = np.concatenate((np.ones(len(pixel)),
+                                 np.fmod(r_ds[last], 1.0),
+                                 np.fmod(c_ds[last], 1.0))).astype(np.float32)
+        flat[idx] = values
+    else:
+        flat[pixel + channel * h * w] = 1
+    return label
+
 
 class PSANADataset(Dataset):
 
     def __init__(self, df_path, subset="train", n=-1, shuffle=False):
-        self.df = pd.read_csv(df_path).query("subset == '{}'".format(subset))
+        self.df_path = df_path
+        self.subset = subset
+        self.df = self.read_runs()
         if n > 0:
             n = min(n, len(self.df))
             self.df = self.df.sample(n=n)
@@ -25,59 +182,148 @@ class PSANADataset(Dataset):
         file_path, exp, run = self.df.iloc[idx][["path", "exp", "run"]]
         return file_path, exp, run
 
+    def read_runs(self):
+        return pd.read_csv(self.df_path).query("subset == '{}'".format(self.subset))
+
+    def select(self, run_index):
+        # the given runs (index of the csv rows) in that order, e.g. a checkpoint's: taken from the whole
+        # table, as n > 0 sampled another subset of it
+        self.df = self.read_runs().loc[list(run_index)]
+        self.n = len(self.df)
+
+    def event_counts(self, n_per_run=-1, min_det_peaks=-1, min_indexed_peaks=-1, use_indexed_peaks=False):
+        # events of each run that PSANAImage would sample, read from the cxi labels only
+        counts = []
+        for i in range(self.n):
+            cxi_path = self.df.iloc[i]["path"]
+            cxi, key = open_cxi_label(cxi_path, use_indexed_peaks)
+            n = len(cxi.eligible_rows(min_det_peaks, min_indexed_peaks))
+            get_run_pool().release(key)
+            counts.append(n if n_per_run == -1 else min(n, n_per_run))
+        return counts
+
+    def shard(self, runs):
+        # keeps the given runs (indices into the current order), e.g. one rank's share (see distributed)
+        self.df = self.df.iloc[list(runs)]
+        self.n = len(self.df)
+
 
 class PSANAImage(Dataset):
 
     def __init__(self, cxi_path, exp, run, normalize=True, downsample=1, debug=True,
                  max_cutoff=1024, mode="peaknet2020", shuffle=False, n=-1, min_det_peaks=-1, use_indexed_peaks=False,
-                 n_classes=3):
+                 n_classes=3, label_cache_dir=None, image_cache=None, source="psana", frame_dir=None,
+                 min_indexed_peaks=-1, mask_cache_dir=None, pool_in_loader=False,
+                 sparse_labels=False):
         self.use_indexed_peaks = use_indexed_peaks
         self.n_classes = n_classes
         self.downsample = downsample
-        self.cxi = CXILabel(cxi_path, use_indexed_peaks)
+        self.cxi, self.cxi_key = open_cxi_label(cxi_path, use_indexed_peaks)
         self.detector = self.cxi.detector  # "CxiDs2.0:Cspad.0"#
+        # only events with enough peaks are sampled
+        eligible = self.cxi.eligible_rows(min_det_peaks, min_indexed_peaks)
+        self.ratio_used = len(eligible) / float(max(1, len(self.cxi)))
         if n == -1:
-            self.n = len(self.cxi)
+            self.n = len(eligible)
         else:
-            self.n = min(n, len(self.cxi))
+            self.n = min(n, len(eligible))
         self.normalize = normalize
+        # per-run stage times, printed by close()
+        self.timers = Timers()
         self.max_cutoff = max_cutoff
         self.debug = debug
-        self.psana = PSANAReader(exp, run, self.detector)
-        self.psana.build()
+        self.psana, self.psana_key = open_frame_source(exp, run, self.detector, source=source, frame_dir=frame_dir,
+                                                       image_cache=image_cache, mask_cache_dir=mask_cache_dir)
         self.mode = mode
         self.min_det_peaks = min_det_peaks
+        self.min_indexed_peaks = min_indexed_peaks
+        # max-pool in the worker, so that smaller tensors cross the process boundary (models skip their own pooling)
+        self.pool_in_loader = pool_in_loader and downsample >= 2
+        # peak lists instead of dense labels, rasterized by the loss on the training device (see sparse_labels)
+        self.sparse_labels = sparse_labels
         if shuffle:
-            self.rand_idxs = np.random.permutation(len(self.cxi))
-            self.rand_idxs = self.rand_idxs[:self.n]
+            self.rand_idxs = np.random.permutation(eligible)[:self.n]
         else:
-            self.rand_idxs = np.arange(self.n)
+            self.rand_idxs = eligible[:self.n]
+        self.label_cache = None
+        if label_cache_dir is not None and mode == "peaknet2020" and not sparse_labels:
+            self.label_cache = self.build_label_cache(label_cache_dir, cxi_path)
 
     def __len__(self):
         return self.n
 
+    def label_shape(self, n_panels=PANEL_SHAPE[0], h=PANEL_SHAPE[1], w=PANEL_SHAPE[2]):
+        return label_shape(self.downsample, self.n_classes, self.use_indexed_peaks, n_panels, h, w)
+
+    def build_label_cache(self, label_cache_dir, cxi_path):
+        label_cache = LabelCache(label_cache_dir, cxi_path, self.downsample, self.use_indexed_peaks, self.n_classes)
+        if not label_cache.is_valid():
+            print("Building label cache at " + label_cache.data_path + "...")
+            n_panels, _, h_ds, w_ds = self.label_shape()
+            label_cache.build(lambda row: self.render_label(self.cxi[row], n_panels, h_ds, w_ds),
+                              len(self.cxi), self.label_shape())
+        return label_cache
+
     def make_label(self, s, r, c, n_panels=32, h=24, w=49):
-        label = torch.zeros(n_panels, 3, h, w)
-        for i in range(n_panels):
-            my_r = r[s == i]
-            my_c = c[s == i]
-            for j in range(len(my_r)):
-                u = int(np.floor(my_r[j] / float(self.downsample)))
-                v = int(np.floor(my_c[j] / float(self.downsample)))
-                if u < h and v < w:
-                    label[i, 0, u, v] = 1
-                    label[i, 1, u, v] = np.fmod(my_r[j] / float(self.downsample), 1.0) #
-                    label[i, 2, u, v] = np.fmod(my_c[j] / float(self.downsample), 1.0)
-        return label
+        label = np.zeros((n_panels, 3, h, w), dtype=np.float32)
+        rasterize_peaks(label, s, r, c, self.downsample)
+        return torch.from_numpy(label)
 
     def make_label_with_idxg(self, s, r, c, s_idxg, r_idxg, c_idxg, n_panels=32, h=24, w=49):
-        label = torch.zeros(n_panels, 6, h, w)
-        label_peaks_only = self.make_label(s, r, c, n_panels=n_panels, h=h, w=w)
-        label_idxg_only = self.make_label(s_idxg, r_idxg, c_idxg, n_panels=n_panels, h=h, w=w)
-        label[:, :3, :, :] = label_peaks_only
-        label[:, 3:, :, :] = label_idxg_only
+        label = np.zeros((n_panels, 6, h, w), dtype=np.float32)
+        rasterize_peaks(label, s, r, c, self.downsample, channel=0)
+        rasterize_peaks(label, s_idxg, r_idxg, c_idxg, self.downsample, channel=3)
+        return torch.from_numpy(label)
+
+    def make_label_1channel(self, s, r, c, s_idxg=None, r_idxg=None, c_idxg=None, n_panels=32, h=24, w=49):
+        # same as slicing channels [0] (or [0, 3]) out of the 3- (or 6-) channel label
+        if s_idxg is None:
+            label = np.zeros((n_panels, 1, h, w), dtype=np.float32)
+        else:
+            label = np.zeros((n_panels, 2, h, w), dtype=np.float32)
+            rasterize_peaks(label, s_idxg, r_idxg, c_idxg, self.downsample, channel=1, with_offsets=False)
+        rasterize_peaks(label, s, r, c, self.downsample, channel=0, with_offsets=False)
+        return torch.from_numpy(label)
+
+    def render_label(self, item, n_panels, h, w):
+        # item is a CXILabel entry
+        if self.use_indexed_peaks:
+            _, s, r, c, s_idxg, r_idxg, c_idxg = item
+        else:
+            _, s, r, c = item
+        if self.n_classes == 1:
+            if self.use_indexed_peaks:
+                return self.make_label_1channel(s, r, c, s_idxg, r_idxg, c_idxg, n_panels=n_panels, h=h, w=w)
+            return self.make_label_1channel(s, r, c, n_panels=n_panels, h=h, w=w)
+        elif self.use_indexed_peaks:
+            return self.make_label_with_idxg(s, r, c, s_idxg, r_idxg, c_idxg, n_panels=n_panels, h=h, w=w)
+        return self.make_label(s, r, c, n_panels=n_panels, h=h, w=w)
+
+    def event_order(self):
+        # event index of each sample, for BlockShuffleSampler
+        return self.cxi.eventIdx[self.rand_idxs]
+
+    def fill_label(self, item, label):
+        # same as render_label, into a zeroed (n_panels, n_channels, h, w) float32 array
+        if self.use_indexed_peaks:
+            _, s, r, c, s_idxg, r_idxg, c_idxg = item
+        else:
+            _, s, r, c = item
+        with_offsets = self.n_classes != 1
+        rasterize_peaks(label, s, r, c, self.downsample, channel=0, with_offsets=with_offsets)
+        if self.use_indexed_peaks:
+            rasterize_peaks(label, s_idxg, r_idxg, c_idxg, self.downsample, channel=3 if with_offsets else 1,
+                            with_offsets=with_offsets)
         return label
 
+    def sparse_label(self, item, n_panels, h, w):
+        label_shape = (n_panels, self.label_shape()[1], h, w)
+        if self.use_indexed_peaks:
+            _, s, r, c, s_idxg, r_idxg, c_idxg = item
+            return SparseLabel(label_shape, self.downsample, s, r, c, s_idxg, r_idxg, c_idxg)
+        _, s, r, c = item
+        return SparseLabel(label_shape, self.downsample, s, r, c)
+
     def make_yolo_labels(self, s, r, c, h_obj=7, w_obj=7):
         n = r.shape[0]
         cls = np.zeros((n,))
@@ -86,23 +332,67 @@ class PSANAImage(Dataset):
         return [cls, s, r, c, hh, ww]
 
     def close(self):
-        self.cxi.close()
-        self.psana.ds = None
-
-    def __getitem__(self, idx):
-        if self.use_indexed_peaks:
-            event_idx, s, r, c, s_idxg, r_idxg, c_idxg = self.cxi[self.rand_idxs[idx]]
+        # the handles stay open in the run pool until evicted
+        get_run_pool().release(self.cxi_key)
+        get_run_pool().release(self.psana_key)
+        if self.label_cache is not None:
+            self.label_cache.close()
+        if self.psana.image_cache is not None:
+            print(self.psana.image_cache.report())
+        if self.timers.counts:
+            print(self.timers.report("exp {} run {}".format(self.psana.exp, self.psana.run)))
+
+    def get_batch(self, idxs):
+        rows = self.rand_idxs[np.asarray(idxs, dtype=np.int64)]
+        items = [self.cxi[row] for row in rows]
+        n_panels, n_channels, h_ds, w_ds = self.label_shape()
+        imgs = np.empty((len(rows),) + PANEL_SHAPE, dtype=np.float32)
+        with self.timers.time("psana read"):
+            self.psana.load_imgs([item[0] for item in items], out=imgs)
+        preprocess_imgs(imgs, self.normalize)
+        with self.timers.time("label build"):
+            if self.sparse_labels:
+                labels = SparseLabels.collate([self.sparse_label(item, n_panels, h_ds, w_ds) for item in items])
+            elif self.label_cache is not None:
+                labels = torch.stack([self.label_cache[row] for row in rows])
+            else:
+                labels = torch.stack([self.render_label(item, n_panels, h_ds, w_ds) for item in items])
+        n_trials = torch.full((len(rows), 1), 1. / max(1e-12, self.ratio_used))
+        img_tensor = torch.from_numpy(imgs)
+        if self.pool_in_loader:
+            img_tensor = nn.functional.max_pool2d(img_tensor, self.downsample)
+        return img_tensor, labels, n_trials
+
+    def fill_sample(self, idx, img_out, label_out, n_trials_out):
+        # sample idx written into preallocated tensors (slots of a batch_ring.BatchRing), same values as __getitem__
+        row = self.rand_idxs[idx]
+        item = self.cxi[row]
+        with self.timers.time("psana read"):
+            img = self.psana.load_img(item[0])
+        img = preprocess_imgs(img[None], self.normalize)[0]
+        if self.pool_in_loader:
+            img_out.copy_(nn.functional.max_pool2d(torch.from_numpy(img), self.downsample))
         else:
-            event_idx, s, r, c = self.cxi[self.rand_idxs[idx]]
-        n_trials = 1
-        while len(s) < self.min_det_peaks:
-            idx = (idx + 1) % self.n
-            n_trials += 1
-            if self.use_indexed_peaks:
-                event_idx, s, r, c, s_idxg, r_idxg, c_idxg = self.cxi[self.rand_idxs[idx]]
+            img_out.numpy()[...] = img
+        with self.timers.time("label build"):
+            if self.label_cache is not None:
+                label_out.copy_(self.label_cache[row])
             else:
-                event_idx, s, r, c = self.cxi[self.rand_idxs[idx]]
-        img = self.psana.load_img(event_idx)
+                label_out.zero_()
+                self.fill_label(item, label_out.numpy())
+        n_trials_out.fill_(1. / max(1e-12, self.ratio_used))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray)):
+            # from batch_loader
+            return self.get_batch(idx)
+        row = self.rand_idxs[idx]
+        item = self.cxi[row]
+        event_idx, s = item[0], item[1]
+        # CXI rows read per sample used, as the former retry loop counted them: seen / sum(n_trials) = ratio used
+        n_trials = 1. / max(1e-12, self.ratio_used)
+        with self.timers.time("psana read"):
+            img = self.psana.load_img(event_idx)
         img[img < 0] = 0
         if self.normalize:
             # img = img / max(0.01, np.std(img)) # why max 0.01?
@@ -121,22 +411,153 @@ class PSANAImage(Dataset):
             # img_tensor = torch.zeros(img.shape[0], h_pad, w_pad)
             img_tensor = torch.zeros(img.shape[0], h, w)
             img_tensor[:, 0:img.shape[1], 0:img.shape[2]] = torch.from_numpy(img)
-            if self.use_indexed_peaks:
-                label_tensor = self.make_label_with_idxg(s, r, c, s_idxg, r_idxg, c_idxg, n_panels=img.shape[0], h=h_ds, w=w_ds)
-            else:
-                label_tensor = self.make_label(s, r, c, n_panels=img.shape[0], h=h_ds, w=w_ds)
+            if self.pool_in_loader:
+                img_tensor = nn.functional.max_pool2d(img_tensor, self.downsample)
+            with self.timers.time("label build"):
+                if self.sparse_labels:
+                    label_tensor = self.sparse_label(item, img.shape[0], h_ds, w_ds)
+                elif self.label_cache is not None:
+                    label_tensor = self.label_cache[row]
+                else:
+                    label_tensor = self.render_label(item, img.shape[0], h_ds, w_ds)
             n_trials_tensor = torch.zeros(1)
             n_trials_tensor[0] = n_trials
-            if self.n_classes == 1:
-                if self.use_indexed_peaks:
-                    label_tensor = label_tensor[:, [0, 3], :, :]
-                else:
-                    label_tensor = label_tensor[:, 0:1, :, :]
             return img_tensor, label_tensor, n_trials_tensor
         else:  # YOLO mode
-            labels = self.make_yolo_labels(s, r, c)
+            labels = self.make_yolo_labels(s, item[2], item[3])
             return img, labels
 
+class PSANAStream(IterableDataset):
+    """
+    Samples of all the runs of a PSANADataset as one stream, for a single DataLoader per epoch.
+    Runs are sharded across DataLoader workers (events too, when there are fewer runs than workers).
+    Each worker keeps n_open_runs PSANAImage open and interleaves their events through a bounded
+    shuffle buffer of (run, index) pairs; images are only loaded when a sample leaves the buffer.
+    With block_size > 1 the events of a run are block shuffled (see block_shuffle) instead of fully
+    permuted: runs are interleaved block by block, each block read in order, and the buffer is first in,
+    first out, so that the reads stay sequential.
+    """
+
+    def __init__(self, run_dataset, image_kwargs, n_open_runs=4, shuffle_buffer=256, shuffle=True, seed=0,
+                 block_size=1):
+        self.run_dataset = run_dataset
+        self.image_kwargs = image_kwargs
+        self.n_open_runs = n_open_runs
+        self.shuffle_buffer = shuffle_buffer
+        self.block_size = block_size
+        self.resume = None
+        self.shuffle = shuffle
+        self.seed = seed
+        # shared with persistent DataLoader workers, which keep their run pool across epochs
+        self.epoch = torch.multiprocessing.Value("i", 0)
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def set_resume(self, epoch, n_batches, batch_size, num_workers):
+        # the first n_batches of epoch were already trained on. The DataLoader takes batches from its workers
+        # in turn, so worker w produced batches w, w + num_workers, ... (exact unless a worker ran out of runs
+        # before the others). Set before the workers start; persistent workers only apply it to that epoch.
+        n_workers = max(1, num_workers)
+        self.resume = (epoch, [max(0, (n_batches - w + n_workers - 1) // n_workers) * batch_size
+                               for w in range(n_workers)])
+
+    def iter_items(self):
+        # iter_all_items, minus the samples already trained on before a resume; skipped samples are not loaded
+        n_skip = 0
+        if self.resume is not None and self.resume[0] == self.epoch.value:
+            worker_info = get_worker_info()
+            n_skip = self.resume[1][0 if worker_info is None else worker_info.id]
+        for k, (dataset, idx) in enumerate(self.iter_all_items()):
+            if k >= n_skip:
+                yield dataset, idx
+
+    def shards(self, worker_id, num_workers):
+        # (run index, first event, event stride)
+        n_runs = len(self.run_dataset)
+        if n_runs >= num_workers:
+            return [(i, 0, 1) for i in range(worker_id, n_runs, num_workers)]
+        return [(i, worker_id, num_workers) for i in range(n_runs)]
+
+    def open_run(self, i):
+        cxi_path, exp, run = self.run_dataset[i]
+        if not frames_exist(exp, run, self.image_kwargs.get("source", "psana"), self.image_kwargs.get("frame_dir")):
+            print("[{:}] exp: {}  run: {}  PRECHECK FAILED".format(i, exp, run))
+            return None
+        print("*********************************************************************")
+        print("[{:}] exp: {}  run: {}\ncxi: {}".format(i, exp, run, cxi_path))
+        print("*********************************************************************")
+        return PSANAImage(cxi_path, exp, run, **self.image_kwargs)
+
+    def iter_all_items(self):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        rng = np.random.RandomState([self.seed, self.epoch.value, worker_id])
+        pending = self.shards(worker_id, num_workers)
+        if self.shuffle:
+            pending = [pending[k] for k in rng.permutation(len(pending))]
+        # a random pop from the buffer would undo the order within blocks
+        random_pop = self.shuffle and self.block_size <= 1
+        opened = []  # [dataset, iterator over chunks of its indices, exhausted]
+        in_buffer = {}  # id(dataset) -> number of its samples in the buffer
+        buffer = []
+        next_run = 0
+
+        def release(entry):
+            if entry[2] and in_buffer.get(id(entry[0]), 0) == 0:
+                entry[0].close()
+                opened.remove(entry)
+
+        while pending or opened:
+            while len([entry for entry in opened if not entry[2]]) < self.n_open_runs and pending:
+                i, first, stride = pending.pop(0)
+                dataset = self.open_run(i)
+                if dataset is None:
+                    continue
+                idxs = np.arange(first, len(dataset), stride)
+                if self.shuffle and self.block_size > 1:
+                    chunks = [idxs[block] for block in shuffled_blocks(dataset.event_order()[idxs], self.block_size,
+                                                                       rng)]
+                elif self.shuffle:
+                    chunks = idxs[block_shuffle(dataset.event_order()[idxs], self.block_size, rng)][:, None]
+                else:
+                    chunks = idxs[:, None]
+                opened.append([dataset, iter(chunks), False])
+            active = [entry for entry in opened if not entry[2]]
+            if not active:
+                break
+            if self.shuffle:
+                entry = active[rng.randint(len(active))]
+            else:
+                entry = active[next_run % len(active)]
+                next_run += 1
+            # one event, or a whole block of events with block_size > 1
+            chunk = next(entry[1], None)
+            if chunk is None:
+                entry[2] = True
+                release(entry)
+                continue
+            for idx in chunk:
+                buffer.append((entry, idx))
+            in_buffer[id(entry[0])] = in_buffer.get(id(entry[0]), 0) + len(chunk)
+            while len(buffer) >= max(1, self.shuffle_buffer):
+                item = buffer.pop(rng.randint(len(buffer)) if random_pop else 0)
+                in_buffer[id(item[0][0])] -= 1
+                yield item[0][0], item[1]
+                release(item[0])
+        if random_pop:
+            buffer = [buffer[k] for k in rng.permutation(len(buffer))]
+        for entry, idx in buffer:
+            in_buffer[id(entry[0])] -= 1
+            yield entry[0], idx
+            release(entry)
+
+    def __iter__(self):
+        for dataset, idx in self.iter_items():
+            yield dataset[idx]
+
+
 class PSANADatasetNoLabel(Dataset):
 
     def __init__(self, df_path, n=-1, shuffle=False):
@@ -157,20 +578,45 @@ class PSANADatasetNoLabel(Dataset):
 
 class PSANAImageNoLabel(Dataset):
 
-    def __init__(self, exp, run):
-        self.psana = PSANAReader(exp, run, self.detector)
-        self.psana.build()
+    def __init__(self, exp, run, det_name="DsdCsPad", normalize=True, image_cache=None, source="psana", frame_dir=None,
+                 mask_cache_dir=None):
+        self.psana, self.psana_key = open_frame_source(exp, run, det_name, source=source, frame_dir=frame_dir,
+                                                       image_cache=image_cache, mask_cache_dir=mask_cache_dir)
         self.detector = self.psana.det_name
+        self.normalize = normalize
         self.n = len(self.psana.times)
+        self.timers = Timers()
 
     def __len__(self):
         return self.n
 
     def close(self):
-        self.psana.ds = None
+        get_run_pool().release(self.psana_key)
+        # reads done in this process only (not in DataLoader workers)
+        if self.timers.counts:
+            print(self.timers.report("exp {} run {}".format(self.psana.exp, self.psana.run)))
+
+    def get_batch(self, idxs):
+        imgs = np.empty((len(idxs),) + PANEL_SHAPE, dtype=np.float32)
+        with self.timers.time("psana read"):
+            self.psana.load_imgs(idxs, out=imgs)
+        return torch.from_numpy(preprocess_imgs(imgs, self.normalize))
+
+    def event_order(self):
+        return np.arange(self.n)
+
+    def fill_sample(self, idx, img_out):
+        # see PSANAImage.fill_sample
+        with self.timers.time("psana read"):
+            img = self.psana.load_img(idx)
+        img_out.numpy()[...] = preprocess_imgs(img[None], self.normalize)[0]
 
     def __getitem__(self, idx):
-        img = self.psana.load_img(idx)
+        if isinstance(idx, (list, np.ndarray)):
+            # from batch_loader
+            return self.get_batch(idx)
+        with self.timers.time("psana read"):
+            img = self.psana.load_img(idx)
         img[img < 0] = 0
         if self.normalize:
             for i in range(img.shape[0]):
@@ -183,94 +629,83 @@ class PSANAImageNoLabel(Dataset):
 
         return img_tensor
 
-class PSANAReader(object):
-
-    def __init__(self, exp, run, det_name="DsdCsPad"):
-        self.exp = exp
-        self.run = run
-        self.det_name = det_name
-        self.ds = None
-        self.det = None
-        self.this_run = None
-        self.times = None
-
-    def build(self):
-        self.ds = psana.DataSource("exp={}:run={}:idx".format(self.exp, self.run))
-        self.det = psana.Detector(self.det_name)
-        ## self.this_run = self.ds.runs().next()
-        self.this_run = next(self.ds.runs())
-        self.times = self.this_run.times()
-
-    def load_img(self, event_idx):
-        evt = self.this_run.event(self.times[event_idx])
-        calib = self.det.calib(evt) * self.det.mask(evt, calib=True, status=True, edges=True,
-                                                    central=True, unbond=True, unbondnbrs=True)
-        return calib
+def to_ragged(dset, counts, chunk_rows=1024):
+    # first counts[i] entries of row i of a (n_rows, max_n) dataset, concatenated in row order
+    out = np.empty(int(counts.sum()), dtype=dset.dtype)
+    pos = 0
+    for beg in range(0, len(counts), chunk_rows):
+        end = min(beg + chunk_rows, len(counts))
+        my_counts = counts[beg:end]
+        width = int(my_counts.max()) if len(my_counts) > 0 else 0
+        if width == 0:
+            continue
+        block = dset[beg:end, :width]
+        values = block[np.arange(width)[None, :] < my_counts[:, None]]
+        out[pos:pos + len(values)] = values
+        pos += len(values)
+    return out
 
 
 class CXILabel(Dataset):
+    """
+    Peaks of a CXI file as a ragged table: row i owns entries offsets[i]:offsets[i+1] of flat
+    panel / row / column columns, computed once when the file is opened.
+    """
 
     def __init__(self, cxi_path, use_indexed_peaks, fmod=True):
-        self.f = h5py.File(cxi_path, "r")
-        # Test constistency
-        # self.f_test = h5py.File('/cds/data/psdm/cxi/cxic0415/scratch/axlevy/psocake/r0100/cxic0415_0100_psocake2.cxi', "r")
-        # self.nPeaks_test = self.f_test["entry_1/result_1/nPeaks"]
-        # self.n_hits_test = len(self.nPeaks_test)
-        # self.eventIdx_test = self.f_test["LCLS/eventNumber"][:self.n_hits_test]
-        # print('eventIdx_test')
-        # print(self.eventIdx_test)
-
-        self.nPeaks = self.f["entry_1/result_1/nPeaks"]
-        self.n_hits = len(self.nPeaks)
-        self.eventIdx = self.f["LCLS/eventNumber"][:self.n_hits]
-        self.peak_x_label = self.f['entry_1/result_1/peakXPosRaw'][:self.n_hits, :]
-        self.peak_y_label = self.f['entry_1/result_1/peakYPosRaw'][:self.n_hits, :]
-        self.peak_x_center = self.f['entry_1/result_1/peak2'][:self.n_hits, :]
-        self.peak_y_center = self.f['entry_1/result_1/peak1'][:self.n_hits, :]
-        self.detector = str(self.f["entry_1/instrument_1/detector_1/description"][()])
-        # print('eventIdx')
-        # print(self.eventIdx)
+        f = h5py.File(cxi_path, "r")
+        nPeaks = f["entry_1/result_1/nPeaks"]
+        self.n_hits = len(nPeaks)
+        self.eventIdx = f["LCLS/eventNumber"][:self.n_hits]
+        self.detector = str(f["entry_1/instrument_1/detector_1/description"][()])
+
+        peak_datasets = [f['entry_1/result_1/' + key] for key in ['peakXPosRaw', 'peakYPosRaw', 'peak2', 'peak1']]
+        width = min(dset.shape[1] for dset in peak_datasets)
+        self.n_peaks = np.minimum(nPeaks[:self.n_hits], width).astype(np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.n_peaks)))
+        peak_x_label, peak_y_label, peak_x_center, peak_y_center = [to_ragged(dset, self.n_peaks)
+                                                                    for dset in peak_datasets]
+        # psana style
+        self.peak_s = (np.floor_divide(peak_y_label, 185) + 8 * np.floor_divide(peak_x_label, 388)).astype(np.int16)
+        self.peak_r = np.fmod(peak_y_center, 185.0).astype(np.float32)
+        self.peak_c = np.fmod(peak_x_center, 388.0).astype(np.float32)
 
         self.use_indexed_peaks = use_indexed_peaks
         if use_indexed_peaks:
-            self.nIndexedPeaks = self.f["indexing/nIndexedPeaks"]
-            self.indexing_x_center = self.f["indexing/XPos"][:self.n_hits, :]
-            self.indexing_y_center = self.f["indexing/YPos"][:self.n_hits, :]
-            self.indexing_panel = self.f["indexing/panel"][:self.n_hits, :]
+            indexing_datasets = [f["indexing/" + key] for key in ["XPos", "YPos", "panel"]]
+            width = min(dset.shape[1] for dset in indexing_datasets)
+            self.n_indexed_peaks = np.minimum(f["indexing/nIndexedPeaks"][:self.n_hits], width).astype(np.int64)
+            self.indexing_offsets = np.concatenate(([0], np.cumsum(self.n_indexed_peaks)))
+            indexing_x_center, indexing_y_center, indexing_panel = [to_ragged(dset, self.n_indexed_peaks)
+                                                                    for dset in indexing_datasets]
+            self.indexing_s = indexing_panel.astype(np.int32)
+            self.indexing_r = np.fmod(indexing_y_center, 185.0).astype(np.float32)
+            self.indexing_c = np.fmod(indexing_x_center, 388.0).astype(np.float32)
+        # everything is in memory now
+        f.close()
 
     def __len__(self):
         return self.n_hits
 
+    def eligible_rows(self, min_det_peaks=-1, min_indexed_peaks=-1):
+        eligible = self.n_peaks >= min_det_peaks
+        if self.use_indexed_peaks and min_indexed_peaks > 0:
+            eligible &= self.n_indexed_peaks >= min_indexed_peaks
+        return np.flatnonzero(eligible)
+
     def __getitem__(self, idx):
-        my_npeaks = self.nPeaks[idx]
+        # zero-copy slices of the flat columns
+        beg, end = self.offsets[idx], self.offsets[idx + 1]
         my_event_idx = self.eventIdx[idx]
-        # Test consistency
-        # print(idx)
-        # print(my_event_idx)
-        # print(my_npeaks)
-        # print("")
-        # print(np.argwhere(self.eventIdx_test == my_event_idx))
-        # idx_test = np.argwhere(self.eventIdx_test == my_event_idx)[0,0]
-        # my_npeaks_test = self.nPeaks_test[idx_test]
-        # my_event_idx_test = self.eventIdx_test[idx_test]
-        # print(idx_test)
-        # print(my_event_idx_test)
-        # print(my_npeaks_test)
-        # time.sleep(5)
-
-        # psana style
-        my_s = np.floor_divide(self.peak_y_label[idx, 0:my_npeaks], 185) \
-            + 8 * np.floor_divide(self.peak_x_label[idx, 0:my_npeaks], 388)
-        my_r = np.fmod(self.peak_y_center[idx, 0:my_npeaks], 185.0)
-        my_c = np.fmod(self.peak_x_center[idx, 0:my_npeaks], 388.0)
+        my_s = self.peak_s[beg:end]
+        my_r = self.peak_r[beg:end]
+        my_c = self.peak_c[beg:end]
         if self.use_indexed_peaks:
-            my_nIndexedPeaks = self.nIndexedPeaks[idx]
-            my_s_indexing = self.indexing_panel[idx, 0:my_nIndexedPeaks].astype(np.int32)
-            my_r_indexing = np.fmod(self.indexing_y_center[idx, 0:my_nIndexedPeaks], 185.0)
-            my_c_indexing = np.fmod(self.indexing_x_center[idx, 0:my_nIndexedPeaks], 388.0)
-            return my_event_idx, my_s, my_r, my_c, my_s_indexing, my_r_indexing, my_c_indexing
+            beg, end = self.indexing_offsets[idx], self.indexing_offsets[idx + 1]
+            return my_event_idx, my_s, my_r, my_c, \
+                self.indexing_s[beg:end], self.indexing_r[beg:end], self.indexing_c[beg:end]
         else:
             return my_event_idx, my_s, my_r, my_c
 
     def close(self):
-        self.f.close()
+        pass
@@ -0,0 +1,102 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return get_rank() == 0
+
+
+def launched_with_env():
+    # torchrun (or launch_local) sets the rank and the world size of each process
+    return "RANK" in os.environ and "WORLD_SIZE" in os.environ
+
+
+def init_distributed(backend="gloo"):
+    # rendezvous at MASTER_ADDR:MASTER_PORT, as set by torchrun or launch_local
+    dist.init_process_group(backend=backend, init_method="env://")
+    return get_rank(), get_world_size()
+
+
+def local_rank():
+    return int(os.environ.get("LOCAL_RANK", get_rank()))
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def launch_local(fn, nprocs, args=(), master_port=29500):
+    """
+    Runs fn(*args) in nprocs processes of this node, each with its rank in the environment (as torchrun
+    would); fn calls init_distributed. Several nodes are launched with torchrun instead.
+    """
+    os.environ["MASTER_ADDR"] = os.environ.get("MASTER_ADDR", "127.0.0.1")
+    os.environ["MASTER_PORT"] = str(master_port)
+    os.environ["WORLD_SIZE"] = str(nprocs)
+    mp.spawn(local_worker, args=(fn, nprocs, args), nprocs=nprocs, join=True)
+
+
+def local_worker(rank, fn, nprocs, args):
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(rank)
+    # the cores of the node are split between its ranks
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // nprocs))
+    fn(*args)
+
+
+def all_true(flag):
+    # True on every rank iff flag is True on every rank
+    if not is_distributed():
+        return flag
+    t = torch.tensor([1 if flag else 0], dtype=torch.int32)
+    dist.all_reduce(t, op=dist.ReduceOp.MIN)
+    return bool(t.item())
+
+
+def broadcast_object(obj):
+    # rank 0's obj, on every rank
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=0)
+    return objs[0]
+
+
+def gather_object(obj):
+    # [obj of rank 0, obj of rank 1, ...], on every rank
+    if not is_distributed():
+        return [obj]
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def balanced_shards(counts, world_size):
+    # runs (indices into counts) of each rank: largest runs first, each to the rank with the fewest events so far
+    shards = [[] for _ in range(world_size)]
+    loads = [0] * world_size
+    for i in sorted(range(len(counts)), key=lambda i: -counts[i]):
+        r = loads.index(min(loads))
+        shards[r].append(i)
+        loads[r] += counts[i]
+    return [sorted(shard) for shard in shards], loads
@@ -5,11 +5,18 @@ import torch
 import torch.optim as optim
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from data import PSANADataset, PSANAImage
+from data import PSANADataset, PSANAStream, sample_shapes
+from batch_ring import BatchRing, RingStream, default_n_slots, ring_loader
 from unet import UNet
 from saver import Saver
+from run_pool import get_run_pool
+from image_cache import ImageCache
+from instrument import Timers, ProfilerWindow
+from compiled import CompiledModel
+from fusion import fuse_for_inference
 import shutil
 import argparse
+import time
 
 def evaluation_metrics(scores, y, cutoff=0.5):
     scores_c = scores[:, 0, :, :].reshape(-1)
@@ -28,51 +35,80 @@ def evaluation_metrics(scores, y, cutoff=0.5):
     metrics = {"recall": recall, "precision": precision}
     return metrics
 
-def check_existence(exp, run):
-    files = glob("/reg/d/psdm/cxi/{}/xtc/*{}*.xtc".format(exp, run))
-    return len(files) > 0
-
 def evaluate(model, device, params):
     model.eval()
 
     saver = Saver(params["saver_type"], params)
+    get_run_pool(max_open=params["max_open_runs"])
+
+    image_cache = None
+    if params["image_cache_dir"] is not None:
+        image_cache = ImageCache(params["image_cache_dir"], max_gb=params["image_cache_gb"],
+                                 dtype=params["image_cache_dtype"])
 
     eval_dataset = PSANADataset(params["run_dataset_path"], subset="val", shuffle=True, n=params["n_experiments"])
+    image_kwargs = {"downsample": model.downsample, "n": params["n_per_run"],
+                    "label_cache_dir": params["label_cache_dir"], "image_cache": image_cache,
+                    "source": params["frame_source"], "frame_dir": params["frame_dir"],
+                    "mask_cache_dir": params["mask_cache_dir"], "pool_in_loader": params["pool_in_loader"]}
+    eval_stream = PSANAStream(eval_dataset, image_kwargs, n_open_runs=params["n_open_runs"],
+                              shuffle_buffer=params["shuffle_buffer"], shuffle=True,
+                              block_size=params["block_size"])
     seen = 0
 
     total_steps = 0
+    runner = CompiledModel(model, params["compile"])
+    img_shape = sample_shapes(model.downsample, 3, False, params["pool_in_loader"])[0]
+    warm_up_time = runner.warm_up(torch.zeros((params["batch_size"],) + tuple(img_shape), device=device))
+    if runner.mode != "eager":
+        print("Compiled (" + runner.mode + ") in " + str(warm_up_time) + " s.")
+    timers = Timers(synchronize=params["sync_timers"])
+    profiler = ProfilerWindow(params["profile_start"], params["profile_stop"], params["trace_path"])
+    ring = None
+    if params["batch_ring"]:
+        n_slots = params["ring_slots"] if params["ring_slots"] > 0 else default_n_slots(params["num_workers"])
+        ring = BatchRing(n_slots, params["batch_size"],
+                         sample_shapes(model.downsample, 3, False, params["pool_in_loader"]))
     with torch.no_grad():
-        for i, (cxi_path, exp, run) in enumerate(eval_dataset):
-            if check_existence(exp, run):
-                pass
-            else:
-                print("[{:}] exp: {}  run: {}  PRECHECK FAILED".format(i, exp, run))
-                continue
-            print("*********************************************************************")
-            print("[{:}] exp: {}  run: {}\ncxi: {}".format(i, exp, run, cxi_path))
-            print("*********************************************************************")
-            psana_images = PSANAImage(cxi_path, exp, run, downsample=model.downsample, n=params["n_per_run"])
-            data_loader = DataLoader(psana_images, batch_size=params["batch_size"], shuffle=True, drop_last=True,
+        if ring is not None:
+            data_loader = ring_loader(RingStream(eval_stream, ring, drop_last=True), num_workers=params["num_workers"])
+        else:
+            data_loader = DataLoader(eval_stream, batch_size=params["batch_size"], drop_last=True,
                                      num_workers=params["num_workers"])
-            for j, (x, y) in enumerate(data_loader):
-                n = x.size(0)
-                y = y.view(-1, y.size(2), y.size(3), y.size(4))
+        tic = time.time()
+        for j, batch in enumerate(data_loader):
+            timers.add("data wait", time.time() - tic)
+            profiler.step(total_steps)
+            if ring is not None:
+                slot, n_batch = batch
+                x, y, _ = ring.batch(slot, n_batch)
+            else:
+                x, y, _ = batch
+            n = x.size(0)
+            y = y.view(-1, y.size(2), y.size(3), y.size(4))
+            with timers.time("h2d copy"):
                 x = x.to(device)
                 y = y.to(device)
-                scores = model(x)
+            with timers.time("forward"):
+                scores = runner(x)
+            with timers.time("metrics"):
                 metrics = evaluation_metrics(scores, y, cutoff=params["cutoff_eval"])
-
-                total_steps += 1
-                seen += n
-
-                if seen % params["print_every"] == 0:
-                    print_str = "seen " + str(seen) + " ; "
-                    for (key, value) in metrics.items():
-                        print_str += key + " " + str(value) + " ; "
-                    print(print_str)
-                if seen % params["upload_every"] == 0:
-                    saver.upload(metrics, params["save_name"])
-            psana_images.close()
+            if ring is not None:
+                ring.release(slot)
+
+            total_steps += 1
+            seen += n
+
+            if seen % params["print_every"] == 0:
+                print_str = "seen " + str(seen) + " ; "
+                for (key, value) in metrics.items():
+                    print_str += key + " " + str(value) + " ; "
+                print(print_str)
+            if seen % params["upload_every"] == 0:
+                saver.upload(metrics, params["save_name"])
+            tic = time.time()
+        profiler.close()
+        print(timers.report("Evaluation stages"))
         saver.save(params["save_name"])
 
 def parse_args():
@@ -95,6 +131,27 @@ def parse_args():
     p.add_argument("--n_per_run", type=int, default=-1)
     p.add_argument("--batch_size", type=int, default=5)
     p.add_argument("--num_workers", type=int, default=0)
+    p.add_argument("--n_open_runs", type=int, default=4, help="Runs read concurrently by each data worker")
+    p.add_argument("--shuffle_buffer", type=int, default=256, help="Samples shuffled across the open runs")
+    p.add_argument("--block_size", type=int, default=1, help="Shuffle events by contiguous blocks (1: fully random)")
+    p.add_argument("--max_open_runs", type=int, default=16, help="Run handles kept open per process")
+    p.add_argument("--frame_source", type=str, default="psana", help="psana, or h5 for exported frames")
+    p.add_argument("--mask_cache_dir", type=str, default=None, help="Directory for the per-run pixel masks")
+    p.add_argument("--pool_in_loader", type=str, default="False", help="Downsample images in the data workers")
+    p.add_argument("--batch_ring", type=str, default="False", help="Workers fill shared-memory batch slots")
+    p.add_argument("--ring_slots", type=int, default=-1, help="Slots of the batch ring (-1: from num_workers)")
+    p.add_argument("--frame_dir", type=str, default=None, help="Directory of exported frames (h5 frame source)")
+    p.add_argument("--label_cache_dir", type=str, default=None, help="Directory for pre-rendered label sidecars")
+    p.add_argument("--image_cache_dir", type=str, default=None, help="Directory for the calibrated image cache")
+    p.add_argument("--image_cache_gb", type=float, default=50., help="Size cap of the image cache")
+    p.add_argument("--image_cache_dtype", type=str, default="float32", help="float32, float16 or uint16")
+    p.add_argument("--compile", type=str, default="eager", help="eager, compile (torch.compile) or trace (TorchScript)")
+    p.add_argument("--fuse", type=str, default="False", help="Fold BatchNorm and pads into the convolutions")
+    p.add_argument("--sync_timers", type=str, default="False", help="Synchronize CUDA around each timed stage")
+    p.add_argument("--profile_start", type=int, default=-1, help="First step of the profiler trace (-1: no trace)")
+    p.add_argument("--profile_stop", type=int, default=-1,
+                   help="Step at which the profiler trace is written (-1: 10 steps)")
+    p.add_argument("--trace_path", type=str, default="eval_trace.json", help="Chrome trace written by the profiler")
 
     return p.parse_args()
 
@@ -112,6 +169,8 @@ def main():
         device = torch.device("cpu")
 
     model = model.to(device)
+    if args.fuse == "True":
+        model = fuse_for_inference(model)
 
     params = {}
     params["run_dataset_path"] = args.run_dataset_path
@@ -124,6 +183,34 @@ def main():
     params["n_per_run"] = args.n_per_run
     params["batch_size"] = args.batch_size
     params["num_workers"] = args.num_workers
+    params["n_open_runs"] = args.n_open_runs
+    params["shuffle_buffer"] = args.shuffle_buffer
+    params["block_size"] = args.block_size
+    params["max_open_runs"] = args.max_open_runs
+    params["frame_source"] = args.frame_source
+    params["frame_dir"] = args.frame_dir
+    params["mask_cache_dir"] = args.mask_cache_dir
+    if args.pool_in_loader == "True":
+        params["pool_in_loader"] = True
+    else:
+        params["pool_in_loader"] = False
+    if args.batch_ring == "True":
+        params["batch_ring"] = True
+    else:
+        params["batch_ring"] = False
+    params["ring_slots"] = args.ring_slots
+    params["label_cache_dir"] = args.label_cache_dir
+    params["image_cache_dir"] = args.image_cache_dir
+    params["image_cache_gb"] = args.image_cache_gb
+    params["image_cache_dtype"] = args.image_cache_dtype
+    if args.sync_timers == "True":
+        params["sync_timers"] = True
+    else:
+        params["sync_timers"] = False
+    params["profile_start"] = args.profile_start
+    params["profile_stop"] = args.profile_stop
+    params["trace_path"] = args.trace_path
+    params["compile"] = args.compile
 
     evaluate(model, device, params)
 
@@ -0,0 +1,206 @@
+import os
+import numpy as np
+import h5py
+
+
+class FrameSource(object):
+    """
+    Calibrated and masked detector frames of one run, addressed by event index.
+    Backends implement build(times=None) (which sets self.times, reusing a known time table if given)
+    and read_img(event_idx).
+    """
+
+    def __init__(self, exp, run, det_name="DsdCsPad", image_cache=None):
+        self.exp = exp
+        self.run = run
+        self.det_name = det_name
+        self.image_cache = image_cache
+        self.times = None
+
+    def build(self, times=None):
+        raise NotImplementedError
+
+    def read_img(self, event_idx):
+        raise NotImplementedError
+
+    def load_img(self, event_idx):
+        if self.image_cache is not None:
+            calib = self.image_cache.get(self.exp, self.run, event_idx)
+            if calib is not None:
+                return calib
+        calib = self.read_img(event_idx)
+        if self.image_cache is not None:
+            self.image_cache.put(self.exp, self.run, event_idx, calib)
+        return calib
+
+    def load_imgs(self, event_idxs, out=None):
+        # fills a preallocated (B, panels, rows, cols) float32 buffer if given
+        for k, event_idx in enumerate(event_idxs):
+            img = self.load_img(event_idx)
+            if out is None:
+                out = np.empty((len(event_idxs),) + img.shape, dtype=np.float32)
+            out[k] = img
+        return out
+
+    def close(self):
+        pass
+
+
+class PSANAReader(FrameSource):
+
+    def __init__(self, exp, run, det_name="DsdCsPad", image_cache=None, mask_cache_dir=None):
+        super(PSANAReader, self).__init__(exp, run, det_name, image_cache=image_cache)
+        self.ds = None
+        self.det = None
+        self.this_run = None
+        self.mask_cache_dir = mask_cache_dir
+        self.mask = None
+
+    def build(self, times=None):
+        # imported here so that the rest of the data path works off the facility nodes
+        import psana
+        self.ds = psana.DataSource("exp={}:run={}:idx".format(self.exp, self.run))
+        self.det = psana.Detector(self.det_name)
+        ## self.this_run = self.ds.runs().next()
+        self.this_run = next(self.ds.runs())
+        self.times = self.this_run.times() if times is None else times
+
+    def mask_path(self):
+        return os.path.join(self.mask_cache_dir, "{}_r{:04d}_{}.npy".format(self.exp, int(self.run),
+                                                                           str(self.det_name).replace(":", "_")))
+
+    def pixel_mask(self, evt):
+        # the combined mask is static within a run: computed once, and cached on disk if mask_cache_dir is set
+        if self.mask is None:
+            if self.mask_cache_dir is not None and os.path.isfile(self.mask_path()):
+                self.mask = np.load(self.mask_path())
+            else:
+                self.mask = self.det.mask(evt, calib=True, status=True, edges=True,
+                                          central=True, unbond=True, unbondnbrs=True)
+                if self.mask_cache_dir is not None:
+                    os.makedirs(self.mask_cache_dir, exist_ok=True)
+                    tmp_path = self.mask_path() + ".{}.tmp.npy".format(os.getpid())
+                    np.save(tmp_path, self.mask)
+                    os.replace(tmp_path, self.mask_path())
+        return self.mask
+
+    def read_img(self, event_idx):
+        evt = self.this_run.event(self.times[event_idx])
+        calib = self.det.calib(evt) * self.pixel_mask(evt)
+        return calib
+
+    def close(self):
+        self.ds = None
+
+
+def frame_path(frame_dir, exp, run):
+    return os.path.join(frame_dir, str(exp), "r{:04d}.h5".format(int(run)))
+
+
+class H5FrameSource(FrameSource):
+    """
+    Frames exported by export_frames (see preprocessing/export_frames.py) to <frame_dir>/<exp>/r<run>.h5.
+    Uncompressed contiguous datasets are memory-mapped directly, bypassing the HDF5 library on reads.
+    """
+
+    def __init__(self, exp, run, det_name="DsdCsPad", image_cache=None, frame_dir="."):
+        super(H5FrameSource, self).__init__(exp, run, det_name, image_cache=image_cache)
+        self.path = frame_path(frame_dir, exp, run)
+        self.f = None
+        self.frames = None
+        self.rows = None
+
+    def build(self, times=None):
+        self.f = h5py.File(self.path, "r")
+        dset = self.f["frames"]
+        offset = dset.id.get_offset()
+        if dset.chunks is None and dset.compression is None and offset is not None:
+            self.frames = np.memmap(self.path, dtype=dset.dtype, mode="r", offset=offset, shape=dset.shape)
+        else:
+            self.frames = dset
+        self.times = self.f["times"][()]
+        # exported frames may be a subset of the run: event index -> row in "frames"
+        self.rows = np.full(len(self.times), -1, dtype=np.int64)
+        self.rows[self.f["event_idx"][()]] = np.arange(dset.shape[0])
+
+    def read_img(self, event_idx):
+        row = self.rows[event_idx]
+        if row < 0:
+            raise KeyError("Event {} of {} run {} was not exported to {}.".format(event_idx, self.exp, self.run,
+                                                                                 self.path))
+        # callers modify the image in place
+        return np.array(self.frames[row], dtype=np.float32)
+
+    def load_imgs(self, event_idxs, out=None):
+        if self.image_cache is not None or not isinstance(self.frames, np.memmap):
+            return super(H5FrameSource, self).load_imgs(event_idxs, out=out)
+        rows = self.rows[np.asarray(event_idxs, dtype=np.int64)]
+        if np.any(rows < 0):
+            raise KeyError("Some events of {} run {} were not exported to {}.".format(self.exp, self.run, self.path))
+        if out is None:
+            out = np.empty((len(rows),) + self.frames.shape[1:], dtype=np.float32)
+        # one gather straight from the mapped file into the batch buffer
+        np.take(self.frames, rows, axis=0, out=out)
+        return out
+
+    def close(self):
+        self.frames = None
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled, DataLoader workers re-open the file
+        state = self.__dict__.copy()
+        state["f"] = None
+        state["frames"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.times is not None:
+            self.build()
+
+
+def build_frame_source(exp, run, det_name="DsdCsPad", source="psana", frame_dir=None, image_cache=None,
+                       mask_cache_dir=None):
+    if source == "psana":
+        return PSANAReader(exp, run, det_name, image_cache=image_cache, mask_cache_dir=mask_cache_dir)
+    elif source == "h5":
+        return H5FrameSource(exp, run, det_name, image_cache=image_cache, frame_dir=frame_dir)
+    raise ValueError("Unrecognized frame source: " + str(source))
+
+
+def frames_exist(exp, run, source="psana", frame_dir=None):
+    if source == "h5":
+        return os.path.isfile(frame_path(frame_dir, exp, run))
+    from glob import glob
+    files = glob("/reg/d/psdm/cxi/{}/xtc/*{}*.xtc".format(exp, run))
+    return len(files) > 0
+
+
+def export_frames(reader, path, event_idxs=None):
+    """
+    Write the frames of a built FrameSource to an HDF5 file readable by H5FrameSource.
+    psana event times are stored as (seconds, nanoseconds, fiducial).
+    """
+    if event_idxs is None:
+        event_idxs = np.arange(len(reader.times))
+    event_idxs = np.sort(np.asarray(event_idxs, dtype=np.int64))
+    first = reader.load_img(int(event_idxs[0]))
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with h5py.File(path, "w") as f:
+        # contiguous and uncompressed, so that H5FrameSource can memory-map it
+        frames = f.create_dataset("frames", shape=(len(event_idxs),) + first.shape, dtype=np.float32)
+        frames[0] = first
+        for i in range(1, len(event_idxs)):
+            frames[i] = reader.load_img(int(event_idxs[i]))
+        times = reader.times
+        if len(times) > 0 and hasattr(times[0], "seconds"):
+            times = np.array([[t.seconds(), t.nanoseconds(), t.fiducial()] for t in times], dtype=np.int64)
+        f.create_dataset("times", data=np.asarray(times))
+        f.create_dataset("event_idx", data=event_idxs)
+        f.attrs["exp"] = str(reader.exp)
+        f.attrs["run"] = int(reader.run)
+        f.attrs["det_name"] = str(reader.det_name)
@@ -0,0 +1,131 @@
+import time
+import torch
+
+
+class FrozenFilters(object):
+    """
+    AdaFilter_1 inference over a run with frozen adaptive filters. Within a run (one experiment, one detector
+    state) the panel-dependent filters generated by the encoder and linear_layer barely change from one event
+    to the next: they are averaged over the first n_calibration events, which use their own filters, and
+    every later batch only runs the fixed filtering and gen_peak_finding.
+
+    The filters are recalibrated every refresh_every events (0: never). Every drift_check_every events
+    (0: never), a batch's own filters are compared with the frozen ones, and a relative L2 distance above
+    drift_tolerance recalibrates them. These checks also measure how far the frozen outputs are from the
+    per-event ones (report). forward is what runs the model, e.g. a compiled.CompiledModel in eager or compile
+    mode (a trace would not see the filters change). Call start_run() at the beginning of each run.
+    """
+
+    def __init__(self, model, forward=None, n_calibration=16, refresh_every=0, drift_check_every=0,
+                 drift_tolerance=0.05, cutoff=0.5):
+        if not getattr(model, "adaptive_filtering", False) or not hasattr(model, "filter_bank"):
+            raise ValueError("Frozen filters are for AdaFilter_1 models with adaptive filtering.")
+        self.model = model
+        self.forward = model if forward is None else forward
+        self.n_calibration = n_calibration
+        self.refresh_every = refresh_every
+        self.drift_check_every = drift_check_every
+        self.drift_tolerance = drift_tolerance
+        self.cutoff = cutoff
+        # over all runs
+        self.times = {"per-event": 0., "frozen": 0.}
+        self.n_events = {"per-event": 0, "frozen": 0}
+        self.n_calibrations = 0
+        self.n_drift_checks = 0
+        self.n_drifted = 0
+        self.max_drift = 0.
+        self.max_logit_diff = 0.
+        self.n_changed = 0
+        self.n_positives = 0
+        self.start_run()
+
+    def start_run(self):
+        self.frozen = None
+        self.model.fixed_filters = None
+        self.bank_sum = None
+        self.n_calibrated = 0
+        self.since_refresh = 0
+        self.since_check = 0
+
+    def __call__(self, x):
+        tic = time.time()
+        mode = "per-event" if self.frozen is None else "frozen"
+        if self.frozen is None:
+            scores = self.calibrate(x, *self.per_event(x))
+        else:
+            scores = self.frozen_forward(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        self.times[mode] += time.time() - tic
+        self.n_events[mode] += x.size(0)
+        return scores
+
+    def per_event(self, x):
+        # the batch's own filters, computed once and used for its forward pass
+        bank = self.model.filter_bank(self.model.downsample_for_visualization(x))
+        self.model.fixed_filters = bank
+        try:
+            scores = self.forward(x)
+        finally:
+            self.model.fixed_filters = self.frozen
+        return scores, bank
+
+    def panel_mean(self, bank):
+        return bank.view(-1, self.model.n_panels, bank.size(1)).mean(0)
+
+    def calibrate(self, x, scores, bank):
+        bank_sum = bank.view(-1, self.model.n_panels, bank.size(1)).sum(0)
+        self.bank_sum = bank_sum if self.bank_sum is None else self.bank_sum + bank_sum
+        self.n_calibrated += x.size(0)
+        if self.n_calibrated >= self.n_calibration:
+            self.frozen = self.bank_sum / self.n_calibrated
+            self.model.fixed_filters = self.frozen
+            self.n_calibrations += 1
+            self.bank_sum = None
+            self.n_calibrated = 0
+            self.since_refresh = 0
+            self.since_check = 0
+        return scores
+
+    def unfreeze(self):
+        self.frozen = None
+        self.model.fixed_filters = None
+
+    def frozen_forward(self, x):
+        self.since_refresh += x.size(0)
+        self.since_check += x.size(0)
+        if self.refresh_every > 0 and self.since_refresh >= self.refresh_every:
+            self.unfreeze()
+            return self.calibrate(x, *self.per_event(x))
+        if self.drift_check_every > 0 and self.since_check >= self.drift_check_every:
+            self.since_check = 0
+            return self.check_drift(x)
+        return self.forward(x)
+
+    def check_drift(self, x):
+        scores = self.forward(x)
+        own_scores, bank = self.per_event(x)
+        drift = float((self.panel_mean(bank) - self.frozen).norm() / self.frozen.norm().clamp_min(1e-12))
+        self.n_drift_checks += 1
+        self.max_drift = max(self.max_drift, drift)
+        self.max_logit_diff = max(self.max_logit_diff, float((scores - own_scores).abs().max()))
+        positives = torch.sigmoid(scores) > self.cutoff
+        own_positives = torch.sigmoid(own_scores) > self.cutoff
+        self.n_changed += int((positives != own_positives).sum())
+        self.n_positives += int(own_positives.sum())
+        if drift > self.drift_tolerance:
+            # the batch's own filters start the new calibration
+            self.n_drifted += 1
+            self.unfreeze()
+            return self.calibrate(x, own_scores, bank)
+        return scores
+
+    def report(self):
+        ms_per_event = {mode: 1e3 * self.times[mode] / max(1, self.n_events[mode]) for mode in self.times}
+        speedup = ms_per_event["per-event"] / max(1e-12, ms_per_event["frozen"])
+        return "frozen filters: {} events with their own filters ({:.2f} ms / event), {} frozen ({:.2f} ms / event, " \
+               "x{:.2f}) ; {} calibrations ; {} drift checks, {} drifted, max drift {:.3f} ; max logit diff " \
+               "{:.2e}, {} pixels changed for {} per-event positives".format(
+                   self.n_events["per-event"], ms_per_event["per-event"], self.n_events["frozen"],
+                   ms_per_event["frozen"], speedup, self.n_calibrations, self.n_drift_checks, self.n_drifted,
+                   self.max_drift, self.max_logit_diff, self.n_changed, self.n_positives)
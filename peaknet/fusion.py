@@ -0,0 +1,189 @@
+import copy
+import argparse
+import torch
+import torch.nn as nn
+from data import PANEL_SHAPE
+from models import AdaFilter_1
+
+
+def conv_like(conv, padding, padding_mode, bias):
+    new = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=padding,
+                    dilation=conv.dilation, groups=conv.groups, bias=bias, padding_mode=padding_mode)
+    return new.to(device=conv.weight.device, dtype=conv.weight.dtype)
+
+
+def fold_batchnorm(conv, bn):
+    # conv followed by bn (inference statistics) as one conv: w * s, (b - mean) * s + beta, s = gamma / std
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.affine:
+            scale = scale * bn.weight
+        bias = -bn.running_mean if conv.bias is None else conv.bias - bn.running_mean
+        bias = bias * scale
+        if bn.affine:
+            bias = bias + bn.bias
+        fused = conv_like(conv, conv.padding, conv.padding_mode, True)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_(bias)
+    return fused
+
+
+def can_merge_pad(pad, conv):
+    left, right, top, bottom = pad.padding
+    return left == right and top == bottom and tuple(conv.padding) == (0, 0) and conv.padding_mode == "zeros"
+
+
+def merge_reflection_pad(pad, conv):
+    # ReflectionPad2d + unpadded conv as one reflect-padded conv
+    left, _, top, _ = pad.padding
+    merged = conv_like(conv, (top, left), "reflect", conv.bias is not None)
+    with torch.no_grad():
+        merged.weight.copy_(conv.weight)
+        if conv.bias is not None:
+            merged.bias.copy_(conv.bias)
+    return merged
+
+
+def fuse_sequential(seq):
+    modules = []
+    for m in seq:
+        if isinstance(m, nn.Sequential):
+            m = fuse_sequential(m)
+        elif isinstance(m, nn.ReflectionPad2d) and all(p == 0 for p in m.padding):
+            continue
+        elif isinstance(m, nn.BatchNorm2d) and m.track_running_stats and modules and \
+                isinstance(modules[-1], nn.Conv2d):
+            modules[-1] = fold_batchnorm(modules[-1], m)
+            continue
+        elif isinstance(m, nn.Conv2d) and modules and isinstance(modules[-1], nn.ReflectionPad2d) and \
+                can_merge_pad(modules[-1], m):
+            modules[-1] = merge_reflection_pad(modules[-1], m)
+            continue
+        else:
+            fuse_modules(m)
+        modules.append(m)
+    return nn.Sequential(*modules)
+
+
+def fuse_modules(module):
+    # in place: every nn.Sequential below module is replaced by its fused version
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential):
+            setattr(module, name, fuse_sequential(child))
+        else:
+            fuse_modules(child)
+
+
+class ResidualCombination(nn.Module):
+    # combination_layer of AdaFilter_1 (1 x 1 conv of cat(filtered_x, logits)) as a weighted sum, without the cat
+
+    def __init__(self, conv):
+        super(ResidualCombination, self).__init__()
+        weight = conv.weight.detach().reshape(2)
+        self.register_buffer("weight_x", weight[0:1].clone())
+        self.register_buffer("weight_logits", weight[1:2].clone())
+        self.register_buffer("bias", conv.bias.detach().clone())
+
+    def forward(self, filtered_x, logits):
+        return torch.addcmul(filtered_x * self.weight_x + self.bias, logits, self.weight_logits)
+
+
+class FusedAdaFilter1(nn.Module):
+    """
+    AdaFilter_1 for inference only, built from a trained one: BatchNorm folded into the convolutions,
+    reflection pads merged into them, the residual combination without the concatenation, and no
+    intermediate-activation / visualization outputs.
+    """
+    filter_bank = AdaFilter_1.filter_bank
+    use_encoder = AdaFilter_1.use_encoder
+    input_is_downsampled = AdaFilter_1.input_is_downsampled
+    # frozen_filters.FrozenFilters computes filter banks on the downsampled panels
+    downsample_for_visualization = AdaFilter_1.downsample_for_visualization
+
+    def __init__(self, model):
+        super(FusedAdaFilter1, self).__init__()
+        if getattr(model, "adaptive_residual", False):
+            raise ValueError("AdaFilter_1 with adaptive_residual cannot be fused.")
+        self.n_panels = model.n_panels
+        self.can_show_inter_act = False
+        if hasattr(model, "downsample"):
+            self.downsample = model.downsample
+        self.downsample_bool = model.downsample_bool
+        if self.downsample_bool:
+            self.downsampling = model.downsampling
+        self.adaptive_filtering = model.adaptive_filtering
+        if self.adaptive_filtering:
+            self.encoder = fuse_sequential(model.encoder)
+            self.linear_layer = model.linear_layer
+            self.k_ada_filter = model.k_ada_filter
+            self.n_ada_filter = model.n_ada_filter
+        else:
+            self.pd_filtering = fuse_sequential(model.pd_filtering)
+        self.dynamic_conv = getattr(model, "dynamic_conv", "auto")
+        self.fixed_filters = getattr(model, "fixed_filters", None)
+        self.gen_peak_finding = fuse_sequential(model.gen_peak_finding)
+        self.combination = ResidualCombination(model.combination_layer) if model.residual else None
+        self.pd_scaling = fuse_sequential(model.pd_scaling)
+
+    def forward(self, x):
+        if self.downsample_bool and not self.input_is_downsampled(x):
+            x = self.downsampling(x)
+        h, w = x.size(2), x.size(3)
+        if self.adaptive_filtering:
+            filtered_x = self.use_encoder(x, self.k_ada_filter, self.n_ada_filter)
+        else:
+            filtered_x = self.pd_filtering(x)
+        filtered_x = filtered_x.view(-1, 1, h, w)
+        logits = self.gen_peak_finding(filtered_x)
+        if self.combination is not None:
+            logits = self.combination(filtered_x, logits)
+        if len(self.pd_scaling) > 0:
+            logits = self.pd_scaling(logits.view(-1, self.n_panels, h, w))
+        return logits.view(-1, 1, h, w)
+
+
+def fuse_for_inference(model):
+    """
+    An inference-only copy of model (AdaFilter_0/1/2 or UNet, in eval mode), with BatchNorm folded into
+    the preceding convolutions and ReflectionPad2d + conv pairs merged. The model itself is not modified.
+    """
+    model = copy.deepcopy(model).eval()
+    if isinstance(model, AdaFilter_1):
+        fused = FusedAdaFilter1(model)
+    else:
+        # the forward passes of AdaFilter_0/2 and UNet have no intermediate outputs: their blocks are fused in place
+        fuse_modules(model)
+        fused = model
+        if hasattr(fused, "can_show_inter_act"):
+            fused.can_show_inter_act = False
+    return fused.eval()
+
+
+def max_difference(model, fused, x):
+    with torch.no_grad():
+        return (model.eval()(x) - fused(x)).abs().max().item()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Exports a trained model (.PT) fused for inference.")
+    p.add_argument("model_path", type=str, help="A path to .PT file")
+    p.add_argument("fused_path", type=str, help="Where to save the fused model")
+    p.add_argument("--batch_size", type=int, default=2, help="Batch of random panels to check the outputs on")
+    p.add_argument("--atol", type=float, default=1e-4)
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    model = torch.load(args.model_path, map_location="cpu", weights_only=False)
+    fused = fuse_for_inference(model)
+    diff = max_difference(model, fused, torch.rand((args.batch_size,) + PANEL_SHAPE))
+    print("Max difference to the original outputs: " + str(diff))
+    if diff > args.atol:
+        raise ValueError("The fused model differs by more than " + str(args.atol) + ".")
+    torch.save(fused, args.fused_path)
+    print("Fused model saved at " + args.fused_path + ".")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import numpy as np
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "uint16": np.uint16}
+
+
+class ImageCache(object):
+    """
+    Local cache of calibrated, masked detector images keyed by (exp, run, event), stored in fixed-size slots
+    of a memory-mapped file. The index is two small arrays (key hash and last-use time per slot); when the
+    size cap is reached the least recently used slot is overwritten. float16 and uint16 storage trade
+    accuracy for footprint, the resulting error is tracked and printed by report().
+    """
+
+    def __init__(self, cache_dir, max_gb=50., dtype="float32", img_shape=(32, 185, 388)):
+        if dtype not in DTYPES:
+            raise ValueError("Unrecognized image cache dtype: " + str(dtype))
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        self.img_shape = tuple(img_shape)
+        slot_bytes = int(np.prod(self.img_shape)) * np.dtype(DTYPES[dtype]).itemsize
+        self.n_slots = max(1, int(max_gb * 1024 ** 3) // slot_bytes)
+        self.images = None
+        self.keys = None
+        self.ticks = None
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_written = 0
+        self.sum_abs_err = 0.
+        self.sum_abs_val = 0.
+        self.max_abs_err = 0.
+        self.n_pixels = 0
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def open(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        header = {"dtype": self.dtype, "img_shape": list(self.img_shape), "n_slots": self.n_slots}
+        with open(self.path("lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path("header.json")) as f:
+                    existing = json.load(f)
+            except (IOError, ValueError):
+                existing = None
+            if existing != header:
+                # new cache, or a different dtype / size cap: start from scratch
+                np.memmap(self.path("images.dat"), dtype=DTYPES[self.dtype], mode="w+",
+                          shape=(self.n_slots,) + self.img_shape).flush()
+                np.lib.format.open_memmap(self.path("keys.npy"), mode="w+", dtype=np.int64,
+                                          shape=(self.n_slots,)).flush()
+                np.lib.format.open_memmap(self.path("ticks.npy"), mode="w+", dtype=np.float64,
+                                          shape=(self.n_slots,)).flush()
+                with open(self.path("header.json"), "w") as f:
+                    json.dump(header, f)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.images = np.memmap(self.path("images.dat"), dtype=DTYPES[self.dtype], mode="r+",
+                                shape=(self.n_slots,) + self.img_shape)
+        self.keys = np.load(self.path("keys.npy"), mmap_mode="r+")
+        self.ticks = np.load(self.path("ticks.npy"), mmap_mode="r+")
+
+    def key_hash(self, exp, run, event_idx):
+        key = "{}:{}:{}".format(exp, int(run), int(event_idx))
+        # 0 marks an empty slot and -1 a slot being written
+        return int(hashlib.sha1(key.encode()).hexdigest()[:15], 16) + 1
+
+    def get(self, exp, run, event_idx):
+        if self.images is None:
+            self.open()
+        h = self.key_hash(exp, run, event_idx)
+        slots = np.flatnonzero(self.keys == h)
+        if len(slots) > 0:
+            slot = slots[0]
+            img = self.images[slot].astype(np.float32)
+            # the slot may have been evicted by another process while we were copying it
+            if self.keys[slot] == h:
+                self.ticks[slot] = time.time()
+                self.n_hits += 1
+                return img
+        self.n_misses += 1
+        return None
+
+    def encode(self, img):
+        if self.dtype == "uint16":
+            return np.clip(np.rint(img), 0, 65535).astype(np.uint16)
+        return img.astype(DTYPES[self.dtype])
+
+    def put(self, exp, run, event_idx, img):
+        if self.images is None:
+            self.open()
+        h = self.key_hash(exp, run, event_idx)
+        stored = self.encode(img)
+        if self.dtype != "float32":
+            # negative pixels are clipped by the data pipeline right after loading, so they do not count
+            ref = np.maximum(img, 0).astype(np.float64)
+            err = np.abs(np.maximum(stored.astype(np.float64), 0) - ref)
+            self.sum_abs_err += err.sum()
+            self.sum_abs_val += ref.sum()
+            self.max_abs_err = max(self.max_abs_err, float(err.max()))
+            self.n_pixels += err.size
+        with open(self.path("lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not np.any(self.keys == h):
+                empty = np.flatnonzero(self.keys == 0)
+                slot = empty[0] if len(empty) > 0 else int(np.argmin(self.ticks))
+                self.keys[slot] = -1
+                self.images[slot] = stored
+                self.ticks[slot] = time.time()
+                self.keys[slot] = h
+                self.n_written += 1
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def report(self):
+        report_str = "image cache ({}, {} slots): {} hits, {} misses, {} written".format(
+            self.dtype, self.n_slots, self.n_hits, self.n_misses, self.n_written)
+        if self.n_pixels > 0:
+            report_str += " ; mean abs error {:.4g} ADU, max abs error {:.4g} ADU, relative error {:.3g}".format(
+                self.sum_abs_err / self.n_pixels, self.max_abs_err, self.sum_abs_err / max(1e-12, self.sum_abs_val))
+        return report_str
+
+    def close(self):
+        if self.images is not None:
+            self.images.flush()
+        self.images = None
+        self.keys = None
+        self.ticks = None
+
+    def __getstate__(self):
+        # the mappings are re-opened on first access in DataLoader workers
+        state = self.__dict__.copy()
+        state["images"] = None
+        state["keys"] = None
+        state["ticks"] = None
+        return state
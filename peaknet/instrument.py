@@ -0,0 +1,76 @@
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+import torch
+
+
+class Timers(object):
+    """
+    Wall-clock time and number of calls per named stage ("data wait", "forward", "psana read", ...),
+    summed until reset(). Each timed stage is also a torch.profiler range. With synchronize, CUDA work is
+    waited for at both ends of a stage: exact stage times, at the cost of the CPU/GPU overlap.
+    """
+
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.totals = OrderedDict()
+        self.counts = OrderedDict()
+
+    @contextmanager
+    def time(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        tic = time.time()
+        with torch.profiler.record_function(name):
+            yield
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self.add(name, time.time() - tic)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def report(self, title):
+        totals = list(self.totals.items())
+        total = sum(seconds for _, seconds in totals)
+        lines = [title + ": {:.2f} s timed".format(total)]
+        for name, seconds in totals:
+            lines.append("  {:16s} {:9.3f} s {:6.1f}% {:9.2f} ms x {}".format(
+                name, seconds, 100. * seconds / max(1e-12, total), 1e3 * seconds / self.counts[name],
+                self.counts[name]))
+        return "\n".join(lines)
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+
+
+class ProfilerWindow(object):
+    """
+    torch.profiler over steps [start, stop), exported as a Chrome trace (chrome://tracing or Perfetto).
+    step(i) is called at the beginning of each step. start < 0 disables it; stop <= start traces 10 steps.
+    """
+
+    def __init__(self, start, stop, trace_path):
+        self.start = start
+        self.stop = stop if stop > start else start + 10
+        self.trace_path = trace_path
+        self.prof = None
+
+    def step(self, i):
+        if i == self.start and self.prof is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.prof.__enter__()
+        elif i >= self.stop:
+            self.close()
+
+    def close(self):
+        if self.prof is not None:
+            self.prof.__exit__(None, None, None)
+            self.prof.export_chrome_trace(self.trace_path)
+            print("Profiler trace of steps {} to {} written at {}.".format(self.start, self.stop, self.trace_path))
+            self.prof = None
@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+
+class LabelCache(object):
+    """
+    Pre-rendered labels of one CXI file in a memory-mapped .npy sidecar, keyed by
+    (CXI file, downsample, use_indexed_peaks, n_classes) and rebuilt when the CXI mtime or size changes.
+    """
+
+    def __init__(self, cache_dir, cxi_path, downsample, use_indexed_peaks, n_classes):
+        self.cache_dir = cache_dir
+        self.cxi_path = os.path.abspath(cxi_path)
+        self.key = {"cxi_path": self.cxi_path, "downsample": int(downsample),
+                    "use_indexed_peaks": bool(use_indexed_peaks), "n_classes": int(n_classes)}
+        digest = hashlib.sha1(json.dumps(self.key, sort_keys=True).encode()).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(cxi_path))[0] + "_" + digest
+        self.data_path = os.path.join(cache_dir, name + ".npy")
+        self.meta_path = os.path.join(cache_dir, name + ".json")
+        self.labels = None
+
+    def cxi_stat(self):
+        st = os.stat(self.cxi_path)
+        return {"cxi_mtime": st.st_mtime, "cxi_size": st.st_size}
+
+    def is_valid(self):
+        if not (os.path.isfile(self.data_path) and os.path.isfile(self.meta_path)):
+            return False
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except ValueError:
+            return False
+        expected = dict(self.key, **self.cxi_stat())
+        return all(meta.get(k) == v for k, v in expected.items())
+
+    def build(self, render_label, n_rows, label_shape):
+        # render_label(row) returns the label tensor of CXI row `row`
+        # the header is removed first and written last, so a half-built sidecar is never trusted
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        tmp_path = self.data_path + ".{}.tmp".format(os.getpid())
+        out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(n_rows,) + tuple(label_shape))
+        for row in range(n_rows):
+            out[row] = render_label(row).numpy()
+        out.flush()
+        del out
+        os.replace(tmp_path, self.data_path)
+        meta = dict(self.key, **self.cxi_stat())
+        meta["shape"] = [n_rows] + list(label_shape)
+        tmp_meta = self.meta_path + ".{}.tmp".format(os.getpid())
+        with open(tmp_meta, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, self.meta_path)
+
+    def open(self):
+        # copy-on-write mapping: torch.from_numpy gets a writable, zero-copy view of the page cache
+        self.labels = np.load(self.data_path, mmap_mode="c")
+
+    def __len__(self):
+        if self.labels is None:
+            self.open()
+        return len(self.labels)
+
+    def __getitem__(self, row):
+        if self.labels is None:
+            self.open()
+        return torch.from_numpy(self.labels[row])
+
+    def close(self):
+        self.labels = None
+
+    def __getstate__(self):
+        # DataLoader workers re-open the mapping on first access instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state["labels"] = None
+        return state
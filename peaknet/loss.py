@@ -1,12 +1,15 @@
 import torch
 import torch.nn as nn
 import numpy as np
+from sparse_labels import SparseLabels
 
 class PeaknetBCELoss(nn.Module):
 
-    def __init__(self, coor_scale=1, pos_weight=1.0, device=None):
+    def __init__(self, coor_scale=1, pos_weight=1.0, device=None, per_step_metrics=True):
         super(PeaknetBCELoss, self).__init__()
         self.coor_scale = coor_scale
+        # recall / precision as floats at every step (a device sync each), see metrics.MetricsAccumulator
+        self.per_step_metrics = per_step_metrics
         self.mseloss = nn.MSELoss()
         self.bceloss = None
         self.pos_weight = torch.Tensor([pos_weight])
@@ -14,6 +17,10 @@ class PeaknetBCELoss(nn.Module):
             self.pos_weight.to(device)
 
     def forward(self, scores, targets, cutoff=0.1, verbose=False):
+        # scores of a mixed-precision forward pass (see precision), the loss is computed in float32
+        scores = scores.float()
+        if isinstance(targets, SparseLabels):
+            targets = targets.to_dense(scores.device)
         if verbose:
             print("scores", scores.size())
             print("targets", targets.size())
@@ -40,14 +47,15 @@ class PeaknetBCELoss(nn.Module):
             positives = (scores_c > cutoff)
             n_p = positives.sum()
             n_tp = (positives[gt_mask]).sum()
-            recall = float(n_tp) / max(1, int(n_gt))
-            precision = float(n_tp) / max(1, int(n_p))
             rmsd = torch.sqrt(torch.mean((targets_x - scores_x).pow(2) + (targets_y - scores_y).pow(2)))
             if verbose:
                 print("nGT", int(n_gt), "recall", int(n_tp), "nP", int(n_p), "rmsd", float(rmsd),
                       "loss", float(loss.data), "conf", float(loss_conf.data), "coor", float(loss_coor.data))
-        metrics = {"loss": loss, "loss_conf": loss_conf, "loss_coor": loss_coor, "recall": recall,
-                   "precision": precision, "rmsd": rmsd}
+        metrics = {"loss": loss, "loss_conf": loss_conf, "loss_coor": loss_coor, "rmsd": rmsd,
+                   "n_tp_recall": n_tp, "n_gt": n_gt, "n_tp_prec": n_tp, "n_p": n_p}
+        if self.per_step_metrics:
+            metrics["recall"] = float(n_tp) / max(1, int(n_gt))
+            metrics["precision"] = float(n_tp) / max(1, int(n_p))
         return metrics
 
 def focal_loss(scores, target, TN, alpha, gamma):
@@ -81,6 +89,8 @@ class PeakNetBCE1ChannelLoss(nn.Module):
         pos_weight_0 = params["pos_weight_0"]
         annihilation_speed = params["annihilation_speed"]
         self.use_indexed_peaks = use_indexed_peaks
+        # recall / precision as floats at every step (a device sync each), see metrics.MetricsAccumulator
+        self.per_step_metrics = params.get("debug_metrics", True)
         if use_indexed_peaks:
             self.maxpool_idxg = nn.Sequential(nn.ReflectionPad2d(2),
                                               nn.MaxPool2d(5, stride=1, padding=0))
@@ -114,7 +124,24 @@ class PeakNetBCE1ChannelLoss(nn.Module):
             if self. gamma_bool:
                 self.gamma = self.gamma.to(device)
 
+    def schedule_state(self):
+        # pos_weight is not a buffer, and the step schedule counts calls: both go into training checkpoints
+        state = {"pos_weight": self.pos_weight.cpu()}
+        if self.use_scheduled_pos_weight:
+            state["internal_count"] = self.internal_count
+        return state
+
+    def load_schedule_state(self, state):
+        self.pos_weight = state["pos_weight"].to(self.pos_weight.device)
+        if self.use_scheduled_pos_weight:
+            self.internal_count = state["internal_count"]
+
     def forward(self, scores, targets, cutoff=0.5, verbose=False, maxpool_gt=False, maxpool_prec=True):
+        # scores of a mixed-precision forward pass (see precision), the loss is computed in float32
+        scores = scores.float()
+        if isinstance(targets, SparseLabels):
+            # peak lists from PSANAImage(sparse_labels=True), rendered here in one scatter on the scores' device
+            targets = targets.to_dense(scores.device)
         if self.use_indexed_peaks:
             peak_finding_mask = targets[:, 0, :, :].reshape(-1)
             indexing_mask = self.maxpool_idxg(targets)[:, 1, :, :].reshape(-1)
@@ -155,9 +182,13 @@ class PeakNetBCE1ChannelLoss(nn.Module):
                     n_tp_prec = (positives * union_mask_mp).sum()
                 else:
                     n_tp_prec = (positives * union_mask).sum()
-                recall = float(n_tp_recall) / max(1, int(n_pos_gt))
-                precision = float(n_tp_prec) / max(1, int(n_p))
-            metrics = {"loss": loss, "recall": recall, "precision": precision, "n_pos_gt": n_pos_gt.item(), "n_neg_gt": n_neg_gt.item()}
+            metrics = {"loss": loss, "n_tp_recall": n_tp_recall, "n_gt": n_pos_gt, "n_tp_prec": n_tp_prec, "n_p": n_p,
+                       "n_pos_gt": n_pos_gt, "n_neg_gt": n_neg_gt}
+            if self.per_step_metrics:
+                metrics["recall"] = float(n_tp_recall) / max(1, int(n_pos_gt))
+                metrics["precision"] = float(n_tp_prec) / max(1, int(n_p))
+                metrics["n_pos_gt"] = n_pos_gt.item()
+                metrics["n_neg_gt"] = n_neg_gt.item()
             return metrics
 
         else:
@@ -189,11 +220,12 @@ class PeakNetBCE1ChannelLoss(nn.Module):
                     n_tp_prec = (positives[self.maxpool(targets)[:, 0, :, :].reshape(-1) > 0.5]).sum()
                 else:
                     n_tp_prec = n_tp
-                recall = float(n_tp) / max(1, int(n_gt))
-                precision = float(n_tp_prec) / max(1, int(n_p))
                 if verbose:
                     print("nGT", int(n_gt), "recall", int(n_tp), "nP", int(n_p), "loss", float(loss.data))
-            metrics = {"loss": loss, "recall": recall, "precision": precision}
+            metrics = {"loss": loss, "n_tp_recall": n_tp, "n_gt": n_gt, "n_tp_prec": n_tp_prec, "n_p": n_p}
+            if self.per_step_metrics:
+                metrics["recall"] = float(n_tp) / max(1, int(n_gt))
+                metrics["precision"] = float(n_tp_prec) / max(1, int(n_p))
             return metrics
 
 class PeaknetMSELoss(nn.Module):
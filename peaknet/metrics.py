@@ -0,0 +1,47 @@
+import torch
+import torch.distributed as dist
+from distributed import is_distributed, get_world_size
+
+
+class MetricsAccumulator(object):
+    """
+    Sums of the per-step metrics returned by the loss functions (loss terms and the TP / positive / GT counts),
+    kept as device tensors so that training steps do not wait on the device. values() brings them to the host
+    in one transfer, at print / upload boundaries, and starts a new window: losses are averaged over the
+    window's steps, counts are summed, and recall / precision are computed from the summed counts.
+    In distributed training the sums of all ranks are reduced, so every rank calls values() at the same steps.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.n_steps = 0
+
+    def add(self, metrics):
+        with torch.no_grad():
+            for key, value in metrics.items():
+                # per-step floats (debug_metrics) are not accumulated
+                if not isinstance(value, torch.Tensor):
+                    continue
+                value = value.detach().reshape(())
+                self.sums[key] = value if key not in self.sums else self.sums[key] + value
+        self.n_steps += 1
+
+    def values(self):
+        if self.n_steps == 0:
+            return {}
+        keys = list(self.sums.keys())
+        stacked = torch.stack([self.sums[key].double() for key in keys])
+        n_steps = self.n_steps
+        if is_distributed():
+            dist.all_reduce(stacked)
+            n_steps *= get_world_size()
+        sums = dict(zip(keys, stacked.cpu().tolist()))
+        values = {}
+        for key, value in sums.items():
+            values[key] = value if key.startswith("n_") else value / n_steps
+        if "n_tp_recall" in sums:
+            values["recall"] = sums["n_tp_recall"] / max(1, sums["n_gt"])
+            values["precision"] = sums["n_tp_prec"] / max(1, sums["n_p"])
+        self.sums = {}
+        self.n_steps = 0
+        return values
@@ -0,0 +1,53 @@
+import torch
+import torch.nn.functional as F
+
+# a grouped convolution is fine up to this many groups (one event's panels)
+GROUPED_MAX_GROUPS = 32
+# unfolded (im2col) inputs larger than this are convolved tap by tap instead
+UNFOLD_MAX_BYTES = 256 * 2 ** 20
+
+
+def choose_method(x, weight, groups):
+    if groups <= GROUPED_MAX_GROUPS:
+        return "grouped"
+    c_in, kh, kw = weight.size(1), weight.size(2), weight.size(3)
+    h, w = x.size(2) - kh + 1, x.size(3) - kw + 1
+    if groups * c_in * kh * kw * h * w * x.element_size() <= UNFOLD_MAX_BYTES:
+        return "unfold"
+    return "shift"
+
+
+def dynamic_conv2d(x, weight, bias, groups, method="auto"):
+    """
+    Same as F.conv2d(x, weight, bias, groups=groups) for a (1, groups * c_in, h, w) input, already padded,
+    convolved by its own filters in each group (weight: (groups * c_out, c_in, kh, kw)), as in
+    AdaFilter_1.use_encoder. A grouped convolution with thousands of groups is very slow on CPU, so:
+    "unfold" unfolds the input (im2col) and runs one batched matmul over the groups; "shift" runs one
+    batched contraction per filter tap, and does not hold the kh * kw copies of the input that "unfold" does.
+    "auto" picks "grouped" for few groups, then "unfold" while the unfolded input is small, then "shift".
+    """
+    if method == "auto":
+        method = choose_method(x, weight, groups)
+    if method == "grouped":
+        return F.conv2d(x, weight, bias=bias, groups=groups)
+    c_in, kh, kw = weight.size(1), weight.size(2), weight.size(3)
+    c_out = weight.size(0) // groups
+    h_pad, w_pad = x.size(2), x.size(3)
+    h, w = h_pad - kh + 1, w_pad - kw + 1
+    x = x.reshape(groups, c_in, h_pad, w_pad)
+    if method == "unfold":
+        # (groups, c_in * kh * kw, h * w), in the (c_in, kh, kw) order of the weights
+        cols = F.unfold(x, (kh, kw))
+        out = torch.bmm(weight.reshape(groups, c_out, c_in * kh * kw), cols).view(groups, c_out, h, w)
+    elif method == "shift":
+        weight = weight.reshape(groups, c_out, c_in, kh, kw)
+        out = None
+        for i in range(kh):
+            for j in range(kw):
+                tap = torch.einsum("goc,gchw->gohw", weight[:, :, :, i, j], x[:, :, i:i + h, j:j + w])
+                out = tap if out is None else out + tap
+    else:
+        raise ValueError("Unrecognized dynamic convolution " + str(method) + " (auto, grouped, unfold or shift).")
+    if bias is not None:
+        out = out + bias.view(groups, c_out, 1, 1)
+    return out.reshape(1, groups * c_out, h, w)
@@ -1,7 +1,9 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import time
+from .dynamic_conv import dynamic_conv2d
 
 class AdaFilter_1(nn.Module):
 
@@ -41,6 +43,10 @@ class AdaFilter_1(nn.Module):
             self.encoder, self.linear_layer = self.create_panel_to_filter_encoder(k_list, n_list, h, w)
             self.k_ada_filter = k_list
             self.n_ada_filter = n_list
+        # how the per-panel filters are applied, see dynamic_conv2d
+        self.dynamic_conv = params.get("dynamic_conv", "auto")
+        # filters used instead of the encoder's: (n_panels, n_params) for all events, see frozen_filters
+        self.fixed_filters = None
 
         # Generic Peak Finding
         k_list = [5, 5]
@@ -115,33 +121,53 @@ class AdaFilter_1(nn.Module):
                                      nn.Linear(n_features_inter, n_params)) # two-layer linear decoder
         return encoder, linear_layer
 
+    def filter_bank(self, x):
+        # weights and biases of the panel-dependent filters of each event: (N * n_panels, n_params)
+        return self.linear_layer(self.encoder(x).view(x.size(0) * self.n_panels, -1))
+
     def use_encoder(self, x, k_list, n_list):
-        NL = nn.LeakyReLU()
-        #
         N, h, w = x.size(0), x.size(2), x.size(3)
-        # the filtering will be panel-dependent AND experiment-dependent
-        filtered_x = x.view(1, -1, h, w)
-        n_arr = np.array([1] + n_list + [1])
-        k_arr = np.array(k_list)
+        # python ints, which torch.compile / tracing keep as constants
+        n_arr = [1] + list(n_list) + [1]
+        k_arr = list(k_list)
 
-        weight_bias = self.linear_layer(self.encoder(x).view(N * self.n_panels, -1))
+        # models pickled before frozen filters have no fixed_filters
+        fixed_filters = getattr(self, "fixed_filters", None)
+        if fixed_filters is not None and fixed_filters.size(0) == self.n_panels:
+            # the same filters for every event: a plain batched convolution, with one group per panel
+            weight_bias = fixed_filters
+            filtered_x = x.view(N, -1, h, w)
+        else:
+            # the filtering will be panel-dependent AND experiment-dependent
+            weight_bias = self.filter_bank(x) if fixed_filters is None else fixed_filters
+            filtered_x = x.view(1, -1, h, w)
+        n_groups = weight_bias.size(0)
         idx_beg = 0
         for i in range(len(k_list)):
             # Prepare filters
             n_weight = (n_arr[i] * k_arr[i] ** 2) * n_arr[i+1]
             n_bias = n_arr[i+1]
-            weight = weight_bias[:, idx_beg:idx_beg+n_weight].reshape(N * self.n_panels * n_arr[i+1], n_arr[i], k_arr[i], k_arr[i])
-            bias = weight_bias[:, idx_beg+n_weight:idx_beg+n_weight+n_bias].reshape(N * self.n_panels * n_arr[i+1],)
+            weight = weight_bias[:, idx_beg:idx_beg+n_weight].reshape(n_groups * n_arr[i+1], n_arr[i], k_arr[i], k_arr[i])
+            bias = weight_bias[:, idx_beg+n_weight:idx_beg+n_weight+n_bias].reshape(n_groups * n_arr[i+1],)
             idx_beg = idx_beg + n_weight + n_bias
             #
+            # functional pad / activation: no modules built at every call (same as nn.ReflectionPad2d, nn.LeakyReLU)
             pad = (k_arr[i] - 1) // 2
-            filtered_x = nn.ReflectionPad2d(pad)(filtered_x)
-            filtered_x = nn.functional.conv2d(filtered_x, weight, bias=bias, groups=N * self.n_panels)
-            filtered_x = NL(filtered_x)
+            filtered_x = F.pad(filtered_x, (pad, pad, pad, pad), mode="reflect")
+            if filtered_x.size(0) > 1:
+                filtered_x = F.conv2d(filtered_x, weight, bias=bias, groups=n_groups)
+            else:
+                # models pickled before dynamic_conv2d have no dynamic_conv
+                filtered_x = dynamic_conv2d(filtered_x, weight, bias, n_groups, getattr(self, "dynamic_conv", "auto"))
+            filtered_x = F.leaky_relu(filtered_x)
         return filtered_x
 
+    def input_is_downsampled(self, x):
+        # the data pipeline may have max-pooled the panels already (pool_in_loader)
+        return x.size(2) <= 185 // self.downsampling.kernel_size
+
     def forward(self, x, return_intermediate_act=False):
-        if self.downsample_bool:
+        if self.downsample_bool and not self.input_is_downsampled(x):
             x_ds = self.downsampling(x)
         else:
             x_ds = x
@@ -167,7 +193,7 @@ class AdaFilter_1(nn.Module):
             return logits_out
 
     def downsample_for_visualization(self, x):
-        if self.downsample_bool:
+        if self.downsample_bool and not self.input_is_downsampled(x):
             x_ds = self.downsampling(x)
         else:
             x_ds = x
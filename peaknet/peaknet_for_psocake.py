@@ -4,12 +4,20 @@ import json
 import torch
 import torch.optim as optim
 import torch.nn as nn
-from torch.utils.data import DataLoader
-from data import PSANAImageNoLabel, PSANADatasetNoLabel
+from torch.utils.data import DataLoader, BatchSampler
+from data import PSANAImageNoLabel, PSANADatasetNoLabel, PANEL_SHAPE, batch_loader, index_sampler
+from batch_ring import BatchRing, RingBatches, default_n_slots, ring_loader
 from unet import UNet
 from saver import Saver
+from run_pool import get_run_pool
+from frame_source import frames_exist
+from instrument import Timers
+from compiled import CompiledModel
+from fusion import fuse_for_inference
+from frozen_filters import FrozenFilters
 import shutil
 import argparse
+import time
 import h5py
 
 def evaluation_metrics(scores, y, cutoff=0.5):
@@ -29,12 +37,12 @@ def evaluation_metrics(scores, y, cutoff=0.5):
     metrics = {"recall": recall, "precision": precision}
     return metrics
 
-def check_existence(exp, run):
-    files = glob("/reg/d/psdm/cxi/{}/xtc/*{}*.xtc".format(exp, run))
-    return len(files) > 0
+def check_existence(exp, run, source="psana", frame_dir=None):
+    return frames_exist(exp, run, source=source, frame_dir=frame_dir)
 
 def peak_find(model, device, params):
     model.eval()
+    get_run_pool(max_open=params["max_open_runs"])
 
     eval_dataset = PSANADatasetNoLabel(params["run_dataset_path"], shuffle=True, n=params["n_experiments"])
     seen = 0
@@ -53,10 +61,30 @@ def peak_find(model, device, params):
 
     event_numbers = []
 
+    ring = None
+    if params["batch_ring"]:
+        n_slots = params["ring_slots"] if params["ring_slots"] > 0 else default_n_slots(params["num_workers"])
+        ring = BatchRing(n_slots, params["batch_size"], [PANEL_SHAPE])
+
     total_steps = 0
+    runner = CompiledModel(model, params["compile"])
+    warm_up_time = runner.warm_up(torch.zeros((params["batch_size"],) + PANEL_SHAPE, device=device))
+    if runner.mode != "eager":
+        print("Compiled (" + runner.mode + ") in " + str(warm_up_time) + " s.")
+    forward = runner
+    frozen_filters = None
+    if params["frozen_filters"] > 0:
+        if runner.mode == "trace":
+            raise ValueError("Frozen filters change the model's filters, which a trace would not see.")
+        frozen_filters = FrozenFilters(model, forward=runner, n_calibration=params["frozen_filters"],
+                                       refresh_every=params["refresh_every"],
+                                       drift_check_every=params["drift_check_every"],
+                                       drift_tolerance=params["drift_tolerance"], cutoff=params["cutoff_eval"])
+        forward = frozen_filters
+    timers = Timers(synchronize=params["sync_timers"])
     with torch.no_grad():
         for i, (exp, run) in enumerate(eval_dataset):
-            if check_existence(exp, run):
+            if check_existence(exp, run, params["frame_source"], params["frame_dir"]):
                 pass
             else:
                 print("[{:}] exp: {}  run: {}  PRECHECK FAILED".format(i, exp, run))
@@ -64,20 +92,45 @@ def peak_find(model, device, params):
             print("*********************************************************************")
             print("[{:}] exp: {}  run: {}".format(i, exp, run))
             print("*********************************************************************")
-            psana_images = PSANAImageNoLabel(exp, run)
-            data_loader = DataLoader(psana_images, batch_size=params["batch_size"], shuffle=True, drop_last=True,
-                                     num_workers=params["num_workers"])
-            for j, x in enumerate(data_loader):
+            psana_images = PSANAImageNoLabel(exp, run, source=params["frame_source"], frame_dir=params["frame_dir"],
+                                             mask_cache_dir=params["mask_cache_dir"])
+            if ring is not None:
+                batches = BatchSampler(index_sampler(psana_images, True, params["block_size"]), params["batch_size"],
+                                       drop_last=True)
+                data_loader = ring_loader(RingBatches(psana_images, batches, ring), num_workers=params["num_workers"])
+            else:
+                data_loader = batch_loader(psana_images, params["batch_size"], shuffle=True, drop_last=True,
+                                           num_workers=params["num_workers"], block_size=params["block_size"])
+            if frozen_filters is not None:
+                # calibrated on this run's first events
+                frozen_filters.start_run()
+            tic = time.time()
+            for j, batch in enumerate(data_loader):
+                timers.add("data wait", time.time() - tic)
+                if ring is not None:
+                    slot, n_batch = batch
+                    x, = ring.batch(slot, n_batch)
+                else:
+                    x = batch
                 n = x.size(0)
-                x = x.to(device)
-                scores = model(x)
+                with timers.time("h2d copy"):
+                    x = x.to(device)
+                with timers.time("forward"):
+                    scores = forward(x)
+                if ring is not None:
+                    ring.release(slot)
 
                 total_steps += 1
                 seen += n
 
                 ### Do smtg w/ scores here
                 event_numbers.append(j)
+                tic = time.time()
             psana_images.close()
+            print(timers.report("[{:}] exp: {}  run: {}  stages".format(i, exp, run)))
+            timers.reset()
+    if frozen_filters is not None:
+        print(frozen_filters.report())
 
     # Save cxi file
     print('')
@@ -111,6 +164,21 @@ def parse_args():
     p.add_argument("--n_per_run", type=int, default=-1)
     p.add_argument("--batch_size", type=int, default=5)
     p.add_argument("--num_workers", type=int, default=0)
+    p.add_argument("--max_open_runs", type=int, default=16, help="Run handles kept open per process")
+    p.add_argument("--block_size", type=int, default=1, help="Shuffle events by contiguous blocks (1: fully random)")
+    p.add_argument("--frame_source", type=str, default="psana", help="psana, or h5 for exported frames")
+    p.add_argument("--mask_cache_dir", type=str, default=None, help="Directory for the per-run pixel masks")
+    p.add_argument("--frame_dir", type=str, default=None, help="Directory of exported frames (h5 frame source)")
+    p.add_argument("--batch_ring", type=str, default="False", help="Workers fill shared-memory batch slots")
+    p.add_argument("--ring_slots", type=int, default=-1, help="Slots of the batch ring (-1: from num_workers)")
+    p.add_argument("--compile", type=str, default="eager", help="eager, compile (torch.compile) or trace (TorchScript)")
+    p.add_argument("--fuse", type=str, default="False", help="Fold BatchNorm and pads into the convolutions")
+    p.add_argument("--frozen_filters", type=int, default=0,
+                   help="AdaFilter_1: events per run to calibrate frozen adaptive filters on (0: per-event filters)")
+    p.add_argument("--refresh_every", type=int, default=0, help="Events between recalibrations (0: never)")
+    p.add_argument("--drift_check_every", type=int, default=0, help="Events between drift checks (0: never)")
+    p.add_argument("--drift_tolerance", type=float, default=0.05, help="Relative filter drift that recalibrates")
+    p.add_argument("--sync_timers", type=str, default="False", help="Synchronize CUDA around each timed stage")
     p.add_argument("--verbose", type=str, default="True")
     ### Downsample is 1 for now
 
@@ -130,6 +198,8 @@ def main():
         device = torch.device("cpu")
 
     model = model.to(device)
+    if args.fuse == "True":
+        model = fuse_for_inference(model)
 
     params = {}
     params["run_dataset_path"] = args.run_dataset_path
@@ -141,6 +211,25 @@ def main():
     params["n_per_run"] = args.n_per_run
     params["batch_size"] = args.batch_size
     params["num_workers"] = args.num_workers
+    params["max_open_runs"] = args.max_open_runs
+    params["block_size"] = args.block_size
+    params["frame_source"] = args.frame_source
+    params["frame_dir"] = args.frame_dir
+    params["mask_cache_dir"] = args.mask_cache_dir
+    if args.batch_ring == "True":
+        params["batch_ring"] = True
+    else:
+        params["batch_ring"] = False
+    params["ring_slots"] = args.ring_slots
+    params["compile"] = args.compile
+    params["frozen_filters"] = args.frozen_filters
+    params["refresh_every"] = args.refresh_every
+    params["drift_check_every"] = args.drift_check_every
+    params["drift_tolerance"] = args.drift_tolerance
+    if args.sync_timers == "True":
+        params["sync_timers"] = True
+    else:
+        params["sync_timers"] = False
     if args.verbose == "True":
         params["verbose"] = True
     else:
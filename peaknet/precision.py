@@ -0,0 +1,55 @@
+import contextlib
+import torch
+
+
+def autocast_dtype(precision, device):
+    # None: full precision
+    if precision == "fp32":
+        return None
+    if precision == "amp":
+        return torch.float16 if device.type == "cuda" else torch.bfloat16
+    if precision == "bf16":
+        return torch.bfloat16
+    if precision == "fp16":
+        return torch.float16
+    raise ValueError("Unrecognized precision " + str(precision) + " (fp32, amp, bf16 or fp16).")
+
+
+def grad_scaler(enabled):
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+class MixedPrecision(object):
+    """
+    Runs the forward passes under autocast: "amp" is bfloat16 on CPU and float16 on CUDA. The losses take
+    the scores back to float32, so the loss and pos_weight arithmetic stays in full precision. float16 losses
+    are scaled (GradScaler) so that small gradients do not underflow; bfloat16 has the range of float32 and
+    is not scaled. With "fp32" every method falls back to the plain calls.
+    """
+
+    def __init__(self, precision, device):
+        self.device = torch.device(device)
+        self.dtype = autocast_dtype(precision, self.device)
+        self.scaler = grad_scaler(self.dtype == torch.float16 and self.device.type == "cuda")
+
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        # skipped by the scaler if the gradients overflowed, and the scale is lowered
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state):
+        if state:
+            self.scaler.load_state_dict(state)
@@ -0,0 +1,103 @@
+import time
+import threading
+import queue
+from collections import deque
+import torch
+
+
+class Prefetcher(object):
+    """
+    Iterates over batches with the next n_prefetch of them already prepared (reshaped and on the device)
+    by prepare(batch, non_blocking). On a CUDA device the copies are issued on a side stream from pinned
+    memory; otherwise a background thread prepares them. n_prefetch = 0 prepares each batch in line.
+    Keeps the time the trainer waited for data and the time it spent between batches (compute); the waits
+    are also added to timers (instrument.Timers) as "data wait", if given.
+    """
+
+    def __init__(self, batches, prepare, device, n_prefetch=2, timers=None):
+        self.batches = batches
+        self.prepare = prepare
+        self.device = torch.device(device)
+        self.n_prefetch = n_prefetch
+        self.timers = timers
+        self.wait_time = 0.
+        self.compute_time = 0.
+        self.n_batches = 0
+
+    def __iter__(self):
+        if self.n_prefetch <= 0:
+            it = self.iter_inline()
+        elif self.device.type == "cuda":
+            it = self.iter_cuda()
+        else:
+            it = self.iter_thread()
+        tic = time.time()
+        while True:
+            batch = next(it, None)
+            toc = time.time()
+            self.wait_time += toc - tic
+            if self.timers is not None:
+                self.timers.add("data wait", toc - tic)
+            if batch is None:
+                return
+            yield batch
+            tic = time.time()
+            self.compute_time += tic - toc
+            self.n_batches += 1
+
+    def iter_inline(self):
+        for batch in self.batches:
+            yield self.prepare(batch, False)
+
+    def iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+        prepared = deque()
+        batches = iter(self.batches)
+        while True:
+            while len(prepared) < self.n_prefetch:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                with torch.cuda.stream(stream):
+                    batch = self.prepare(batch, True)
+                event = torch.cuda.Event()
+                event.record(stream)
+                prepared.append((batch, event))
+            if not prepared:
+                return
+            batch, event = prepared.popleft()
+            torch.cuda.current_stream(self.device).wait_event(event)
+            for t in batch if isinstance(batch, (list, tuple)) else [batch]:
+                if isinstance(t, torch.Tensor) and t.is_cuda:
+                    # allocated on the side stream, used on the default one
+                    t.record_stream(torch.cuda.current_stream(self.device))
+            yield batch
+
+    def iter_thread(self):
+        prepared = queue.Queue(maxsize=self.n_prefetch)
+        done = object()
+
+        def worker():
+            try:
+                for batch in self.batches:
+                    prepared.put(self.prepare(batch, False))
+            except Exception as e:
+                prepared.put(e)
+            prepared.put(done)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        while True:
+            batch = prepared.get()
+            if batch is done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+        thread.join()
+
+    def report(self):
+        total = max(1e-12, self.wait_time + self.compute_time)
+        return "data wait {:.1f} s ({:.1f}%) ; compute {:.1f} s ; {} batches{}".format(
+            self.wait_time, 100. * self.wait_time / total, self.compute_time, self.n_batches,
+            " ; input-bound" if self.wait_time > self.compute_time else "")
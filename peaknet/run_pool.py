@@ -0,0 +1,67 @@
+import os
+from collections import OrderedDict
+
+
+class RunPool(object):
+    """
+    Per-process LRU pool of opened run handles (frame sources, CXI label files).
+    Handles are reference counted and only idle ones are closed, least recently used first, once more than
+    max_open are open. Event-time tables outlive their handle so that re-opening a run does not call times().
+    """
+
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self.handles = OrderedDict()  # key -> [handle, number of users]
+        self.times = {}
+        self.n_opened = 0
+        self.n_reused = 0
+
+    def acquire(self, key, opener):
+        if key in self.handles:
+            entry = self.handles[key]
+            self.handles.move_to_end(key)
+            entry[1] += 1
+            self.n_reused += 1
+            return entry[0]
+        handle = opener()
+        self.handles[key] = [handle, 1]
+        self.n_opened += 1
+        self.evict()
+        return handle
+
+    def release(self, key):
+        if key in self.handles:
+            self.handles[key][1] -= 1
+        self.evict()
+
+    def evict(self):
+        while len(self.handles) > self.max_open:
+            idle = next((key for key, entry in self.handles.items() if entry[1] <= 0), None)
+            if idle is None:
+                break
+            handle, _ = self.handles.pop(idle)
+            handle.close()
+
+    def close(self):
+        for handle, _ in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+
+_pools = {}
+
+
+def get_run_pool(max_open=None):
+    # one pool per process: forked DataLoader workers start with empty handles but keep the time tables
+    pid = os.getpid()
+    if pid not in _pools:
+        pool = RunPool()
+        for parent in _pools.values():
+            pool.max_open = parent.max_open
+            pool.times.update(parent.times)
+        _pools.clear()
+        _pools[pid] = pool
+    pool = _pools[pid]
+    if max_open is not None:
+        pool.max_open = max_open
+    return pool
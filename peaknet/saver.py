@@ -18,7 +18,8 @@ class Saver():
         if self.saver_type == "precision_recall":
             self.content["precision"].append(float(metrics["precision"]))
             self.content["recall"].append(float(metrics["recall"]))
-            self.content["loss"].append(float(metrics["loss"].data.cpu()))
+            # a tensor, or a float already brought to the host by metrics.MetricsAccumulator
+            self.content["loss"].append(float(metrics["loss"]))
         elif self.saver_type == "precision_recall_evaluation":
             self.content["precision"].append(float(metrics["precision"]))
             self.content["recall"].append(float(metrics["recall"]))
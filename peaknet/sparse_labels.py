@@ -0,0 +1,131 @@
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+def pack_peaks(s, r, c, n_panels):
+    # (n, 3) float64 rows of (panel, row, col) grouped by panel, and the number of peaks per panel
+    s = np.asarray(s).astype(np.int64)
+    r = np.asarray(r, dtype=np.float64)
+    c = np.asarray(c, dtype=np.float64)
+    keep = (s >= 0) & (s < n_panels)
+    s, r, c = s[keep], r[keep], c[keep]
+    # stable, so that peaks falling into the same pixel keep their order ("last peak wins")
+    order = np.argsort(s, kind="stable")
+    peaks = np.stack((s.astype(np.float64), r, c), axis=1)[order]
+    counts = np.bincount(s, minlength=n_panels)
+    return torch.from_numpy(peaks), torch.from_numpy(counts)
+
+
+class SparseLabel(object):
+    """
+    The peaks of one sample as coordinate lists instead of a dense (n_panels, n_channels, h, w) label.
+    The channel layout follows n_channels as in PSANAImage.label_shape: 1 (or 2 with indexed peaks) confidence
+    channels, or 3 (or 6) channels including the sub-pixel offsets.
+    """
+
+    def __init__(self, label_shape, downsample, s, r, c, s_idxg=None, r_idxg=None, c_idxg=None):
+        self.label_shape = tuple(label_shape)
+        self.downsample = downsample
+        self.peaks, self.counts = pack_peaks(s, r, c, self.label_shape[0])
+        self.idxg_peaks, self.idxg_counts = None, None
+        if s_idxg is not None:
+            self.idxg_peaks, self.idxg_counts = pack_peaks(s_idxg, r_idxg, c_idxg, self.label_shape[0])
+
+
+def pad_peaks(peaks_list, counts_list):
+    n_max = max([len(peaks) for peaks in peaks_list] + [1])
+    peaks = torch.zeros(len(peaks_list), n_max, 3, dtype=torch.float64)
+    for k, p in enumerate(peaks_list):
+        peaks[k, :len(p)] = p
+    return peaks, torch.stack(counts_list)
+
+
+class SparseLabels(object):
+    """
+    A batch of SparseLabel: zero-padded (B, n_max, 3) peak lists and (B, n_panels) per-panel counts.
+    to_dense() renders the (B * n_panels, n_channels, h, w) targets on the target device, equal to the
+    labels rendered by PSANAImage.render_label (see data.rasterize_peaks).
+    """
+
+    def __init__(self, label_shape, downsample, peaks, counts, idxg_peaks=None, idxg_counts=None):
+        self.label_shape = tuple(label_shape)
+        self.downsample = downsample
+        self.peaks = peaks
+        self.counts = counts
+        self.idxg_peaks = idxg_peaks
+        self.idxg_counts = idxg_counts
+
+    @staticmethod
+    def collate(labels):
+        peaks, counts = pad_peaks([label.peaks for label in labels], [label.counts for label in labels])
+        idxg_peaks, idxg_counts = None, None
+        if labels[0].idxg_peaks is not None:
+            idxg_peaks, idxg_counts = pad_peaks([label.idxg_peaks for label in labels],
+                                                [label.idxg_counts for label in labels])
+        return SparseLabels(labels[0].label_shape, labels[0].downsample, peaks, counts, idxg_peaks, idxg_counts)
+
+    def __len__(self):
+        return self.peaks.size(0)
+
+    def apply(self, fn):
+        idxg_peaks = None if self.idxg_peaks is None else fn(self.idxg_peaks)
+        idxg_counts = None if self.idxg_counts is None else fn(self.idxg_counts)
+        return SparseLabels(self.label_shape, self.downsample, fn(self.peaks), fn(self.counts),
+                            idxg_peaks, idxg_counts)
+
+    def to(self, device, non_blocking=False):
+        return self.apply(lambda t: t.to(device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        # called by DataLoader(pin_memory=True)
+        return self.apply(lambda t: t.pin_memory())
+
+    def rasterize(self, out, peaks, counts, channel, with_offsets):
+        # one scatter for the whole batch into out, a (B * n_panels, n_channels, h, w) tensor
+        n_panels, n_channels, h, w = self.label_shape
+        B, n_max, _ = peaks.shape
+        valid = torch.arange(n_max, device=peaks.device)[None, :] < counts.sum(1)[:, None]
+        b = torch.arange(B, device=peaks.device)[:, None].expand(B, n_max)[valid]
+        p = peaks[valid]
+        s = p[:, 0].long()
+        r_ds = p[:, 1] / float(self.downsample)
+        c_ds = p[:, 2] / float(self.downsample)
+        u = torch.floor(r_ds).long()
+        v = torch.floor(c_ds).long()
+        keep = (u >= 0) & (u < h) & (v >= 0) & (v < w)
+        if not keep.any():
+            return out
+        b, s, u, v, r_ds, c_ds = b[keep], s[keep], u[keep], v[keep], r_ds[keep], c_ds[keep]
+        pixel = (b * n_panels + s) * (h * w) + u * w + v
+        # only the last peak falling into a pixel is written
+        order = torch.arange(len(pixel), device=pixel.device)
+        last = torch.full((B * n_panels * h * w,), -1, dtype=torch.long, device=pixel.device)
+        last = last.scatter_reduce(0, pixel, order, reduce="amax")
+        winner = last[pixel] == order
+        pixel, r_ds, c_ds = pixel[winner], r_ds[winner], c_ds[winner]
+        # pixel index -> index into the channel-major (B * n_panels, n_channels, h, w) layout
+        base = (pixel // (h * w)) * (n_channels * h * w) + pixel % (h * w)
+        flat = out.view(-1)
+        flat[base + channel * h * w] = 1
+        if with_offsets:
+            flat[base + (channel + 1) * h * w] = torch.fmod(r_ds, 1.0).to(out.dtype)
+            flat[base + (channel + 2) * h * w] = torch.fmod(c_ds, 1.0).to(out.dtype)
+        return out
+
+    def to_dense(self, device=None):
+        labels = self if device is None else self.to(device)
+        n_panels, n_channels, h, w = self.label_shape
+        out = torch.zeros(len(self) * n_panels, n_channels, h, w, device=labels.peaks.device)
+        with_offsets = n_channels >= 3
+        labels.rasterize(out, labels.peaks, labels.counts, 0, with_offsets)
+        if labels.idxg_peaks is not None:
+            channel = 3 if with_offsets else 1
+            labels.rasterize(out, labels.idxg_peaks, labels.idxg_counts, channel, with_offsets)
+        return out
+
+
+def collate_sparse(batch):
+    # collate_fn for (img, SparseLabel, n_trials) samples
+    imgs, labels, n_trials = zip(*batch)
+    return default_collate(list(imgs)), SparseLabels.collate(labels), default_collate(list(n_trials))
@@ -8,12 +8,26 @@ import json
 import torch
 import torch.optim as optim
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
-from data import PSANADataset, PSANAImage
+from data import PSANADataset, PSANAImage, PSANAStream, sample_shapes
+from batch_ring import BatchRing, RingStream, default_n_slots, ring_loader
+from prefetcher import Prefetcher
+from metrics import MetricsAccumulator
+from precision import MixedPrecision
+from compiled import CompiledModel
+from instrument import Timers, ProfilerWindow
+from checkpoint import CheckpointWriter, rng_state, set_rng_state, load_checkpoint, check_resume_params
+from distributed import get_rank, get_world_size, is_main, init_distributed, launched_with_env, launch_local, \
+    local_rank, all_true, broadcast_object, gather_object, barrier, balanced_shards, cleanup
 from unet import UNet
 from models import AdaFilter_0, AdaFilter_1, AdaFilter_2
 from loss import PeaknetBCELoss, PeakNetBCE1ChannelLoss
 from saver import Saver
+from sparse_labels import SparseLabels, collate_sparse
+from frame_source import frames_exist
+from image_cache import ImageCache
+from run_pool import get_run_pool
 import visualize
 import shutil
 import argparse
@@ -21,19 +35,23 @@ import time
 import numpy as np
 
 
-def check_existence(exp, run):
-    files = glob("/reg/d/psdm/cxi/{}/xtc/*{}*.xtc".format(exp, run))
-    return len(files) > 0
+def check_existence(exp, run, source="psana", frame_dir=None):
+    return frames_exist(exp, run, source=source, frame_dir=frame_dir)
 
 
 def train(model, device, params, writer):
+    # in distributed training (see distributed), rank 0 alone logs, uploads, visualizes and checkpoints;
+    # writer is None on the other ranks
     model.train()
+    rank, world_size = get_rank(), get_world_size()
+    main_rank = is_main()
 
     print("")
 
-    print("*** Parameters ***")
-    for key, value in params.items():
-        print(str(key) + ' : ' + str(value))
+    if main_rank:
+        print("*** Parameters ***")
+        for key, value in params.items():
+            print(str(key) + ' : ' + str(value))
 
     print('')
     print(f"Will show intermediate activation: {getattr(model, 'can_show_inter_act', 'Not available')}.")
@@ -44,104 +62,301 @@ def train(model, device, params, writer):
         print("Unrecognized number of classes for loss function.")
         return
 
-    saver = Saver(params["saver_type"], params)
+    saver = Saver(params["saver_type"] if main_rank else None, params)
+    get_run_pool(max_open=params["max_open_runs"])
+
+    image_cache = None
+    if params["image_cache_dir"] is not None:
+        image_cache = ImageCache(params["image_cache_dir"], max_gb=params["image_cache_gb"],
+                                 dtype=params["image_cache_dtype"])
 
     train_dataset = PSANADataset(params["run_dataset_path"], subset="train", shuffle=False, n=params["n_experiments"])
     optimizer = optim.Adam(model.parameters(), lr=params["lr"], weight_decay=params["weight_decay"])
+    precision = MixedPrecision(params["precision"], device)
     # print("train_dataset", len(train_dataset))
 
-    # Preloading for visualization
-    idx_experiment_visualization = 0
-    cxi_path_vis, exp_vis, run_vis = train_dataset[idx_experiment_visualization]
-    psana_images_vis = PSANAImage(cxi_path_vis, exp_vis, run_vis, downsample=params["downsample"],
-                                  n=params["n_per_run"], min_det_peaks=params["min_det_peaks"],
-                                  use_indexed_peaks=params["use_indexed_peaks"],
-                                  n_classes = params["n_classes"])
-    idx_event_visualization = len(psana_images_vis) // 2
-    print('')
-    print('Loading image for visualization...')
-    img_vis, target_vis, _ = psana_images_vis[idx_event_visualization]
-    print("nPeaks visualization: " + str(len(np.nonzero(target_vis[:, 0, :, :]))))
-    if params["use_indexed_peaks"]:
-        print("nIndexedPeaks visualization: " + str(len(np.nonzero(target_vis[:, 1, :, :]))))
+    checkpoint = None
+    rank_state = None
+    if params["resume"] is not None:
+        print('')
+        print("Resuming from " + params["resume"] + "...")
+        checkpoint = load_checkpoint(params["resume"])
+        check_resume_params(checkpoint["params"], params)
+        # same runs, in the same order, as the interrupted job
+        train_dataset.select(checkpoint["run_index"])
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        loss_func.load_schedule_state(checkpoint["loss"])
+        precision.load_state_dict(checkpoint.get("scaler"))
+        if checkpoint["saver"] is not None:
+            saver.content = checkpoint["saver"]
+        # rng and counters of this rank
+        rank_state = {"rng": checkpoint["rng"], "seen_and_missed": checkpoint["seen_and_missed"]}
+        if len(checkpoint.get("ranks", [rank_state])) != world_size:
+            raise ValueError("The checkpoint was written by " + str(len(checkpoint["ranks"])) + " ranks, not " +
+                             str(world_size) + ".")
+        if "ranks" in checkpoint:
+            rank_state = checkpoint["ranks"][rank]
 
+    # Preloading for visualization
+    visualizer = None
+    if main_rank:
+        idx_experiment_visualization = 0
+        cxi_path_vis, exp_vis, run_vis = train_dataset[idx_experiment_visualization]
+        psana_images_vis = PSANAImage(cxi_path_vis, exp_vis, run_vis, downsample=params["downsample"],
+                                      n=params["n_per_run"], min_det_peaks=params["min_det_peaks"],
+                                      min_indexed_peaks=params["min_indexed_peaks"],
+                                      use_indexed_peaks=params["use_indexed_peaks"],
+                                      n_classes = params["n_classes"], label_cache_dir=params["label_cache_dir"],
+                                      image_cache=image_cache, source=params["frame_source"],
+                                      frame_dir=params["frame_dir"], mask_cache_dir=params["mask_cache_dir"],
+                                      pool_in_loader=params["pool_in_loader"])
+        idx_event_visualization = len(psana_images_vis) // 2
+        print('')
+        print('Loading image for visualization...')
+        img_vis, target_vis, _ = psana_images_vis[idx_event_visualization]
+        print("nPeaks visualization: " + str(len(np.nonzero(target_vis[:, 0, :, :]))))
+        if params["use_indexed_peaks"]:
+            print("nIndexedPeaks visualization: " + str(len(np.nonzero(target_vis[:, 1, :, :]))))
+        if params["async_visualization"]:
+            visualizer = visualize.AsyncVisualizer(model, img_vis, target_vis, params, writer.get_logdir())
+
+    # checkpoints keep the order of all the runs, each rank trains on its own share of them
+    run_index = list(train_dataset.df.index)
+    net = model
+    if world_size > 1:
+        # rank 0's order (n_experiments samples runs at random), and event counts to balance the shards
+        run_index, counts = broadcast_object(
+            (run_index, train_dataset.event_counts(params["n_per_run"], params["min_det_peaks"],
+                                                   params["min_indexed_peaks"], params["use_indexed_peaks"]))
+            if main_rank else None)
+        # from the whole run table: the other ranks sampled their own runs
+        train_dataset.select(run_index)
+        shards, loads = balanced_shards(counts, world_size)
+        if min(len(shard) for shard in shards) == 0:
+            raise ValueError("Fewer runs (" + str(len(counts)) + ") than ranks (" + str(world_size) + ").")
+        train_dataset.shard(shards[rank])
+        print("Rank " + str(rank) + ": " + str(len(shards[rank])) + " runs, " + str(loads[rank]) + " events (" +
+              str(min(loads)) + " to " + str(max(loads)) + " across ranks).")
+        # an AdaFilter_1 without adaptive filtering leaves its encoder out of the graph
+        net = DistributedDataParallel(model, device_ids=[device] if device.type == "cuda" else None,
+                                      find_unused_parameters=getattr(model, "adaptive_filtering", True) is False)
+    if params["compile"] == "trace":
+        raise ValueError("Traces are for inference (evaluate.py, peaknet_for_psocake.py), train with compile.")
+    # model keeps the weights and is what gets saved, net only runs the steps
+    net = CompiledModel(net, params["compile"])
+    img_shape = sample_shapes(params["downsample"], params["n_classes"], params["use_indexed_peaks"],
+                              params["pool_in_loader"])[0]
+    with precision.autocast():
+        warm_up_time = net.warm_up(torch.zeros((params["batch_size"],) + tuple(img_shape), device=device))
+    if main_rank and net.mode != "eager":
+        print("Compiled (" + net.mode + ") in " + str(warm_up_time) + " s.")
+
+
+    image_kwargs = {"downsample": params["downsample"], "n": params["n_per_run"],
+                    "min_det_peaks": params["min_det_peaks"], "min_indexed_peaks": params["min_indexed_peaks"],
+                    "use_indexed_peaks": params["use_indexed_peaks"],
+                    "n_classes": params["n_classes"], "label_cache_dir": params["label_cache_dir"],
+                    "image_cache": image_cache, "source": params["frame_source"], "frame_dir": params["frame_dir"],
+                    "mask_cache_dir": params["mask_cache_dir"], "pool_in_loader": params["pool_in_loader"],
+                    "sparse_labels": params["sparse_labels"]}
+    train_stream = PSANAStream(train_dataset, image_kwargs, n_open_runs=params["n_open_runs"],
+                               shuffle_buffer=params["shuffle_buffer"], shuffle=True,
+                               block_size=params["block_size"])
+    # persistent workers keep their opened runs (see run_pool) from one epoch to the next
+    ring = None
+    if params["batch_ring"]:
+        if params["sparse_labels"]:
+            raise ValueError("The batch ring holds dense labels, it cannot be used with sparse labels.")
+        n_slots = params["ring_slots"]
+        if n_slots <= 0:
+            # the prefetcher holds slots too
+            n_slots = default_n_slots(params["num_workers"]) + params["prefetch"]
+        ring = BatchRing(n_slots, params["batch_size"],
+                         sample_shapes(params["downsample"], params["n_classes"], params["use_indexed_peaks"],
+                                       params["pool_in_loader"]))
+        data_loader = ring_loader(RingStream(train_stream, ring, drop_last=True), num_workers=params["num_workers"],
+                                  persistent_workers=True)
+    else:
+        data_loader = DataLoader(train_stream, batch_size=params["batch_size"], drop_last=True,
+                                 num_workers=params["num_workers"], persistent_workers=params["num_workers"] > 0,
+                                 collate_fn=collate_sparse if params["sparse_labels"] else None,
+                                 pin_memory=device.type == "cuda")
+
+    # per-stage times, reported at the end of each epoch (exact with --sync_timers True)
+    timers = Timers(synchronize=params["sync_timers"])
+    # the copies are prepared by the prefetcher (its thread, or a side stream) while the step runs: timed apart
+    copy_timers = Timers()
+    profiler = ProfilerWindow(params["profile_start"], params["profile_stop"],
+                              "debug/{}/trace_{}{}.json".format(params["experiment_name"], params["profile_start"],
+                                          "_rank" + str(rank) if world_size > 1 else ""))
+
+    def prepare(batch, non_blocking):
+        # reshaped and moved to the device ahead of the step by the prefetcher
+        slot = None
+        if ring is not None:
+            slot, n_batch = batch
+            batch = ring.batch(slot, n_batch)
+        x, y, n_trials = batch
+        if not isinstance(y, SparseLabels):
+            y = y.view(-1, y.size(2), y.size(3), y.size(4))
+        # overlaps the step when prefetching
+        with copy_timers.time("h2d copy"):
+            return slot, x.to(device, non_blocking=non_blocking), y.to(device, non_blocking=non_blocking), n_trials
+
+    checkpoint_path = "debug/" + params["experiment_name"] + "/checkpoint.pt"
+    checkpoint_writer = None
+    if main_rank:
+        checkpoint_writer = CheckpointWriter(keep_last=params["keep_checkpoints"])
+
+    def save_training_state(epoch, n_batches):
+        # called by every rank
+        state = checkpoint_state(epoch, n_batches)
+        if main_rank:
+            numbered_path = "debug/{}/checkpoint_{:010d}.pt".format(params["experiment_name"], total_steps)
+            checkpoint_writer.submit(state, numbered_path, link=checkpoint_path)
+
+    def checkpoint_state(epoch, n_batches):
+        # everything needed to continue with the next batch: see --resume
+        ranks = gather_object({"rng": rng_state(), "seen_and_missed": seen_and_missed})
+        return {"model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                "loss": loss_func.schedule_state(), "scaler": precision.state_dict(),
+                "saver": getattr(saver, "content", None), "run_index": run_index, "epoch": epoch,
+                "n_batches": n_batches, "seen": seen, "seen_and_missed": seen_and_missed, "total_steps": total_steps,
+                "rng": ranks[0]["rng"], "ranks": ranks, "params": params}
 
     total_steps = 0
     seen = 0
     seen_and_missed = 0
-    for epoch in range(params["n_epochs"]):
+    start_epoch = 0
+    n_batches = 0
+    accumulator = MetricsAccumulator()
+    if checkpoint is not None:
+        total_steps = checkpoint["total_steps"]
+        seen = checkpoint["seen"]
+        seen_and_missed = rank_state["seen_and_missed"]
+        start_epoch = checkpoint["epoch"]
+        n_batches = checkpoint["n_batches"]
+        set_rng_state(rank_state["rng"])
+        # the stream skips the samples of the batches already done, without loading them
+        train_stream.set_resume(start_epoch, n_batches, params["batch_size"], params["num_workers"])
+        print("Resuming at epoch " + str(start_epoch) + ", batch " + str(n_batches) + ", seen " + str(seen) + ".")
+    for epoch in range(start_epoch, params["n_epochs"]):
         print("")
         print("*** Epoch "+str(epoch)+" ***")
         print("")
-        for i, (cxi_path, exp, run) in enumerate(train_dataset):
-            #if os.path.isfile("good_cxi/{}_{}".format(exp, run)):
-            #    pass
-            #else:
-            #    continue
-            if check_existence(exp, run):
-                pass
-            else:
-                print("[{:}] exp: {}  run: {}  PRECHECK FAILED".format(i, exp, run))
-                continue
-            print("*********************************************************************")
-            print("[{:}] exp: {}  run: {}\ncxi: {}".format(i, exp, run, cxi_path))
-            print("*********************************************************************")
-            psana_images = PSANAImage(cxi_path, exp, run, downsample=params["downsample"], n=params["n_per_run"],
-                                      min_det_peaks=params["min_det_peaks"], use_indexed_peaks=params["use_indexed_peaks"],
-                                      n_classes = params["n_classes"])
-            data_loader = DataLoader(psana_images, batch_size=params["batch_size"], shuffle=True, drop_last=True,
-                                     num_workers=params["num_workers"])
-            for j, (x, y, n_trials) in enumerate(data_loader):
-                tic = time.time()
-                optimizer.zero_grad()
-                n = x.size(0)
-                seen += n
-                seen_and_missed += n_trials.sum().item()
-                y = y.view(-1, y.size(2), y.size(3), y.size(4))
-                x = x.to(device)
-                y = y.to(device)
-
-                scores = model(x)
+        train_stream.set_epoch(epoch)
+        prefetcher = Prefetcher(data_loader, prepare, device, n_prefetch=params["prefetch"], timers=timers)
+        batches = iter(prefetcher)
+        while True:
+            batch = next(batches, None)
+            # all ranks take the same number of steps: they stop together at the end of the shortest shard
+            if not all_true(batch is not None):
+                break
+            slot, x, y, n_trials = batch
+            profiler.step(total_steps)
+            tic = time.time()
+            optimizer.zero_grad()
+            n = x.size(0)
+            seen += n
+            n_batches += 1
+            seen_and_missed += n_trials.sum().item()
+
+            with timers.time("forward"):
+                with precision.autocast():
+                    scores = net(x)
+            # outside autocast: the loss is kept in float32
+            with timers.time("loss"):
                 metrics = loss_func(scores, y, verbose=params["verbose"], cutoff=params["cutoff"])
-                loss = metrics["loss"]
-
-                visualize.scalar_metrics(writer, metrics, total_steps)
-                total_steps += 1
-
-                loss.backward()
-                optimizer.step()
-                with torch.no_grad():
-                    if seen % params["print_every"] == 0:
-                        toc = time.time()
-                        print(str((toc - tic) / params["batch_size"] * 1e3) + " ms per sample")
-                        print_str = "seen " + str(seen) + " ; "
-                        ratio_real_hits = seen / seen_and_missed
-                        print_str += "ratio used " + str(ratio_real_hits) + " ; "
-                        for (key, value) in metrics.items():
-                            if key == "loss":
-                                print_str += key + " " + str(float(value.data.cpu())) + " ; "
-                            else:
-                                print_str += key + " " + str(value) + " ; "
-                        print(print_str)
-                    if seen % params["upload_every"] == 0:
-                        saver.upload(metrics, params["save_name"])
-                    if seen % (params["backup_every"]) == 0:
-                        print('---')
-                        print("Backing up...")
-                        backup_path = "debug/"+params["experiment_name"]+"/model.pt"
-                        torch.save(model.state_dict(), backup_path)
-                        print("Model has been backed up at " + backup_path +".")
+            loss = metrics["loss"]
+
+            if params["debug_metrics"]:
+                if main_rank:
+                    visualize.scalar_metrics(writer, metrics, total_steps)
+            else:
+                # stays on the device until the next print / upload
+                accumulator.add(metrics)
+            total_steps += 1
+
+            with timers.time("backward"):
+                precision.backward(loss)
+            with timers.time("optimizer step"):
+                precision.step(optimizer)
+            if ring is not None:
+                # the step is done with the slot's tensors, the workers can refill it
+                ring.release(slot)
+            with torch.no_grad():
+                if not params["debug_metrics"] and (seen % params["print_every"] == 0 or
+                                                    seen % params["upload_every"] == 0):
+                    # reduced across the ranks
+                    metrics = accumulator.values()
+                    if main_rank:
+                        visualize.scalar_metrics(writer, metrics, total_steps - 1)
+                if seen % params["print_every"] == 0 and main_rank:
+                    toc = time.time()
+                    print(str((toc - tic) / params["batch_size"] * 1e3) + " ms per sample")
+                    print(prefetcher.report())
+                    print_str = "seen " + str(seen * world_size) + " ; "
+                    ratio_real_hits = seen / seen_and_missed
+                    print_str += "ratio used " + str(ratio_real_hits) + " ; "
+                    for (key, value) in metrics.items():
+                        print_str += key + " " + str(float(value)) + " ; "
+                    print(print_str)
+                if seen % params["upload_every"] == 0:
+                    saver.upload(metrics, params["save_name"])
+                if seen % (params["backup_every"]) == 0:
+                    backup_path = "debug/"+params["experiment_name"]+"/model.pt"
+                    # snapshots only, the files are written in the background
+                    with timers.time("checkpoint"):
+                        if main_rank:
+                            print('---')
+                            print("Backing up...")
+                            checkpoint_writer.submit(model.state_dict(), backup_path)
+                        save_training_state(epoch, n_batches)
+                    if main_rank:
+                        print("Model is being backed up at " + backup_path +", training state at " +
+                              checkpoint_path + ".")
+                        print(checkpoint_writer.report())
                         print('---')
-                    if seen % params["show_image_every"] == 0:
-                        visualize.show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params, device,
-                                                           model, use_indexed_peaks=params["use_indexed_peaks"])
-                        # visualize.show_weights_model(writer, model, total_steps)
-                        if hasattr(model, 'can_show_inter_act') and model.can_show_inter_act:
-                            visualize.show_inter_act(writer, img_vis, total_steps, params, device, model)
-            psana_images.close()
+                if seen % params["show_image_every"] == 0 and main_rank:
+                    with timers.time("visualization"):
+                        if visualizer is not None:
+                            # rendered and logged by the side process
+                            visualizer.submit(model, total_steps)
+                        else:
+                            visualize.show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params,
+                                                               device, model,
+                                                               use_indexed_peaks=params["use_indexed_peaks"])
+                            # visualize.show_weights_model(writer, model, total_steps)
+                            if hasattr(model, 'can_show_inter_act') and model.can_show_inter_act:
+                                visualize.show_inter_act(writer, img_vis, total_steps, params, device, model)
+        if batch is not None:
+            # other ranks ran out first: the rest of this shard is drained, so that the persistent workers start
+            # the next epoch afresh and the ring slots are all released
+            if ring is not None:
+                ring.release(batch[0])
+            for rest in batches:
+                if ring is not None:
+                    ring.release(rest[0])
+        rank_str = "Rank " + str(rank) + " " if world_size > 1 else ""
+        print(rank_str + "Epoch " + str(epoch) + " input pipeline: " + prefetcher.report())
+        print(timers.report(rank_str + "Epoch " + str(epoch) + " stages"))
+        print(copy_timers.report(rank_str + "Epoch " + str(epoch) + " prefetch (overlapped with the stages)"))
+        timers.reset()
+        copy_timers.reset()
+        n_batches = 0
+        save_training_state(epoch + 1, 0)
+    profiler.close()
     saver.save(params["save_name"])
-    torch.save(model, "debug/"+params["experiment_name"]+"/model.pt")
-    print("Model saved at " + "debug/"+params["experiment_name"]+"/model.pt.")
+    if visualizer is not None:
+        visualizer.close()
+        print("Visualization: " + str(visualizer.n_submitted) + " rendered, " + str(visualizer.n_skipped) +
+              " skipped while busy.")
+    if main_rank:
+        checkpoint_writer.close()
+        print(checkpoint_writer.report())
+        torch.save(model, "debug/"+params["experiment_name"]+"/model.pt")
+        print("Model saved at " + "debug/"+params["experiment_name"]+"/model.pt.")
 
 
 def parse_args():
@@ -150,6 +365,10 @@ def parse_args():
 
     # System parameters
     p.add_argument("--gpu", "-g", type=int, default=0, help="Use GPU x")
+    p.add_argument("--nproc_per_node", type=int, default=1,
+                   help="Data-parallel training processes on this node (several nodes: launch with torchrun)")
+    p.add_argument("--dist_backend", type=str, default="gloo", help="torch.distributed backend")
+    p.add_argument("--master_port", type=int, default=29500, help="Rendezvous port of --nproc_per_node")
 
     # Existing model
     p.add_argument("--model", "-m", type=str, default=None, help="A .PT file")
@@ -177,15 +396,45 @@ def parse_args():
     p.add_argument("--show_image_every", type=int, default=1000)
     p.add_argument("--upload_every", type=int, default=100)
     p.add_argument("--min_det_peaks", type=int, default=15)
+    p.add_argument("--min_indexed_peaks", type=int, default=-1)
     p.add_argument("--n_epochs", type=int, default=10)
     p.add_argument("--use_indexed_peaks", type=str, default="True")
     p.add_argument("--downsample", type=int, default=2)
     p.add_argument("--num_workers", type=int, default=0)
+    p.add_argument("--n_open_runs", type=int, default=4, help="Runs read concurrently by each data worker")
+    p.add_argument("--shuffle_buffer", type=int, default=256, help="Samples shuffled across the open runs")
+    p.add_argument("--block_size", type=int, default=1, help="Shuffle events by contiguous blocks (1: fully random)")
+    p.add_argument("--max_open_runs", type=int, default=16, help="Run handles kept open per process")
+    p.add_argument("--frame_source", type=str, default="psana", help="psana, or h5 for exported frames")
+    p.add_argument("--mask_cache_dir", type=str, default=None, help="Directory for the per-run pixel masks")
+    p.add_argument("--pool_in_loader", type=str, default="False", help="Downsample images in the data workers")
+    p.add_argument("--sparse_labels", type=str, default="False", help="Ship peak lists, rasterized by the loss")
+    p.add_argument("--batch_ring", type=str, default="False", help="Workers fill shared-memory batch slots")
+    p.add_argument("--ring_slots", type=int, default=-1, help="Slots of the batch ring (-1: from num_workers)")
+    p.add_argument("--debug_metrics", type=str, default="False", help="Recall / precision synced at every step")
+    p.add_argument("--async_visualization", type=str, default="True", help="Render images in a side process")
+    p.add_argument("--resume", type=str, default=None, help="Training checkpoint to resume from")
+    p.add_argument("--keep_checkpoints", type=int, default=3, help="Numbered training checkpoints kept")
+    p.add_argument("--precision", type=str, default="fp32",
+                   help="fp32, or amp for mixed precision (bfloat16 on CPU, float16 on CUDA), bf16 or fp16")
+    p.add_argument("--compile", type=str, default="eager", help="eager, or compile (torch.compile)")
+    p.add_argument("--prefetch", type=int, default=2, help="Batches prepared on the device ahead of the step")
+    p.add_argument("--sync_timers", type=str, default="False", help="Synchronize CUDA around each timed stage")
+    p.add_argument("--profile_start", type=int, default=-1, help="First step of the profiler trace (-1: no trace)")
+    p.add_argument("--profile_stop", type=int, default=-1,
+                   help="Step at which the profiler trace is written (-1: 10 steps)")
+    p.add_argument("--frame_dir", type=str, default=None, help="Directory of exported frames (h5 frame source)")
     p.add_argument("--use_adaptive_filtering", type=str, default="True")
+    p.add_argument("--dynamic_conv", type=str, default="auto",
+                   help="AdaFilter_1 per-panel filtering: auto, grouped, unfold or shift")
     p.add_argument("--use_scheduled_pos_weight", type=str, default="False")
     p.add_argument("--pos_weight_0", type=float, default=1e2)
     p.add_argument("--annihilation_speed", type=float, default=1e-1)
     p.add_argument("--step_after", type=int, default=200)
+    p.add_argument("--label_cache_dir", type=str, default=None, help="Directory for pre-rendered label sidecars")
+    p.add_argument("--image_cache_dir", type=str, default=None, help="Directory for the calibrated image cache")
+    p.add_argument("--image_cache_gb", type=float, default=50., help="Size cap of the image cache")
+    p.add_argument("--image_cache_dtype", type=str, default="float32", help="float32, float16 or uint16")
     return p.parse_args()
 
 def load_model(params):
@@ -203,16 +452,69 @@ def load_model(params):
     return model
 
 
-def main():
-    args = parse_args()
-    params = json.load(open(args.params))
+def prepare_model_dir(params, confirm_delete):
+    model_dir = os.path.join('debug', params["experiment_name"])
+
+    if os.path.exists(model_dir) and params["resume"] is None:
+        y = 'y'
+        if confirm_delete:
+            print('')
+            val = input("The model directory %s exists. Overwrite? (y/n)" % model_dir)
+        else:
+            val = 'y'
+
+        if val == 'y':
+            shutil.rmtree(model_dir)
+            print('')
+            print(params["experiment_name"] + " directory removed.")
+
+    os.makedirs(model_dir, exist_ok=True)
+
+    summaries_dir = os.path.join(model_dir, 'summaries')
+    if os.path.exists(summaries_dir) and params["resume"] is None:
+        shutil.rmtree(summaries_dir)
+    # a resumed job keeps logging into the same summaries, from the checkpoint's total_steps on
+    os.makedirs(summaries_dir, exist_ok=True)
+    return summaries_dir
+
+
+def run(params, args, model_dir_ready=False):
+    # one training process: the only one, or a rank started by launch_local or torchrun
+    if launched_with_env():
+        init_distributed(params["dist_backend"])
+        if is_main() and not model_dir_ready:
+            prepare_model_dir(params, args.confirm_delete)
+        barrier()
+    elif not model_dir_ready:
+        prepare_model_dir(params, args.confirm_delete)
+    summaries_dir = os.path.join('debug', params["experiment_name"], 'summaries')
 
     # System parameters
     if args.gpu is not None and torch.cuda.is_available():
-        device = torch.device("cuda:{}".format(args.gpu))
+        # one device per rank of the node
+        gpu = local_rank() if get_world_size() > 1 else args.gpu
+        device = torch.device("cuda:{}".format(gpu))
     else:
         device = torch.device("cpu")
 
+    model = load_model(params)
+
+    # Existing model
+    if args.model:
+        model.load_state_dict(torch.load(args.model, map_location="cpu"))
+
+    model = model.to(device)
+
+    writer = SummaryWriter(summaries_dir) if is_main() else None
+
+    train(model, device, params, writer)
+    cleanup()
+
+
+def main():
+    args = parse_args()
+    params = json.load(open(args.params))
+
     # Parameters not in params.json
     if args.experiment_name is not None:
         params["experiment_name"] = args.experiment_name
@@ -235,12 +537,57 @@ def main():
     params["show_image_every"] = args.show_image_every
     params["upload_every"] = args.upload_every
     params["min_det_peaks"] = args.min_det_peaks
+    params["min_indexed_peaks"] = args.min_indexed_peaks
     params["downsample"] = args.downsample
     params["num_workers"] = args.num_workers
+    params["n_open_runs"] = args.n_open_runs
+    params["shuffle_buffer"] = args.shuffle_buffer
+    params["block_size"] = args.block_size
+    params["max_open_runs"] = args.max_open_runs
+    params["frame_source"] = args.frame_source
+    params["frame_dir"] = args.frame_dir
+    params["mask_cache_dir"] = args.mask_cache_dir
+    if args.pool_in_loader == "True":
+        params["pool_in_loader"] = True
+    else:
+        params["pool_in_loader"] = False
+    if args.sparse_labels == "True":
+        params["sparse_labels"] = True
+    else:
+        params["sparse_labels"] = False
+    if args.batch_ring == "True":
+        params["batch_ring"] = True
+    else:
+        params["batch_ring"] = False
+    params["ring_slots"] = args.ring_slots
+    params["prefetch"] = args.prefetch
+    params["precision"] = args.precision
+    params["dynamic_conv"] = args.dynamic_conv
+    params["compile"] = args.compile
+    params["resume"] = args.resume
+    if args.debug_metrics == "True":
+        params["debug_metrics"] = True
+    else:
+        params["debug_metrics"] = False
+    if args.async_visualization == "True":
+        params["async_visualization"] = True
+    else:
+        params["async_visualization"] = False
+    params["keep_checkpoints"] = args.keep_checkpoints
+    if args.sync_timers == "True":
+        params["sync_timers"] = True
+    else:
+        params["sync_timers"] = False
+    params["profile_start"] = args.profile_start
+    params["profile_stop"] = args.profile_stop
     params["n_epochs"] = args.n_epochs
     params["pos_weight_0"] = args.pos_weight_0
     params["annihilation_speed"] = args.annihilation_speed
     params["step_after"] = args.step_after
+    params["label_cache_dir"] = args.label_cache_dir
+    params["image_cache_dir"] = args.image_cache_dir
+    params["image_cache_gb"] = args.image_cache_gb
+    params["image_cache_dtype"] = args.image_cache_dtype
     if args.use_indexed_peaks == "True":
         params["use_indexed_peaks"] = True
     else:
@@ -263,40 +610,14 @@ def main():
     else:
         params["use_scheduled_pos_weight"] = False
     params["verbose"] = False
+    params["dist_backend"] = args.dist_backend
 
-    model = load_model(params)
-
-    # Existing model
-    if args.model:
-        model.load_state_dict(torch.load(args.model, map_location="cpu"))
-
-    model = model.to(device)
-
-    model_dir = os.path.join('debug', params["experiment_name"])
-
-    if os.path.exists(model_dir):
-        y = 'y'
-        if args.confirm_delete:
-            print('')
-            val = input("The model directory %s exists. Overwrite? (y/n)" % model_dir)
-        else:
-            val = 'y'
-
-        if val == 'y':
-            shutil.rmtree(model_dir)
-            print('')
-            print(params["experiment_name"] + " directory removed.")
-
-    os.makedirs(model_dir)
-
-    summaries_dir = os.path.join(model_dir, 'summaries')
-    if os.path.exists(summaries_dir):
-        shutil.rmtree(summaries_dir)
-    os.makedirs(summaries_dir)
-
-    writer = SummaryWriter(summaries_dir)
-
-    train(model, device, params, writer)
+    if args.nproc_per_node > 1 and not launched_with_env():
+        # the model directory is prepared here, where input() can still prompt
+        prepare_model_dir(params, args.confirm_delete)
+        launch_local(run, args.nproc_per_node, args=(params, args, True), master_port=args.master_port)
+    else:
+        run(params, args)
     
     
 if __name__ == "__main__":
@@ -3,10 +3,9 @@ import time
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from peaknet.data import PSANADataset, PSANAImage
+from peaknet.data import PSANADataset, PSANAStream
 from unet import UNet
 from peaknet.loss import PeaknetBCELoss
-from peaknet.train import check_existence
 import matplotlib as mpl
 mpl.use('Agg')
 from matplotlib import pyplot as plt
@@ -43,40 +42,33 @@ def validate(model, device, params, save_plot=False):
     acc_pre = 0
     acc_rms = 0
     acc_dt = 0
-    for i, (cxi_path, exp, run) in enumerate(val_dataset):
-        if check_existence(exp, run):
-            pass
-        else:
-            print("[{:}] exp: {}  run: {}  PRECHECK FAILED".format(i, exp, run))
-            continue
-        print("*********************************************************************")
-        print("[{:}] exp: {}  run: {}\ncxi: {}".format(i, exp, run, cxi_path))
-        print("*********************************************************************")
-        psana_images = PSANAImage(cxi_path, exp, run, downsample=params["downsample"], n=params["n_per_run"])
-        data_loader = DataLoader(psana_images, batch_size=params["batch_size"], shuffle=True, drop_last=True,
-                                 num_workers=params["num_workers"])
-        for j, (x, y) in enumerate(data_loader):
-            with torch.no_grad():
-                n = x.size(0)
-                h, w = x.size(2), x.size(3)
-                x = x.view(-1, 1, h, w).to(device)
-                y = y.view(-1, 3, h, w).to(device)
-                t1 = time.time()
-                scores = model(x)
-                t2 = time.time()
-                loss, recall, precision, rmsd = loss_func(scores, y, verbose=params["verbose"], cutoff=params["cutoff"])
-                seen += n
-                dt = t2 - t1
-                print("loss {:7.5f}  recall  {:.3f}  precision {:.3f}  RMSD {:.3f} in {:5.3f} ms".
-                      format(float(loss.data.cpu()), recall, precision, rmsd, 1000*dt))
-                acc_rec += n * recall
-                acc_pre += n * precision
-                acc_rms += n * rmsd
-                acc_dt += n * dt
-                if save_plot:
-                    output_filename = "debug/val_{}_{}_{}".format(exp, run, str(j).zfill(6))
-                    plot(x, y, scores, output_filename)
-        psana_images.close()
+    image_kwargs = {"downsample": params["downsample"], "n": params["n_per_run"],
+                    "label_cache_dir": params["label_cache_dir"]}
+    val_stream = PSANAStream(val_dataset, image_kwargs, shuffle=False)
+    data_loader = DataLoader(val_stream, batch_size=params["batch_size"], drop_last=True,
+                             num_workers=params["num_workers"])
+    for j, (x, y, _) in enumerate(data_loader):
+        with torch.no_grad():
+            n = x.size(0)
+            h, w = x.size(2), x.size(3)
+            x = x.view(-1, 1, h, w).to(device)
+            y = y.view(-1, 3, h, w).to(device)
+            t1 = time.time()
+            scores = model(x)
+            t2 = time.time()
+            metrics = loss_func(scores, y, verbose=params["verbose"], cutoff=params["cutoff"])
+            loss, recall, precision, rmsd = metrics["loss"], metrics["recall"], metrics["precision"], float(metrics["rmsd"])
+            seen += n
+            dt = t2 - t1
+            print("loss {:7.5f}  recall  {:.3f}  precision {:.3f}  RMSD {:.3f} in {:5.3f} ms".
+                  format(float(loss.data.cpu()), recall, precision, rmsd, 1000*dt))
+            acc_rec += n * recall
+            acc_pre += n * precision
+            acc_rms += n * rmsd
+            acc_dt += n * dt
+            if save_plot:
+                output_filename = "debug/val_{}".format(str(j).zfill(6))
+                plot(x, y, scores, output_filename)
     acc_rec /= seen
     acc_pre /= seen
     acc_rms /= seen
@@ -94,6 +86,7 @@ def parse_args():
     p.add_argument("--n_filters", type=int, default=32, help="Number of filters in UNet's first layer")
     p.add_argument("--n_per_run", "-n", type=int, default=-1, help="Number of images to sample from a run")
     p.add_argument("--plot", action="store_true", help="save output images in debug/")
+    p.add_argument("--label_cache_dir", type=str, default=None, help="Directory for pre-rendered label sidecars")
     return p.parse_args()
 
 
@@ -101,7 +94,8 @@ def main():
     args = parse_args()
     params = {"run_dataset_path": "/reg/neh/home/liponan/peaknet2020/data/val.csv",
               "verbose": False, "lr": 0.01, "weight_decay": 1e-4, "cutoff": args.cutoff,
-              "batch_size": args.batch_size, "num_workers": 0, "downsample": 1, "n_per_run": args.n_per_run}
+              "batch_size": args.batch_size, "num_workers": 0, "downsample": 1, "n_per_run": args.n_per_run,
+              "label_cache_dir": args.label_cache_dir}
     model = UNet(n_channels=1, n_classes=3, n_filters=args.n_filters)
     model.load_state_dict(torch.load(args.model))
     if args.gpu is not None and torch.cuda.is_available():
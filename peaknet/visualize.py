@@ -1,7 +1,13 @@
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import copy
+import queue
+import traceback
+import torch
 import torch.nn as nn
+import torch.multiprocessing as mp
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 def scalar_metrics(writer, metrics, total_steps):
     for (key, value) in metrics.items():
@@ -20,9 +26,25 @@ def show_weights_model(writer, model, total_steps):
     #     axs[c // 4, c % 4].imshow(gen_peak_finding_w[c], cmap='gray')
     # writer.add_figure('Generic Peak Finding Weights (0.1)', fig, global_step=total_steps)
 
-def show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params, device, model, use_indexed_peaks=False):
-    print("*** PANELS ***")
+def figure_to_array(fig):
+    # rendered without pyplot, so that no global figure state is kept (and no display is needed)
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def add_panel_image(ax, img, colorbar=False, title=None):
+    if title is not None:
+        ax.set_title(title)
+    im = ax.imshow(img, cmap='Blues')
+    if colorbar:
+        ax.figure.colorbar(im, ax=ax)
+    ax.set_xticks([])
+    ax.set_yticks([])
 
+
+def render_GT_prediction_image(img_vis, target_vis, params, device, model, use_indexed_peaks=False):
+    # (name, RGB array) for each panel shown
     center_panels = [0, 1, 8, 9, 16, 17, 24, 25]
     top_left = [4, 5]
 
@@ -34,27 +56,26 @@ def show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params, d
         img_vis = model.downsample_for_visualization(x).cpu().numpy()
         img_vis = img_vis.reshape(-1, img_vis.shape[2], img_vis.shape[3])
 
+    images = []
     for i in center_panels + top_left:
         panel_name = 'panel_'+str(i)
 
-        fig = plt.figure(figsize=(10,10))
-        plt.subplot(211)
-        plt.imshow(img_vis[i], cmap='Blues')
-        plt.xticks([])
-        plt.yticks([])
+        fig = Figure(figsize=(10,10))
+        ax = fig.add_subplot(211)
+        add_panel_image(ax, img_vis[i])
 
         # Prediction
         indices_nonzero = np.array(np.argwhere(scores[i, 0] > params["cutoff"]))
         if params["n_classes"] == 3:
-            shift_u = scores[i, 1, indices_nonzero[:, 0], indices_nonzero[:, 1]].numpy()
-            shift_v = scores[i, 2, indices_nonzero[:, 0], indices_nonzero[:, 1]].numpy()
-            plt.plot(indices_nonzero[:, 1] - .5 + shift_v,
-                     indices_nonzero[:, 0] - .5 + shift_u,
-                     'rs', markerfacecolor='none', markersize=5, markeredgewidth=2.0, alpha=.8)
+            shift_u = scores[i, 1, indices_nonzero[:, 0], indices_nonzero[:, 1]]
+            shift_v = scores[i, 2, indices_nonzero[:, 0], indices_nonzero[:, 1]]
+            ax.plot(indices_nonzero[:, 1] - .5 + shift_v,
+                    indices_nonzero[:, 0] - .5 + shift_u,
+                    'rs', markerfacecolor='none', markersize=5, markeredgewidth=2.0, alpha=.8)
         elif params["n_classes"] == 1:
-            plt.plot(indices_nonzero[:, 1] - .5,
-                     indices_nonzero[:, 0] - .5,
-                     'rs', markerfacecolor='none', markersize=5, markeredgewidth=2.0, alpha=.8, label="model")
+            ax.plot(indices_nonzero[:, 1] - .5,
+                    indices_nonzero[:, 0] - .5,
+                    'rs', markerfacecolor='none', markersize=5, markeredgewidth=2.0, alpha=.8, label="model")
         else:
             print("Unrecognized number of classes for visualization.")
 
@@ -63,13 +84,13 @@ def show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params, d
         if params["n_classes"] == 3:
             shift_u = target_vis[i, 1, indices_nonzero[:, 0], indices_nonzero[:, 1]].numpy()
             shift_v = target_vis[i, 2, indices_nonzero[:, 0], indices_nonzero[:, 1]].numpy()
-            plt.plot(indices_nonzero[:, 1] - .5 + shift_v,
-                     indices_nonzero[:, 0] - .5 + shift_u,
-                     'gs', markerfacecolor='none', markersize=10, markeredgewidth=2.0, alpha=.8)
+            ax.plot(indices_nonzero[:, 1] - .5 + shift_v,
+                    indices_nonzero[:, 0] - .5 + shift_u,
+                    'gs', markerfacecolor='none', markersize=10, markeredgewidth=2.0, alpha=.8)
         elif params["n_classes"] == 1:
-            plt.plot(indices_nonzero[:, 1] - .5,
-                     indices_nonzero[:, 0] - .5,
-                     'gs', markerfacecolor='none', markersize=10, markeredgewidth=2.0, alpha=.8, label="psocake")
+            ax.plot(indices_nonzero[:, 1] - .5,
+                    indices_nonzero[:, 0] - .5,
+                    'gs', markerfacecolor='none', markersize=10, markeredgewidth=2.0, alpha=.8, label="psocake")
         else:
             print("Unrecognized number of classes for visualization.")
 
@@ -77,23 +98,25 @@ def show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params, d
         if use_indexed_peaks:
             indices_nonzero = np.array(np.nonzero(target_vis[i, 1]))
             if params["n_classes"] == 1:
-                plt.plot(indices_nonzero[:, 1] - .5,
-                         indices_nonzero[:, 0] - .5,
-                         'mo', markerfacecolor='none', markersize=10, markeredgewidth=2.0, alpha=.8, label="indexing")
+                ax.plot(indices_nonzero[:, 1] - .5,
+                        indices_nonzero[:, 0] - .5,
+                        'mo', markerfacecolor='none', markersize=10, markeredgewidth=2.0, alpha=.8, label="indexing")
             else:
                 print("Unrecognized number of classes for visualization.")
-        plt.legend(loc="best")
+        ax.legend(loc="best")
 
-        plt.subplot(212)
-        plt.imshow(img_vis[i], cmap='Blues')
-        plt.xticks([])
-        plt.yticks([])
+        add_panel_image(fig.add_subplot(212), img_vis[i])
 
-        writer.add_figure(panel_name, fig, global_step=total_steps)
+        images.append((panel_name, figure_to_array(fig)))
+    return images
 
-def show_inter_act(writer, img_vis, total_steps, params, device, model):
-    print("*** INTERMEDIATE ACTIVATIONS ***")
+def show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params, device, model, use_indexed_peaks=False):
+    print("*** PANELS ***")
+    for panel_name, image in render_GT_prediction_image(img_vis, target_vis, params, device, model,
+                                                        use_indexed_peaks=use_indexed_peaks):
+        writer.add_image(panel_name, image, global_step=total_steps, dataformats="HWC")
 
+def render_inter_act(img_vis, params, device, model):
     panels = [0, 4]
 
     h, w = img_vis.size(1), img_vis.size(2)
@@ -104,44 +127,90 @@ def show_inter_act(writer, img_vis, total_steps, params, device, model):
     logits = logits.cpu().numpy()
     logits_out = logits_out.cpu().numpy()
 
+    images = []
     for i in panels:
         title = 'Intermediate Activations Panel ' + str(i)
 
-        fig = plt.figure(figsize=(10, 20))
-
-        plt.subplot(511)
-        plt.title("Original Panel")
-        plt.imshow(img_vis[i], cmap='Blues')
-        plt.colorbar()
-        plt.xticks([])
-        plt.yticks([])
-
-        plt.subplot(512)
-        plt.title("Downsampled Panel")
-        plt.imshow(x_ds[i, 0], cmap='Blues')
-        plt.colorbar()
-        plt.xticks([])
-        plt.yticks([])
-
-        plt.subplot(513)
-        plt.title("After Panel/Exp-Dependent Filtering")
-        plt.imshow(filtered_x[i, 0], cmap='Blues')
-        plt.colorbar()
-        plt.xticks([])
-        plt.yticks([])
-
-        plt.subplot(514)
-        plt.title("After Generic Peak Finding")
-        plt.imshow(logits[i, 0], cmap='Blues')
-        plt.colorbar()
-        plt.xticks([])
-        plt.yticks([])
-
-        plt.subplot(515)
-        plt.title("After Panel-Dependent Scaling")
-        plt.imshow(logits_out[i, 0], cmap='Blues')
-        plt.colorbar()
-        plt.xticks([])
-        plt.yticks([])
-
-        writer.add_figure(title, fig, global_step=total_steps)
\ No newline at end of file
+        fig = Figure(figsize=(10, 20))
+        add_panel_image(fig.add_subplot(511), img_vis[i], colorbar=True, title="Original Panel")
+        add_panel_image(fig.add_subplot(512), x_ds[i, 0], colorbar=True, title="Downsampled Panel")
+        add_panel_image(fig.add_subplot(513), filtered_x[i, 0], colorbar=True,
+                        title="After Panel/Exp-Dependent Filtering")
+        add_panel_image(fig.add_subplot(514), logits[i, 0], colorbar=True, title="After Generic Peak Finding")
+        add_panel_image(fig.add_subplot(515), logits_out[i, 0], colorbar=True, title="After Panel-Dependent Scaling")
+
+        images.append((title, figure_to_array(fig)))
+    return images
+
+def show_inter_act(writer, img_vis, total_steps, params, device, model):
+    print("*** INTERMEDIATE ACTIVATIONS ***")
+    for title, image in render_inter_act(img_vis, params, device, model):
+        writer.add_image(title, image, global_step=total_steps, dataformats="HWC")
+
+def visualization_worker(jobs, busy, model, img_vis, target_vis, params, summaries_dir):
+    from torch.utils.tensorboard import SummaryWriter
+    # leave the cores to training
+    torch.set_num_threads(1)
+    writer = SummaryWriter(summaries_dir)
+    device = torch.device("cpu")
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        total_steps, state_dict = job
+        try:
+            model.load_state_dict(state_dict)
+            with torch.no_grad():
+                show_GT_prediction_image(writer, img_vis, target_vis, total_steps, params, device, model,
+                                         use_indexed_peaks=params["use_indexed_peaks"])
+                if hasattr(model, 'can_show_inter_act') and model.can_show_inter_act:
+                    show_inter_act(writer, img_vis, total_steps, params, device, model)
+            writer.flush()
+        except Exception:
+            # one bad render does not stop the next ones
+            print("Visualization at step " + str(total_steps) + " failed:\n" + traceback.format_exc())
+        finally:
+            # set by AsyncVisualizer.submit, from the snapshot's submission to the end of its rendering
+            busy.clear()
+    writer.close()
+
+class AsyncVisualizer(object):
+    """
+    Renders the panels of show_GT_prediction_image / show_inter_act in a spawned process, with a CPU copy
+    of the model, and logs them to its own event file in the same summaries directory. submit() only
+    snapshots the weights; while the previous snapshot is queued or being rendered, the new one is skipped.
+    """
+
+    def __init__(self, model, img_vis, target_vis, params, summaries_dir):
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue(maxsize=1)
+        self.busy = ctx.Event()
+        self.process = ctx.Process(target=visualization_worker, daemon=True,
+                                   args=(self.jobs, self.busy, copy.deepcopy(model).cpu(), img_vis, target_vis, params,
+                                         summaries_dir))
+        self.process.start()
+        self.n_submitted = 0
+        self.n_skipped = 0
+
+    def submit(self, model, total_steps):
+        if self.busy.is_set() or not self.process.is_alive():
+            self.n_skipped += 1
+            return False
+        self.busy.set()
+        state_dict = {key: value.detach().to("cpu", copy=True) for key, value in model.state_dict().items()}
+        self.jobs.put((total_steps, state_dict))
+        self.n_submitted += 1
+        return True
+
+    def close(self, timeout=120.):
+        # the render process may have died, or be stuck: training never waits more than about 2 * timeout for it
+        if self.process.is_alive():
+            try:
+                self.jobs.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            print("The visualization process did not exit within " + str(timeout) + " s, terminating it.")
+            self.process.terminate()
+            self.process.join()
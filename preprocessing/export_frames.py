@@ -0,0 +1,43 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import argparse
+import numpy as np
+import h5py
+from frame_source import PSANAReader, export_frames, frame_path
+
+# Export calibrated, masked frames from psana so that training, evaluation and benchmarks can run off the
+# facility nodes with --frame_source h5 --frame_dir <out_dir>.
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--exp", type=str, required=True)
+    p.add_argument("--run", type=int, required=True)
+    p.add_argument("--det_name", type=str, default="DsdCsPad")
+    p.add_argument("--out_dir", type=str, required=True)
+    p.add_argument("--cxi_path", type=str, default=None, help="Only export the events listed in this CXI file")
+    p.add_argument("--n", type=int, default=-1, help="Export at most n events")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    reader = PSANAReader(args.exp, args.run, args.det_name)
+    reader.build()
+    if args.cxi_path is not None:
+        with h5py.File(args.cxi_path, "r") as f:
+            n_hits = len(f["entry_1/result_1/nPeaks"])
+            event_idxs = np.unique(f["LCLS/eventNumber"][:n_hits])
+    else:
+        event_idxs = np.arange(len(reader.times))
+    if args.n > 0:
+        event_idxs = event_idxs[:args.n]
+    path = frame_path(args.out_dir, args.exp, args.run)
+    print("Exporting " + str(len(event_idxs)) + " events to " + path + "...")
+    export_frames(reader, path, event_idxs)
+    print("Exported!")
+
+
+if __name__ == "__main__":
+    main()
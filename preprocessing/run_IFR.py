@@ -1,10 +1,12 @@
 import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
 import pandas as pd
 import shutil
 import argparse
 import numpy as np
 from streamManager import iStream
-import psana
+from frame_source import build_frame_source
 
 def get_new_seen(extract):
     seen = []
@@ -21,16 +23,18 @@ def get_event_number(extract, idx_stream):
     return id
 
 class Experiment:
-    def __init__(self, experimentName, runNumber, detInfo='cspad'):
+    def __init__(self, experimentName, runNumber, detInfo='cspad', source="psana", frame_dir=None):
         self.experimentName = experimentName
         self.runNumber = runNumber
         self.detInfo = detInfo
+        self.source = source
+        self.frame_dir = frame_dir
 
     def setup(self):
-        access = 'exp=' + str(self.experimentName) + ':run=' + str(self.runNumber) + ':idx'
-        self.ds = psana.DataSource(access)
-        self.run = next(self.ds.runs())
-        self.times = self.run.times()
+        self.frames = build_frame_source(self.experimentName, self.runNumber, self.detInfo, source=self.source,
+                                         frame_dir=self.frame_dir)
+        self.frames.build()
+        self.times = self.frames.times
         self.eventTotal = len(self.times)
 
 def parse_args():
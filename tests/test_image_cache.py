@@ -0,0 +1,18 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import numpy as np
+from image_cache import ImageCache
+
+
+def test_float16_error_ignores_negative_pixels(tmp_path):
+    # calibrated frames have negative pixels, clipped by the data pipeline: they are no quantization error
+    cache = ImageCache(str(tmp_path / "cache"), max_gb=1e-3, dtype="float16", img_shape=(2, 8, 8))
+    rng = np.random.RandomState(0)
+    img = rng.uniform(-50., 50., size=(2, 8, 8)).astype(np.float32)
+    cache.put("cxitut13", 10, 0, img)
+    assert (img < 0).any()
+    # float16 rounding of values below 50
+    assert cache.max_abs_err <= 50. * 2. ** -11
+    assert np.allclose(np.maximum(cache.get("cxitut13", 10, 0), 0), np.maximum(img, 0), atol=50. * 2. ** -11)
+    cache.close()
@@ -0,0 +1,35 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peaknet"))
+import numpy as np
+import pandas as pd
+import pytest
+from data import PSANADataset
+from checkpoint import RESUME_PARAMS, check_resume_params
+
+
+def write_run_table(path, n_runs=20):
+    subsets = ["train", "test"] * (n_runs // 2)
+    pd.DataFrame({"path": ["run_{}.cxi".format(i) for i in range(n_runs)], "exp": "cxitut13",
+                  "run": np.arange(n_runs), "subset": subsets}).to_csv(path, index=False)
+
+
+def test_resume_with_n_experiments(tmp_path):
+    # --resume with --n_experiments > 0: the new job samples other runs, the checkpoint's are restored
+    df_path = str(tmp_path / "runs.csv")
+    write_run_table(df_path)
+    np.random.seed(0)
+    interrupted = PSANADataset(df_path, subset="train", n=4)
+    run_index = list(interrupted.df.index)
+    np.random.seed(1)
+    resumed = PSANADataset(df_path, subset="train", n=4)
+    resumed.select(run_index)
+    assert len(resumed) == 4
+    assert [resumed[i] for i in range(len(resumed))] == [interrupted[i] for i in range(len(interrupted))]
+
+
+def test_resume_with_other_loader_params():
+    saved = {key: 1 for key in RESUME_PARAMS}
+    check_resume_params(saved, dict(saved, lr=1e-3))
+    with pytest.raises(ValueError, match="num_workers"):
+        check_resume_params(saved, dict(saved, num_workers=4))
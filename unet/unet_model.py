@@ -34,10 +34,14 @@ class UNet(nn.Module):
         self.dataset_path = params["run_dataset_path"]
         self.downsample = params["downsample"]
 
+    def input_is_downsampled(self, x):
+        # the data pipeline may have max-pooled the panels already (pool_in_loader)
+        return x.size(2) <= 185 // self.downsample
+
     def forward(self, x):
         h, w = x.size(2), x.size(3)
         x = x.view(-1, 1, h, w)
-        if self.downsample_bool:
+        if self.downsample_bool and not self.input_is_downsampled(x):
             x_ds = self.downsampling(x)
         else:
             x_ds = x
@@ -54,7 +58,7 @@ class UNet(nn.Module):
         return logits
 
     def downsample_for_visualization(self, x):
-        if self.downsample_bool:
+        if self.downsample_bool and not self.input_is_downsampled(x):
             x_ds = self.downsampling(x)
         else:
             x_ds = x